@@ -1,7 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import sys
+import threading
+from contextlib import contextmanager
+
 import ldap
+import ldap.dn
+import ldap.filter
+import ldap.ldapobject
 import ldap.modlist
+from ldap.controls import SimplePagedResultsControl
+
+from auth import cache, coherence, credentials, fanout, graph, mailindex, pool, replica
+from auth.utils import normalize_dn
 
 # LDAP does not accept empty groups. Use this string to have non-empty groups. Must not be a valid user-dn
 EMPTY_LIST_IDENTIFIER = "cn=empty"
@@ -13,92 +24,511 @@ EVERYBODY_IDENTIFIER = "cn=everybody"
 ANONYMOUS_IDENTIFIER = "cn=anonymous"
 
 class Directory:
-    def __init__(self, ldap_host='', bind_user='', bind_password='', user_dn_base='', group_dn_base=''):
+    def __init__(self, ldap_host='', bind_user='', bind_password='', user_dn_base='', group_dn_base='',
+                 pool_size=10, pool_timeout=10, pool_idle_timeout=300, pool_check_interval=30, persistent=False,
+                 bind_pool_size=5, bind_pool_timeout=5, bind_timeout=5,
+                 batch_size=100, page_size=500, nested_groups=False, graph_ttl=300, cache=None,
+                 mail_index=False, mail_index_ttl=3600, mail_negative_ttl=60,
+                 credential_ttl=60, credential_user_limit=10, credential_ip_limit=50, credential_limit_period=300,
+                 tracer=None, replicate=False, coherence_context=None, coherence_interval=5):
+        # Optional auth.tracing.Tracer recording the operations of all connections
+        self.tracer = tracer
+
         def get_connection():
-            conn = ldap.initialize(ldap_host)
+            # Transparently reconnects and rebinds if the server went away between two operations
+            conn = self._traced(ldap.ldapobject.ReconnectLDAPObject(ldap_host, retry_max=2, retry_delay=0.5))
             conn.simple_bind_s(bind_user, bind_password)
             return conn
 
         self.generate_connection = get_connection
+        if persistent:
+            self.pool = pool.PersistentConnections(get_connection, check_interval=pool_check_interval)
+        else:
+            self.pool = pool.ConnectionPool(get_connection, size=pool_size, timeout=pool_timeout,
+                                            idle_timeout=pool_idle_timeout, check_interval=pool_check_interval)
+        # Use as "with directory.connection() as conn:", the connection is returned to the pool afterwards
+        self.connection = self.pool.connection
+
+        def get_bind_connection():
+            # No ReconnectLDAPObject, it would repeat the bind of the last checked user after reconnecting
+            conn = ldap.initialize(ldap_host)
+            conn.set_option(ldap.OPT_NETWORK_TIMEOUT, bind_timeout)
+            conn.timeout = bind_timeout
+            return self._traced(conn)
+
+        # Connections for password checks, never bound as bind_user
+        self.bind_pool = pool.BindPool(get_bind_connection, size=bind_pool_size, timeout=bind_pool_timeout,
+                                       idle_timeout=pool_idle_timeout, check_interval=pool_check_interval)
 
         self.user_dn_base = user_dn_base
         self.group_dn_base = group_dn_base
+        # Number of entries fetched with a single OR-filter by the get_*_by_dns methods
+        self.batch_size = batch_size
+        # Entries per page of search(), None to send plain searches to servers without the paged results control
+        self.page_size = page_size
+        # Resolve groups being members of other groups, using an in-process graph of all memberships
+        self.graph = graph.MembershipGraph(self._load_membership_graph, ttl=graph_ttl) if nested_groups else None
+        # Optional auth.cache.DirectoryCache shared by all requests
+        self.cache = cache
+        # normalized group dn -> cn in its real spelling, known memberships only keep normalized dns
+        self.group_names = {}
+        # Drop changed entries from the cache once the contextCSN of coherence_context moved
+        self.coherence = coherence.Coherence(self, coherence_context, coherence_interval) if cache is not None and coherence_context else None
+        # Find users by mail in an in-process index instead of searching
+        self.mail_index = mailindex.MailIndex(self._load_mail_index, ttl=mail_index_ttl, negative_ttl=mail_negative_ttl,
+                                              backend=cache.backend if cache is not None else None) if mail_index else None
+        # Password checks for other services, successful ones are remembered for credential_ttl seconds. Failures and
+        # forgotten checks are shared through the backend of cache
+        self.credentials = credentials.CredentialChecker(self, ttl=credential_ttl, user_limit=credential_user_limit,
+                                                         ip_limit=credential_ip_limit, limit_period=credential_limit_period,
+                                                         backend=cache.backend if cache is not None else None)
+        # Answer reads from an in-process copy of all users and groups, kept current by content synchronization
+        self.replica = replica.Replica(ldap_host, bind_user, bind_password, [user_dn_base, group_dn_base]) if replicate else None
+
+        self._local = threading.local()
+
+    def _traced(self, conn):
+        return self.tracer.wrap(conn) if self.tracer is not None else conn
+
+    def begin_request(self):
+        self._local.identity_map = cache.IdentityMap()
+        if self.coherence is not None:
+            self.coherence.check()
+
+    def end_request(self):
+        self._local.identity_map = None
+
+    def get_identity_map(self):
+        return getattr(self._local, "identity_map", None)
+
+    def _get_entry(self, cls, dn, attrlist=None):
+        # An entry already known to the request is returned even if it was loaded with another attrlist, missing
+        # attributes are loaded on access anyway
+        identity_map = self.get_identity_map()
+        if identity_map is None:
+            return cls(self, dn, attrlist=attrlist)
+        entry = identity_map.get(cls, dn)
+        if entry is None:
+            entry = identity_map.add(cls(self, dn, attrlist=attrlist))
+        return entry
+
+    def entry_changed(self, entry, added=(), removed=()):
+        # Called after every write. added and removed are the members the write added to or removed from a group
+        member_dns = list(added) + list(removed)
+        identity_map = self.get_identity_map()
+        if identity_map is not None:
+            identity_map.add(entry)
+            identity_map.forget_memberships(member_dns)
+            identity_map.mark_changed([entry.dn] + list(member_dns))
+        if self.cache is not None:
+            self.cache.delete(entry.cache_kind, entry.dn)
+            for dn in member_dns:
+                self.cache.delete("membership", dn)
+        if self.graph is not None and member_dns:
+            self.graph.update_members(entry.dn, added, removed)
+        self._forget_credentials(member_dns)
+        self.written(entry.dn, member_dns)
+
+    def entry_deleted(self, entry, member_dns=()):
+        identity_map = self.get_identity_map()
+        if identity_map is not None:
+            identity_map.discard(entry)
+            identity_map.forget_memberships(member_dns)
+            identity_map.mark_changed([entry.dn] + list(member_dns))
+        if self.cache is not None:
+            self.cache.delete(entry.cache_kind, entry.dn)
+            for dn in member_dns:
+                self.cache.delete("membership", dn)
+        if self.graph is not None:
+            self.graph.remove_group(entry.dn)
+        self.group_names.pop(normalize_dn(entry.dn), None)
+        self._forget_credentials(member_dns)
+        self.written(entry.dn, member_dns)
+
+    def written(self, dn, member_dns=()):
+        # Until the server sends the entry back, the replica must not answer for it or the memberships of member_dns
+        if self.replica is not None:
+            self.replica.mark_stale(dn, member_dns)
+
+    def get_replicated(self, dn):
+        # attrs of dn from the replica, None if there is none or it cannot answer. AttributeError if dn does not exist
+        if self.replica is None:
+            return None
+        return self.replica.get_entry(dn)
+
+    def _forget_credentials(self, dns):
+        # Remembered password checks include the groups of the user
+        for dn in dns:
+            uid = self.get_uid(dn)
+            if uid is not None:
+                self.credentials.forget(uid)
+
+    def is_changed(self, dn):
+        # Whether dn was written or got its memberships changed during the current request
+        identity_map = self.get_identity_map()
+        return identity_map is not None and identity_map.is_changed(dn)
+
+    def cache_entry(self, kind, dn, attrs):
+        if self.cache is not None:
+            # Never put password hashes into a shared cache
+            self.cache.set(kind, dn, dict((attr, values) for attr, values in attrs.items() if attr.lower() != "userpassword"))
+
+    @contextmanager
+    def fanout(self):
+        """
+        Runs the lookups of the yielded auth.fanout.Fanout concurrently on one connection. All results are there
+        when the block is left.
+        """
+        batch = fanout.Fanout(self)
+        try:
+            yield batch
+            batch.wait()
+        except:
+            batch.abandon()
+            batch.release(*sys.exc_info())
+            raise
+        batch.release(None, None, None)
+
+    def search(self, base, filterstr, attrlist=None, scope=ldap.SCOPE_ONELEVEL):
+        """
+        Generator over the (dn, attrs) results of a search. Results are requested in pages of page_size entries, so
+        the sizelimit of the server does not apply and never more than one page is held in memory. The last page is
+        yielded after the connection went back to the pool, so lookups while iterating over a search fitting into
+        one page use no second connection. Further pages are bound to the connection, which is kept while they are
+        pending.
+        """
+        for page in self._search_pages(base, filterstr, attrlist, scope):
+            for dn, attrs in page:
+                # Skip search references
+                if dn is not None:
+                    yield dn, attrs
+
+    def _search_pages(self, base, filterstr, attrlist, scope):
+        with self.connection() as conn:
+            if not self.page_size:
+                page = conn.search_s(base, scope, filterstr, attrlist)
+            else:
+                control = SimplePagedResultsControl(True, size=self.page_size, cookie='')
+                while True:
+                    msgid = conn.search_ext(base, scope, filterstr, attrlist, serverctrls=[control])
+                    rtype, page, rmsgid, controls = conn.result3(msgid)
+                    cookies = [c.cookie for c in controls if c.controlType == SimplePagedResultsControl.controlType]
+                    if not cookies or not cookies[0]:
+                        break
+                    yield page
+                    control.cookie = cookies[0]
+        yield page
+
+    def _hydrate(self, cls, dn, attrs, attrlist):
+        # Entry for a search result, shared through the identity map. Only complete entries are cached
+        identity_map = self.get_identity_map()
+        entry = identity_map.get(cls, dn) if identity_map is not None else None
+        if entry is None:
+            entry = cls(self, dn, attrs, attrlist)
+            if attrlist is None:
+                self.cache_entry(cls.cache_kind, dn, attrs)
+            if identity_map is not None:
+                identity_map.add(entry)
+        return entry
+
+    def _iter_entries(self, cls, base, filterstr, attrlist, all_filter):
+        # Searches for all entries are answered by the replica if possible
+        entries = self.replica.get_entries(base) if self.replica is not None and filterstr == all_filter else None
+        if entries is not None:
+            for dn, attrs in entries:
+                yield self._hydrate(cls, dn, attrs, None)
+            return
+        attrlist = projection(cls, attrlist)
+        for dn, attrs in self.search(base, filterstr, attrlist):
+            yield self._hydrate(cls, dn, attrs, attrlist)
+
+    def iter_users(self, filterstr="(uid=*)", attrlist=None):
+        return self._iter_entries(User, self.user_dn_base, filterstr, attrlist, "(uid=*)")
+
+    def iter_groups(self, filterstr="(cn=*)", attrlist=None):
+        return self._iter_entries(Group, self.group_dn_base, filterstr, attrlist, "(cn=*)")
+
+    def _load_membership_graph(self):
+        return [(dn, attrs.get("uniqueMember", [])) for dn, attrs in self.search(self.group_dn_base, "(cn=*)", ["uniqueMember"])]
+
+    def _load_mail_index(self):
+        # Raw results, hydrating would put every user into the identity map of the current request
+        for dn, attrs in self.search(self.user_dn_base, "(uid=*)", User.MAIL_ATTRS):
+            yield attrs["uid"][0], attrs.get("mail", []) + attrs.get("email", []) + attrs.get("otherMailbox", [])
+
+    def mails_changed(self, user):
+        # Called after the mails of user were written
+        if self.mail_index is not None:
+            self.mail_index.set_mails(user.name, [m["mail"] for m in user.get_mails()])
 
     def get_user_dn(self, uid):
         return "uid={name},{base_dn}".format(name=uid, base_dn=self.user_dn_base)
 
-    def get_user(self, uid):
-        return self.get_user_by_dn(self.get_user_dn(uid))
+    def get_user(self, uid, attrlist=None):
+        return self.get_user_by_dn(self.get_user_dn(uid), attrlist)
 
     def get_user_by_mail(self, mail):
-        conn = self.generate_connection()
-        res = conn.search_s(self.user_dn_base, ldap.SCOPE_ONELEVEL, "(|(mail={0})(email={0})(otherMailbox={0}))".format(mail))
-        if len(res) != 1:
-            raise AttributeError("No such object".format(mail))
-        dn, user = res[0]
-        return self.get_user_by_dn(dn)
+        dns = self.replica.get_dns_by_mail(mail) if self.replica is not None else None
+        if dns is not None:
+            if len(dns) != 1:
+                raise AttributeError("No such object")
+            return self.get_user_by_dn(dns[0])
+
+        if self.mail_index is not None:
+            uids = self.mail_index.get_uids(mail)
+            if uids is not None and not uids:
+                raise AttributeError("No such object")
+            if uids is not None and len(uids) == 1:
+                try:
+                    user = self.get_user(uids.pop())
+                    if mail.lower() in [m["mail"].lower() for m in user.get_mails()]:
+                        return user
+                except AttributeError:
+                    pass
+            # The index is outdated or lists several users, which may have changed since. Ask the directory
+
+        filterstr = ldap.filter.filter_format("(|(mail=%s)(email=%s)(otherMailbox=%s))", [mail, mail, mail])
+        users = list(self.iter_users(filterstr))
+        if self.mail_index is not None:
+            for user in users:
+                self.mails_changed(user)
+            if not users:
+                self.mail_index.set_missing(mail)
+        if len(users) != 1:
+            raise AttributeError("No such object")
+        return users[0]
+
+    def get_user_by_dn(self, dn, attrlist=None):
+        return self._get_entry(User, dn, attrlist)
+
+    def get_users_by_dn(self, dns, attrlist=None):
+        """
+        Resolve many users with a few chunked OR-searches instead of one search per user, all sent at once. Pass
+        attrlist to fetch only some attributes, the others are loaded on access. Unknown dns and dns not below
+        user_dn_base (like nested groups) are skipped, the order of dns is kept.
+        """
+        with self.fanout() as batch:
+            users = batch.get_users_by_dn(dns, attrlist)
+        return users.get()
+
+    def membership_filter(self, dn):
+        return ldap.filter.filter_format("(uniqueMember=%s)", [dn])
+
+    def get_known_group_dns(self, dn):
+        # Groups dn is a direct member of, if they are known without a search. None otherwise
+        if self.graph is not None:
+            return sorted(self.graph.get_parents(dn))
+        group_dns = self.replica.get_group_dns(dn) if self.replica is not None else None
+        if group_dns is not None:
+            return group_dns
+        identity_map = self.get_identity_map()
+        if identity_map is not None and identity_map.get_memberships(dn) is not None:
+            return identity_map.get_memberships(dn)
+        group_dns = self.cache.get("membership", dn) if self.cache is not None else None
+        if group_dns is not None and identity_map is not None:
+            identity_map.set_memberships(dn, group_dns)
+        return group_dns
+
+    def set_group_dns(self, dn, group_dns, res=()):
+        # res may be the (dn, attrs) of the groups including their cn
+        for group_dn, attrs in res:
+            self.group_names[normalize_dn(group_dn)] = attrs["cn"][0]
+        if self.cache is not None:
+            self.cache.set("membership", dn, group_dns)
+        identity_map = self.get_identity_map()
+        if identity_map is not None:
+            identity_map.set_memberships(dn, group_dns)
+
+    def get_group_dns(self, dn):
+        # Normalized dns of the groups dn is a direct member of, without loading the entry of dn
+        group_dns = self.get_known_group_dns(dn)
+        if group_dns is None:
+            res = list(self.search(self.group_dn_base, self.membership_filter(dn), ["cn"]))
+            group_dns = [normalize_dn(group_dn) for group_dn, attrs in res]
+            self.set_group_dns(dn, group_dns, res)
+        return group_dns
+
+    def get_matching_dns(self, dn, get_group_dns=None):
+        # Normalized dns specifying dn: dn itself, EVERYBODY and all its groups. get_group_dns() returns the groups dn
+        # is a direct member of, without a graph
+        if self.graph is not None:
+            group_dns = list(self.graph.get_groups(dn))
+        else:
+            group_dns = get_group_dns() if get_group_dns is not None else self.get_group_dns(dn)
+        return frozenset([EVERYBODY_IDENTIFIER, normalize_dn(dn)] + group_dns)
+
+    def get_group_names(self, dn):
+        # Names of the groups dn is a direct member of, without loading the groups
+        with self.fanout() as batch:
+            names = batch.get_group_names(dn)
+        return names.get()
 
-    def get_user_by_dn(self, dn):
-        return User(self, dn)
+    def check_password(self, dn, password):
+        # Raises ldap.BUSY if too many checks are running
+        return self.bind_pool.check(dn, password.encode("utf-8"))
+
+    def get_rdn_value(self, dn, base_dn, attr):
+        # Value of the attr rdn of a dn directly below base_dn, None for any other dn
+        try:
+            rdns = ldap.dn.str2dn(dn)
+            base = ldap.dn.str2dn(base_dn)
+        except ldap.DECODING_ERROR:
+            return None
+        if len(rdns) != len(base) + 1 or len(rdns[0]) != 1 or rdns[0][0][0].lower() != attr:
+            return None
+        if normalize_dn(ldap.dn.dn2str(rdns[1:])) != normalize_dn(base_dn):
+            return None
+        return rdns[0][0][1]
+
+    def get_uid(self, dn):
+        # uid of a dn directly below user_dn_base, None for any other dn
+        return self.get_rdn_value(dn, self.user_dn_base, "uid")
 
     def create_user(self, uid, password, externalMail):
-        conn = self.generate_connection()
-        conn.add_s(self.get_user_dn(uid), ldap.modlist.addModlist({
-            'objectClass': ["inetOrgPerson", "extensibleObject"],
-            'cn': uid.encode("utf-8"),
-            'otherMailbox': externalMail.encode("utf-8"),
-            'userPassword': password.encode("utf-8"),
-            'sn': "-",
-        }))
-        return self.get_user(uid)
+        with self.connection() as conn:
+            conn.add_s(self.get_user_dn(uid), ldap.modlist.addModlist({
+                'objectClass': ["inetOrgPerson", "extensibleObject"],
+                'cn': uid.encode("utf-8"),
+                'otherMailbox': externalMail.encode("utf-8"),
+                'userPassword': password.encode("utf-8"),
+                'sn': "-",
+            }))
+        self.written(self.get_user_dn(uid))
+        user = self.get_user(uid)
+        self.mails_changed(user)
+        return user
 
     def get_group_dn(self, group):
         return "cn={name},{base_dn}".format(name=group, base_dn=self.group_dn_base)
 
     def get_groups(self):
-        conn = self.generate_connection()
-        return [self.get_group(attrs["cn"][0]) for dn, attrs in conn.search_s(self.group_dn_base, ldap.SCOPE_ONELEVEL, "cn=*", ["cn"])]
+        # Fetch all groups including their attributes with a single (paged) search
+        return list(self.iter_groups())
+
+    def filter_visible(self, groups, user):
+        # Same as checking may_see for every group, but looks up the memberships of user only once
+        if user is None:
+            return [group for group in groups if group.may_see(None)]
+        matching = user.get_matching_dns()
+        return [group for group in groups if any(normalize_dn(dn) in matching for dn in group.secretary)]
 
-    def get_group(self, group):
-        return self.get_group_by_dn(self.get_group_dn(group))
+    def get_group(self, group, attrlist=None):
+        return self.get_group_by_dn(self.get_group_dn(group), attrlist)
 
-    def get_group_by_dn(self, dn):
-        return Group(self, dn)
+    def get_group_by_dn(self, dn, attrlist=None):
+        return self._get_entry(Group, dn, attrlist)
+
+    def get_groups_by_dn(self, dns, attrlist=None):
+        # Like get_users_by_dn, dns not directly below group_dn_base are skipped
+        with self.fanout() as batch:
+            groups = batch.get_groups_by_dn(dns, attrlist)
+        return groups.get()
 
     def create_group(self, display_name, description, members, managers=[], owners=[]):
         group = display_name.lower().replace("/", "-").replace(" ", "_")
 
-        conn = self.generate_connection()
-        conn.add_s(self.get_group_dn(group), ldap.modlist.addModlist({
-            'objectClass': ["groupOfUniqueNames", "extensibleObject"],
-            'cn': group.encode("utf-8"),
-            'displayName': display_name.encode("utf-8"),
-            'description': description.encode("utf-8"),
-            'owner': [owner.dn for owner in owners],
-            'manager': [manager.dn for manager in managers] if managers != [] else [member.dn for member in members],
-            'uniqueMember': [member.dn for member in members]
-        }))
-        return self.get_group(group)
+        with self.connection() as conn:
+            conn.add_s(self.get_group_dn(group), ldap.modlist.addModlist({
+                'objectClass': ["groupOfUniqueNames", "extensibleObject"],
+                'cn': group.encode("utf-8"),
+                'displayName': display_name.encode("utf-8"),
+                'description': description.encode("utf-8"),
+                'owner': [owner.dn for owner in owners],
+                'manager': [manager.dn for manager in managers] if managers != [] else [member.dn for member in members],
+                'uniqueMember': [member.dn for member in members]
+            }))
+        self.written(self.get_group_dn(group), [member.dn for member in members])
+        group = self.get_group(group)
+        self.entry_changed(group, group.members)
+        return group
+
+
+def projection(cls, attrlist):
+    # attrlist extended by the attributes every entry of cls needs
+    if attrlist is None:
+        return None
+    return list(attrlist) + [attr for attr in cls.REQUIRED_ATTRS if attr not in attrlist]
 
 
 class DirectoryResult:
     dn = ''
-
-    def __init__(self, directory, dn):
+    # Python attribute -> LDAP attributes fill_attrs computes it from
+    FIELDS = {}
+    REQUIRED_ATTRS = []
+
+    def __init__(self, directory, dn, attrs=None, attrlist=None):
+        """
+        attrs may be passed if the entry was already fetched by some other search. If only the attributes in
+        attrlist were fetched, fields depending on other attributes are loaded on first access.
+        """
         self.directory = directory
         self.dn = dn
 
-        conn = self.directory.generate_connection()
+        if attrs is None:
+            attrs = directory.get_replicated(dn)
+            if attrs is not None:
+                attrlist = None
+        if attrs is None and directory.cache is not None:
+            attrs = directory.cache.get(self.cache_kind, dn)
+            if attrs is not None:
+                attrlist = None
+        if attrs is None:
+            attrlist = projection(self.__class__, attrlist)
+            attrs = self._fetch(attrlist)
+        self._fill(attrs, attrlist)
+
+    def _fetch(self, attrlist):
         try:
-            result = conn.search_s(self.dn, ldap.SCOPE_BASE)
+            with self.directory.connection() as conn:
+                result = conn.search_s(self.dn, ldap.SCOPE_BASE, "(objectClass=*)", attrlist)
         except ldap.NO_SUCH_OBJECT:
-            raise AttributeError("No such object".format(dn))
+            raise AttributeError("No such object".format(self.dn))
         dn, attrs = result[0]
+        if attrlist is None:
+            self.directory.cache_entry(self.cache_kind, dn, attrs)
+        return attrs
+
+    def _fill(self, attrs, attrlist):
         self.attrs = attrs
+        self.attrlist = attrlist
         self.fill_attrs(attrs)
+        if attrlist is not None:
+            fetched = set(attr.lower() for attr in attrlist)
+            for field, sources in self.FIELDS.items():
+                if any(source.lower() not in fetched for source in sources):
+                    # Computed from missing attributes, let __getattr__ load it
+                    self.__dict__.pop(field, None)
+
+    def __getattr__(self, name):
+        # Only called for attributes missing in the instance and its class
+        if name in self.FIELDS and self.__dict__.get("attrlist") is not None:
+            self.load()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def load(self):
+        # Fetch all attributes of a partially loaded entry, needed before writes
+        if self.attrlist is not None:
+            self._fill(self._fetch(None), None)
 
 
 class User(DirectoryResult):
+    cache_kind = "user"
+    _matching_dns = None
+    FIELDS = {
+        "name": ["uid"],
+        "display_name": ["cn", "uid"],
+        "mail": ["mail"],
+        "primary_mail": ["mail", "email"],
+        "external_mails": ["otherMailbox", "email"],
+        "given_name": ["givenName"],
+        "surname": ["sn"],
+        "common_name": ["cn", "uid"],
+        "member_id": ["employeeNumber"],
+    }
+    REQUIRED_ATTRS = ["uid"]
+    MAIL_ATTRS = ["uid", "mail", "email", "otherMailbox"]
+
     def fill_attrs(self, attrs):
         self.name = attrs["uid"][0]
         self.display_name = attrs["cn"][0] if "cn" in attrs else attrs["uid"][0]
@@ -114,17 +544,12 @@ class User(DirectoryResult):
             self.primary_mail = attrs["mail"][0]
             self.mail = attrs["mail"][0]
         self.given_name = attrs["givenName"][0] if "givenName" in attrs else ""
-        self.surname = attrs["sn"][0] if attrs["sn"][0] != "-" else ""
-        self.common_name = attrs["cn"][0]
+        self.surname = attrs["sn"][0] if attrs.get("sn", ["-"])[0] != "-" else ""
+        self.common_name = attrs["cn"][0] if "cn" in attrs else self.display_name
         self.member_id = attrs["employeeNumber"][0] if "employeeNumber" in attrs else None
 
     def check_password(self, password):
-        conn = self.directory.generate_connection()
-        try:
-            conn.simple_bind_s(self.dn, password.encode("utf-8"))
-            return True
-        except (ldap.INVALID_CREDENTIALS, ldap.UNWILLING_TO_PERFORM):
-            return False
+        return self.directory.check_password(self.dn, password)
 
     def get_mails(self, only_verified=False):
         if only_verified:
@@ -136,45 +561,56 @@ class User(DirectoryResult):
             return self.external_mails
 
     def set_password(self, password):
-        conn = self.directory.generate_connection()
-        conn.passwd_s(self.dn, None, password.encode("utf-8"))
+        with self.directory.connection() as conn:
+            conn.passwd_s(self.dn, None, password.encode("utf-8"))
+        self.directory.credentials.forget(self.name)
 
     def set_names(self, given_name, surname, common_name):
-        conn = self.directory.generate_connection()
-        conn.modify_s(self.dn, ldap.modlist.modifyModlist({
-            "givenName": self.attrs["givenName"] if "givenName" in self.attrs else [],
-            "sn": self.attrs["sn"] if "sn" in self.attrs else [],
-            "cn": self.attrs["cn"] if "cn" in self.attrs else []
-        }, {
-            "givenName": given_name.encode("utf-8") if given_name != "" else [],
-            "sn": surname.encode("utf-8") if surname != "" else ["-"],
-            "cn": common_name.encode("utf-8")
-        }))
+        self.load()
+        with self.directory.connection() as conn:
+            conn.modify_s(self.dn, ldap.modlist.modifyModlist({
+                "givenName": self.attrs["givenName"] if "givenName" in self.attrs else [],
+                "sn": self.attrs["sn"] if "sn" in self.attrs else [],
+                "cn": self.attrs["cn"] if "cn" in self.attrs else []
+            }, {
+                "givenName": given_name.encode("utf-8") if given_name != "" else [],
+                "sn": surname.encode("utf-8") if surname != "" else ["-"],
+                "cn": common_name.encode("utf-8")
+            }))
         self.attrs["givenName"] = [given_name]
         self.given_name = given_name
         self.attrs["sn"] = [surname if surname != "" else "-"]
         self.surname = surname
         self.attrs["cn"] = [common_name]
         self.common_name = common_name
+        self.directory.entry_changed(self)
 
     def set_external_mails(self, external_mails):
-        conn = self.directory.generate_connection()
-        # Add test-item to cause a "real" change, even if there was just reordering
-        conn.modify_s(self.dn, ldap.modlist.modifyModlist({
-            "otherMailbox": [m['mail'] for m in self.external_mails if not m['verified']],
-            "emailAddress": [m['mail'] for m in self.external_mails if m['verified']]
-        }, {
-            "otherMailbox": [m['mail'] for m in external_mails if not m['verified']] + ["_TOBEREMOVED"],
-            "emailAddress": [m['mail'] for m in external_mails if m['verified']] + ["_TOBEREMOVED"]
-        }))
-        conn.modify_s(self.dn, ldap.modlist.modifyModlist({
-            "otherMailbox": [m['mail'] for m in external_mails if not m['verified']] + ["_TOBEREMOVED"],
-            "emailAddress": [m['mail'] for m in external_mails if m['verified']] + ["_TOBEREMOVED"]
-        }, {
-            "otherMailbox": [m['mail'] for m in external_mails if not m['verified']],
-            "emailAddress": [m['mail'] for m in external_mails if m['verified']]
-        }))
-        self.external_mails = external_mails
+        self.load()
+        unverified = [m['mail'] for m in external_mails if not m['verified']]
+        verified = [m['mail'] for m in external_mails if m['verified']]
+        # Replacing keeps the order of the values, the first verified mail is the primary one. Only send what changed
+        modlist = []
+        if unverified != [m['mail'] for m in self.external_mails if not m['verified']]:
+            modlist.append((ldap.MOD_REPLACE, "otherMailbox", unverified))
+        if verified != [m['mail'] for m in self.external_mails if m['verified']]:
+            modlist.append((ldap.MOD_REPLACE, "emailAddress", verified))
+        if not modlist:
+            return
+        with self.directory.connection() as conn:
+            conn.modify_s(self.dn, modlist)
+
+        attrs = dict(self.attrs)
+        for attr, values in (("otherMailbox", unverified), ("email", verified)):
+            if values:
+                attrs[attr] = values
+            else:
+                attrs.pop(attr, None)
+        self.attrs = attrs
+        self.external_mails = list(external_mails)
+        self.primary_mail = self.mail or (verified[0] if verified else None)
+        self.directory.entry_changed(self)
+        self.directory.mails_changed(self)
 
     def set_primary_mail(self, primary_mail):
         self.set_external_mails([m for m in self.external_mails if m['mail'] == primary_mail] + [m for m in self.external_mails if m['mail'] != primary_mail])
@@ -196,101 +632,332 @@ class User(DirectoryResult):
         self.set_external_mails([m for m in self.external_mails if m['mail'] != external_mail])
 
     def get_group_dns(self):
-        conn = self.directory.generate_connection()
-        return [dn.lower() for dn, attrs in conn.search_s(self.directory.group_dn_base, ldap.SCOPE_ONELEVEL, "uniqueMember={0}".format(self.dn), ["cn"])]
-
-    def get_groups(self):
-        return [self.directory.get_group_by_dn(group_dn) for group_dn in self.get_group_dns()]
+        return self.directory.get_group_dns(self.dn)
+
+    def get_groups(self, attrlist=None):
+        return self.directory.get_groups_by_dn(self.get_group_dns(), attrlist)
+
+    def get_matching_dns(self):
+        # Normalized dns specifying us, computed once per object: our own dn, EVERYBODY and all our groups
+        if self._matching_dns is None:
+            self._matching_dns = self.directory.get_matching_dns(self.dn, self.get_group_dns)
+        return self._matching_dns
+
+    def group_joined(self, group):
+        if self.directory.graph is not None:
+            # Joining a group implies joining all groups containing it, the graph knows them
+            self._matching_dns = None
+        elif self._matching_dns is not None:
+            self._matching_dns = self._matching_dns | frozenset([normalize_dn(group.dn)])
+
+    def group_left(self, group):
+        if self.directory.graph is not None:
+            self._matching_dns = None
+        elif self._matching_dns is not None:
+            self._matching_dns = self._matching_dns - frozenset([normalize_dn(group.dn)])
 
     """
     Check if we are specified by some dn. This may either be the case it is our dn or if the dn specifies a group we are part of
     """
     def match_dn(self, dn):
-        if dn.lower() == EVERYBODY_IDENTIFIER:
-            return True
-        if dn.lower() == self.dn.lower():
-            return True
-        if dn.lower() in self.get_group_dns():
-            return True
-        return False
+        return normalize_dn(dn) in self.get_matching_dns()
+
+
+class LazyUser:
+    """
+    Stands in for the user of a session and loads it from the directory on first use. Attributes contained in a
+    snapshot (see snapshot()) are answered without asking the directory at all. Groups are never part of the snapshot,
+    access checks always see the current memberships. They are looked up without loading the user.
+    """
+    SNAPSHOT_ATTRS = ("display_name", "mail", "primary_mail", "external_mails")
+
+    def __init__(self, directory, name, snapshot=None):
+        self._directory = directory
+        self._snapshot = snapshot
+        self._user = None
+        self._matching_dns = None
+        self.name = name
+        self.dn = directory.get_user_dn(name)
+
+    def __getattr__(self, attr):
+        if attr.startswith("__") or attr in ("_directory", "_snapshot", "_user", "_matching_dns"):
+            raise AttributeError(attr)
+        if self._snapshot is not None and attr in self.SNAPSHOT_ATTRS:
+            return self._snapshot[attr]
+        return getattr(self.get_user(), attr)
+
+    def __nonzero__(self):
+        return True
+
+    def __eq__(self, other):
+        return isinstance(other, (User, LazyUser)) and normalize_dn(other.dn) == normalize_dn(self.dn)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def get_user(self):
+        if self._user is None:
+            self._user = self._directory.get_user(self.name)
+            # The loaded user knows better from now on
+            self._snapshot = None
+        return self._user
+
+    def is_loaded(self):
+        return self._user is not None
+
+    def is_changed(self):
+        return self._directory.is_changed(self.dn)
+
+    def snapshot(self):
+        user = self.get_user()
+        snapshot = dict((attr, getattr(user, attr)) for attr in self.SNAPSHOT_ATTRS)
+        snapshot["name"] = user.name
+        return snapshot
+
+    def get_mails(self, only_verified=False):
+        if self._snapshot is None:
+            return self.get_user().get_mails(only_verified)
+        mails = self.external_mails + ([{"verified": True, "mail": self.mail}] if self.mail else [])
+        return [m for m in mails if m["verified"] or not only_verified]
+
+    def get_group_dns(self):
+        if self._user is not None:
+            return self._user.get_group_dns()
+        return self._directory.get_group_dns(self.dn)
+
+    def get_groups(self, attrlist=None):
+        return self._directory.get_groups_by_dn(self.get_group_dns(), attrlist)
+
+    def get_matching_dns(self):
+        if self._user is not None:
+            return self._user.get_matching_dns()
+        if self._matching_dns is None:
+            self._matching_dns = self._directory.get_matching_dns(self.dn)
+        return self._matching_dns
+
+    def match_dn(self, dn):
+        return normalize_dn(dn) in self.get_matching_dns()
+
+    def group_joined(self, group):
+        if self._user is not None:
+            self._user.group_joined(group)
+        elif self._directory.graph is not None:
+            self._matching_dns = None
+        elif self._matching_dns is not None:
+            self._matching_dns = self._matching_dns | frozenset([normalize_dn(group.dn)])
+
+    def group_left(self, group):
+        if self._user is not None:
+            self._user.group_left(group)
+        elif self._directory.graph is not None:
+            self._matching_dns = None
+        elif self._matching_dns is not None:
+            self._matching_dns = self._matching_dns - frozenset([normalize_dn(group.dn)])
 
 
 class Group(DirectoryResult):
-    dn = ''
-    name = ''
-    description = ''
-    mail = ''
-    members = []
-    owners = []
-    managers = []
-    secretary = []
+    cache_kind = "group"
+    FIELDS = {
+        "name": ["cn"],
+        "mail": ["mail"],
+        "display_name": ["displayName", "cn"],
+        "description": ["description"],
+        "_members": ["uniqueMember"],
+        "members": ["uniqueMember"],
+        "owners": ["owner"],
+        "managers": ["manager"],
+        "secretary": ["secretary"],
+    }
+    REQUIRED_ATTRS = ["cn"]
+    # Enough to list groups and check whether they are visible, without fetching the members
+    SUMMARY_ATTRS = ["cn", "displayName", "description", "mail", "secretary"]
+    # Enough for may_see, may_edit and may_join
+    ACCESS_ATTRS = ["cn", "secretary", "manager", "owner"]
 
     def fill_attrs(self, attrs):
         self.name = attrs["cn"][0]
+        self.directory.group_names[normalize_dn(self.dn)] = self.name
         self.mail = attrs["mail"][0] if "mail" in attrs else None
         self.display_name = attrs["displayName"][0] if "displayName" in attrs else attrs["cn"][0]
         self.description = attrs["description"][0] if "description" in attrs else ''
         # Keep track what's really in the list to generate valid LDIFs later
-        self._members = attrs["uniqueMember"]
+        self._members = attrs.get("uniqueMember", [])
         self.members = [member for member in self._members if member != EMPTY_LIST_IDENTIFIER]
         self.owners = attrs["owner"] if "owner" in attrs else []
         self.managers = attrs["manager"] if "manager" in attrs else []
         self.secretary = attrs["secretary"] if "secretary" in attrs else [ANONYMOUS_IDENTIFIER, EVERYBODY_IDENTIFIER]
 
     def set_owners(self, owners):
-        conn = self.directory.generate_connection()
-        conn.modify_s(self.dn, ldap.modlist.modifyModlist({
-            'owners': self.owners
-        }, {
-            'owners': owners
-        }))
+        self.load()
+        with self.directory.connection() as conn:
+            conn.modify_s(self.dn, ldap.modlist.modifyModlist({
+                'owner': self.owners
+            }, {
+                'owner': owners
+            }))
         self.owners = owners
+        self.directory.entry_changed(self)
+
+    def _has_value(self, field, attr, dn):
+        # Check locally if field is loaded already, otherwise let the server compare instead of fetching all values
+        if isinstance(dn, unicode):
+            dn = dn.encode("utf-8")
+        if field in self.__dict__:
+            return normalize_dn(dn) in [normalize_dn(value) for value in getattr(self, field)]
+        try:
+            with self.directory.connection() as conn:
+                return bool(conn.compare_s(self.dn, attr, dn))
+        except ldap.NO_SUCH_ATTRIBUTE:
+            return False
 
     def is_member(self, user):
-        return user.dn in self.members
+        return self._has_value("members", "uniqueMember", user.dn)
 
-    def get_members(self):
-        return [self.directory.get_user_by_dn(member) for member in self.members]
+    def get_members(self, attrlist=None):
+        return self.directory.get_users_by_dn(self.members, attrlist)
 
     def set_members(self, members):
+        self.load()
         if not members:
             members = [EMPTY_LIST_IDENTIFIER]
 
-        conn = self.directory.generate_connection()
-        conn.modify_s(self.dn, ldap.modlist.modifyModlist({
-            'uniqueMember': self._members
-        }, {
-            'uniqueMember': members
-        }))
-        self.members = members
+        with self.directory.connection() as conn:
+            conn.modify_s(self.dn, ldap.modlist.modifyModlist({
+                'uniqueMember': self._members
+            }, {
+                'uniqueMember': members
+            }))
+        old = set(normalize_dn(m) for m in self._members)
+        new = set(normalize_dn(m) for m in members)
+        self._members = members
+        self.members = [member for member in members if member != EMPTY_LIST_IDENTIFIER]
+        self.directory.entry_changed(self, new - old, old - new)
 
     def add_member(self, user):
-        self.set_members(self.members + [user.dn.encode("utf-8")])
+        dn = user.dn.encode("utf-8")
+        modlist = [(ldap.MOD_ADD, "uniqueMember", [dn])]
+        # Drop the placeholder unless we know it is not there, without the members loaded it usually is not
+        if "_members" not in self.__dict__ or EMPTY_LIST_IDENTIFIER in self._members:
+            modlist.append((ldap.MOD_DELETE, "uniqueMember", [EMPTY_LIST_IDENTIFIER]))
+        try:
+            with self.directory.connection() as conn:
+                try:
+                    conn.modify_s(self.dn, modlist)
+                except ldap.NO_SUCH_ATTRIBUTE:
+                    if len(modlist) == 1:
+                        raise
+                    # No placeholder
+                    conn.modify_s(self.dn, modlist[:1])
+        except ldap.TYPE_OR_VALUE_EXISTS:
+            return
+        if "_members" in self.__dict__:
+            self._members = [member for member in self._members if member != EMPTY_LIST_IDENTIFIER] + [dn]
+            self.members = self.members + [dn]
+        self.directory.entry_changed(self, added=[dn])
+        user.group_joined(self)
         # If this user was invited indivually, this is not longer needed now
-        if user.dn in self.owners:
-            self.set_owners([owner for owner in self.owners if owner.lower() != user.dn.lower()])
+        if self._has_value("owners", "owner", user.dn):
+            self.del_owner(user)
 
     def del_member(self, user):
-        self.set_members([member for member in self.members if member.lower() != user.dn.lower()])
+        dn = user.dn.encode("utf-8")
+        try:
+            with self.directory.connection() as conn:
+                try:
+                    conn.modify_s(self.dn, [(ldap.MOD_DELETE, "uniqueMember", [dn])])
+                except ldap.OBJECT_CLASS_VIOLATION:
+                    # dn was the last member, but groups must not be empty
+                    conn.modify_s(self.dn, [(ldap.MOD_DELETE, "uniqueMember", [dn]), (ldap.MOD_ADD, "uniqueMember", [EMPTY_LIST_IDENTIFIER])])
+        except ldap.NO_SUCH_ATTRIBUTE:
+            return
+        if "_members" in self.__dict__:
+            self._members = [member for member in self._members if normalize_dn(member) != normalize_dn(dn)] or [EMPTY_LIST_IDENTIFIER]
+            self.members = [member for member in self.members if normalize_dn(member) != normalize_dn(dn)]
+        self.directory.entry_changed(self, removed=[dn])
+        user.group_left(self)
+
+    def update_members(self, added=(), removed=()):
+        """
+        Adds and removes many members with one modify instead of one per member. dns already in the group are not
+        added again and ones not in it not removed, invitations of added members are dropped like in add_member.
+        Returns the dns really added and removed.
+        """
+        try:
+            return self._update_members(added, removed)
+        except (ldap.TYPE_OR_VALUE_EXISTS, ldap.NO_SUCH_ATTRIBUTE):
+            # Our copy of the group was outdated, compute the changes again from the current one
+            self._fill(self._fetch(None), None)
+            return self._update_members(added, removed)
+
+    def _update_members(self, added, removed):
+        self.load()
+        current = set(normalize_dn(member) for member in self.members)
+        added_keys = set()
+        new_members = []
+        for dn in added:
+            if normalize_dn(dn) not in current and normalize_dn(dn) not in added_keys:
+                added_keys.add(normalize_dn(dn))
+                new_members.append(dn)
+        removed_keys = set(normalize_dn(dn) for dn in removed) - added_keys
+        # Use the spelling of the server, values are deleted by equality
+        old_members = [member for member in self.members if normalize_dn(member) in removed_keys]
+        if not new_members and not old_members:
+            return [], []
+
+        remaining = [member for member in self.members if normalize_dn(member) not in removed_keys] + new_members
+        modlist = []
+        if old_members:
+            modlist.append((ldap.MOD_DELETE, "uniqueMember", old_members))
+        if new_members:
+            modlist.append((ldap.MOD_ADD, "uniqueMember", new_members))
+        if remaining and EMPTY_LIST_IDENTIFIER in self._members:
+            modlist.append((ldap.MOD_DELETE, "uniqueMember", [EMPTY_LIST_IDENTIFIER]))
+        elif not remaining and EMPTY_LIST_IDENTIFIER not in self._members:
+            modlist.append((ldap.MOD_ADD, "uniqueMember", [EMPTY_LIST_IDENTIFIER]))
+        invited = [owner for owner in self.owners if normalize_dn(owner) in added_keys]
+        if invited:
+            modlist.append((ldap.MOD_DELETE, "owner", invited))
+        with self.directory.connection() as conn:
+            conn.modify_s(self.dn, modlist)
+
+        self._members = remaining or [EMPTY_LIST_IDENTIFIER]
+        self.members = remaining
+        self.owners = [owner for owner in self.owners if normalize_dn(owner) not in added_keys]
+        self.directory.entry_changed(self, new_members, old_members)
+        return new_members, old_members
+
+    def del_owner(self, user):
+        dn = user.dn.encode("utf-8")
+        try:
+            with self.directory.connection() as conn:
+                conn.modify_s(self.dn, [(ldap.MOD_DELETE, "owner", [dn])])
+        except ldap.NO_SUCH_ATTRIBUTE:
+            return
+        if "owners" in self.__dict__:
+            self.owners = [owner for owner in self.owners if normalize_dn(owner) != normalize_dn(dn)]
+        self.directory.entry_changed(self)
 
     def set_managers(self, managers):
-        conn = self.directory.generate_connection()
-        conn.modify_s(self.dn, ldap.modlist.modifyModlist({
-            'manager': self.managers
-        }, {
-            'manager': managers
-        }))
+        self.load()
+        with self.directory.connection() as conn:
+            conn.modify_s(self.dn, ldap.modlist.modifyModlist({
+                'manager': self.managers
+            }, {
+                'manager': managers
+            }))
         self.managers = managers
+        self.directory.entry_changed(self)
 
     def add_manager(self, user):
         self.set_managers(self.managers + [user.dn.encode("utf-8")])
 
     def del_manager(self, user):
-        self.set_managers([manager for manager in self.managers if manager.lower() != user.dn.lower()])
+        self.set_managers([manager for manager in self.managers if normalize_dn(manager) != normalize_dn(user.dn)])
 
     def delete(self):
-        conn = self.directory.generate_connection()
-        conn.delete_s(self.dn)
+        with self.directory.connection() as conn:
+            conn.delete_s(self.dn)
+        self.directory.entry_deleted(self, self.members)
 
     def may_see(self, user):
         if user is None:
@@ -310,7 +977,7 @@ class Group(DirectoryResult):
 
     def may_join(self, user):
         if user is None:
-            return ANONYMOUS_IDENTIFIER in self.owner
+            return ANONYMOUS_IDENTIFIER in self.owners
         for owner in self.owners:
             if user.match_dn(owner):
                 return True
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import StringIO
+
+import ldap.filter
+import ldif
+
+from auth.utils import normalize_dn
+
+# How import_members applies the read members
+MODES = ("add", "remove", "replace")
+FORMATS = ("csv", "ldif")
+
+# Attributes of the members written by export_csv and export_ldif
+EXPORT_ATTRS = ["uid", "cn", "mail", "email"]
+
+
+class InvalidMembers(Exception):
+    def __init__(self, unknown, ambiguous):
+        Exception.__init__(self, "Unknown: {0}, ambiguous: {1}".format(", ".join(unknown) or "-", ", ".join(ambiguous) or "-"))
+        self.unknown = unknown
+        self.ambiguous = ambiguous
+
+
+def guess_format(filename):
+    return "ldif" if filename.lower().endswith(".ldif") else "csv"
+
+
+def read_identifiers(f, format="csv"):
+    """
+    Usernames, mails or dns listed in f. For CSV the first column of every row is used, a header row as written by
+    export_csv is skipped. For LDIF the uid of every entry is used, its mail or dn if it has none. Raises ValueError
+    for malformed files.
+    """
+    identifiers = []
+    if format == "ldif":
+        reader = ldif.LDIFRecordList(f)
+        reader.parse()
+        for dn, attrs in reader.all_records:
+            attrs = dict((attr.lower(), values) for attr, values in attrs.items())
+            identifiers.append((attrs.get("uid") or attrs.get("mail") or attrs.get("email") or [dn])[0])
+        return identifiers
+
+    try:
+        for i, row in enumerate(csv.reader(f)):
+            value = row[0].strip() if row else ""
+            if i == 0:
+                # Byte order mark of files saved by spreadsheet programs
+                value = value.lstrip("\xef\xbb\xbf")
+                if value.lower() in ("uid", "username", "mail"):
+                    continue
+            if value and not value.startswith("#"):
+                identifiers.append(value)
+    except csv.Error as e:
+        raise ValueError(str(e))
+    return identifiers
+
+
+def resolve(directory, identifiers):
+    """
+    dns of the users given by identifiers, in their order and without duplicates. Identifiers containing "@" are
+    mails, ones containing "=" dns, all others usernames. They are looked up with a few OR-searches of up to
+    batch_size values, sent at once. Raises InvalidMembers listing the identifiers matching no user and the mails
+    matching several.
+    """
+    # lowercased uid -> dn, None until found
+    uids = {}
+    mails = set()
+    for identifier in identifiers:
+        if "@" in identifier:
+            mails.add(identifier.lower())
+        elif "=" in identifier:
+            uid = directory.get_uid(identifier)
+            if uid is not None:
+                uids[uid.lower()] = None
+        else:
+            uids[identifier.lower()] = None
+
+    # lowercased mail -> normalized dn -> dn
+    found_mails = dict((mail, {}) for mail in mails)
+    requests = []
+    with directory.fanout() as batch:
+        pending = sorted(uids)
+        for i in range(0, len(pending), directory.batch_size):
+            filterstr = "(|{0})".format("".join(ldap.filter.filter_format("(uid=%s)", [uid]) for uid in pending[i:i + directory.batch_size]))
+            requests.append(batch.search(directory.user_dn_base, filterstr, ["uid"]))
+        pending = sorted(mails)
+        for i in range(0, len(pending), directory.batch_size):
+            filterstr = "(|{0})".format("".join(ldap.filter.filter_format("(mail=%s)(email=%s)(otherMailbox=%s)", [mail] * 3)
+                                                for mail in pending[i:i + directory.batch_size]))
+            requests.append(batch.search(directory.user_dn_base, filterstr, ["uid", "mail", "email", "otherMailbox"]))
+    for request in requests:
+        for dn, attrs in request.get():
+            for uid in attrs.get("uid", []):
+                if uid.lower() in uids:
+                    uids[uid.lower()] = dn
+            for attr in ("mail", "email", "otherMailbox"):
+                for mail in attrs.get(attr, []):
+                    if mail.lower() in found_mails:
+                        found_mails[mail.lower()][normalize_dn(dn)] = dn
+
+    dns = []
+    seen = set()
+    unknown = []
+    ambiguous = []
+    for identifier in identifiers:
+        if "@" in identifier:
+            matches = found_mails[identifier.lower()].values()
+            if len(matches) > 1:
+                ambiguous.append(identifier)
+                continue
+            dn = matches[0] if matches else None
+        elif "=" in identifier:
+            uid = directory.get_uid(identifier)
+            dn = uids[uid.lower()] if uid is not None else None
+        else:
+            dn = uids[identifier.lower()]
+        if dn is None:
+            if identifier not in unknown:
+                unknown.append(identifier)
+        elif normalize_dn(dn) not in seen:
+            seen.add(normalize_dn(dn))
+            dns.append(dn)
+    if unknown or ambiguous:
+        raise InvalidMembers(unknown, ambiguous)
+    return dns
+
+
+def import_members(group, dns, mode="add", dry_run=False):
+    """
+    Applies the user dns to the members of group: "add" adds them, "remove" removes them and "replace" makes them
+    the only users in the group, other members like nested groups are kept. All changes are written with a single
+    modify. Returns the dns added and removed, with dry_run the ones that would be.
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown mode {0}".format(mode))
+    directory = group.directory
+    group.load()
+    current = set(normalize_dn(member) for member in group.members)
+    keys = set(normalize_dn(dn) for dn in dns)
+    added = [dn for dn in dns if normalize_dn(dn) not in current] if mode != "remove" else []
+    if mode == "add":
+        removed = []
+    elif mode == "remove":
+        removed = [member for member in group.members if normalize_dn(member) in keys]
+    else:
+        removed = [member for member in group.members if normalize_dn(member) not in keys and directory.get_uid(member) is not None]
+    if dry_run or not (added or removed):
+        return added, removed
+    return group.update_members(added, removed)
+
+
+def iter_members(group, attrlist=EXPORT_ATTRS):
+    """
+    (dn, attrs) of the users in group sorted case-insensitively by uid, fetched with paged OR-searches of batch_size
+    users. Only the current batch is held in memory and no User objects are created. Members which are no users are
+    skipped. The batches are cut from the sorted uids and each batch is sorted by the same key, which makes the whole
+    output sorted.
+    """
+    directory = group.directory
+    uids = sorted(set(uid.lower() for uid in (directory.get_uid(dn) for dn in group.members) if uid is not None))
+    for i in range(0, len(uids), directory.batch_size):
+        filterstr = "(|{0})".format("".join(ldap.filter.filter_format("(uid=%s)", [uid]) for uid in uids[i:i + directory.batch_size]))
+        # The uid of the rdn is the one that was searched
+        entries = sorted(directory.search(directory.user_dn_base, filterstr, list(attrlist)), key=lambda entry: directory.get_uid(entry[0]).lower())
+        for dn, attrs in entries:
+            yield dn, attrs
+
+
+def export_csv(members):
+    """
+    Generator over the lines of a CSV file with uid, cn and mail of members as returned by iter_members
+    """
+    out = StringIO.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["uid", "cn", "mail"])
+    yield out.getvalue()
+    for dn, attrs in members:
+        out.seek(0)
+        out.truncate()
+        writer.writerow([attrs["uid"][0], attrs.get("cn", [""])[0], (attrs.get("mail") or attrs.get("email") or [""])[0]])
+        yield out.getvalue()
+
+
+def export_ldif(members):
+    # Generator over the entries of members as LDIF records
+    out = StringIO.StringIO()
+    writer = ldif.LDIFWriter(out)
+    for dn, attrs in members:
+        out.seek(0)
+        out.truncate()
+        writer.unparse(dn, attrs)
+        yield out.getvalue()
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from auth.utils import normalize_dn
+
+
+class IdentityMap:
+    """
+    Request-scoped registry of directory entries and membership searches, so every dn is fetched at most once per
+    request and every part of the request sees the same User and Group objects.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.memberships = {}
+        # dns written or with changed memberships during this request
+        self.changed = set()
+
+    def get(self, cls, dn):
+        return self.entries.get((cls, normalize_dn(dn)))
+
+    def add(self, entry):
+        self.entries[(entry.__class__, normalize_dn(entry.dn))] = entry
+        return entry
+
+    def discard(self, entry):
+        self.entries.pop((entry.__class__, normalize_dn(entry.dn)), None)
+
+    def get_memberships(self, dn):
+        return self.memberships.get(normalize_dn(dn))
+
+    def set_memberships(self, dn, group_dns):
+        self.memberships[normalize_dn(dn)] = group_dns
+
+    def forget_memberships(self, dns):
+        for dn in dns:
+            self.memberships.pop(normalize_dn(dn), None)
+
+    def mark_changed(self, dns):
+        self.changed.update(normalize_dn(dn) for dn in dns)
+
+    def is_changed(self, dn):
+        return normalize_dn(dn) in self.changed
+
+
+class DirectoryCache:
+    """
+    Second-level cache for attribute dicts of users and groups and for membership lists, shared by all requests and
+    (depending on the backend) by all worker processes. Every write through auth invalidates the affected keys, an
+    auth.coherence.Coherence can pick up changes made elsewhere.
+    """
+    DEFAULT_TTLS = {"user": 300, "group": 300, "membership": 60}
+
+    def __init__(self, backend, ttls=None):
+        self.backend = backend
+        # kind -> seconds, None to keep entries until they are invalidated
+        self.ttls = dict(self.DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        # kind -> generation. Changing the generation of a kind drops all its entries at once
+        self.generations = {}
+
+    def key(self, kind, dn):
+        # Hash the dn to get keys every backend accepts
+        key = hashlib.sha1(normalize_dn(dn).encode("utf-8")).hexdigest()
+        generation = self.generations.get(kind)
+        if generation is not None:
+            return "auth:{0}:{1}:{2}".format(kind, hashlib.sha1(generation).hexdigest()[:8], key)
+        return "auth:{0}:{1}".format(kind, key)
+
+    def get(self, kind, dn):
+        return self.backend.get(self.key(kind, dn))
+
+    def set(self, kind, dn, value):
+        self.backend.set(self.key(kind, dn), value, self.ttls[kind])
+
+    def delete(self, kind, dn):
+        self.backend.delete(self.key(kind, dn))
+
+    def clear(self):
+        self.backend.clear()
+
+
+class LocMemBackend:
+    """
+    Size-bounded LRU cache in the memory of the current process
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                return None
+            self._data[key] = (expires, value)
+        # Values are pickled, so callers can never modify what is cached
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + timeout if timeout is not None else None, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FileBackend:
+    """
+    One pickle file per key in a directory shared by all worker processes on a host. The least recently used files
+    are removed once there are more than max_entries.
+    """
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._writes = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _filename(self, key):
+        return os.path.join(self.path, key.replace(":", "_") + ".cache")
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, "rb") as f:
+                expires, value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return None
+        try:
+            # Mark as recently used
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value, timeout):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((time.time() + timeout if timeout is not None else None, value), f, pickle.HIGHEST_PROTOCOL)
+        # rename is atomic, readers never see partially written files
+        os.rename(tmp, self._filename(key))
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._cull()
+
+    def delete(self, key):
+        try:
+            os.remove(self._filename(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            if name.endswith(".cache"):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+    def _cull(self):
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith(".cache"):
+                try:
+                    files.append((os.path.getmtime(os.path.join(self.path, name)), name))
+                except OSError:
+                    pass
+        files.sort()
+        for mtime, name in files[:max(0, len(files) - self.max_entries)]:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+
+class DjangoCacheBackend:
+    """
+    Stores entries in one of the caches configured in the CACHES setting, e.g. a memcached shared by all hosts
+    """
+    def __init__(self, alias="default"):
+        self.alias = alias
+        self._cache = None
+
+    def get_cache(self):
+        # Resolve lazily, settings are not completely loaded yet when the Directory is created
+        if self._cache is None:
+            from django.core.cache import get_cache
+            self._cache = get_cache(self.alias)
+        return self._cache
+
+    def get(self, key):
+        return self.get_cache().get(key)
+
+    def set(self, key, value, timeout):
+        self.get_cache().set(key, value, timeout)
+
+    def delete(self, key):
+        self.get_cache().delete(key)
+
+    def clear(self):
+        self.get_cache().clear()
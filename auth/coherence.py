@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import ldap
+import ldap.filter
+
+# Key of the state shared by all processes using the same cache backend
+STATE_KEY = "auth:coherence"
+
+
+class Coherence:
+    """
+    Drops changes made elsewhere from a DirectoryCache within check_interval seconds instead of its ttls. Every
+    check_interval seconds one base search reads the contextCSN of context_dn. Once it moved, the users and groups with
+    an entryCSN after the last seen contextCSN are dropped from the cache, and all cached memberships if some group
+    changed. Deleted or renamed entries cannot be found that way: if nothing changed below the bases although the
+    contextCSN moved the whole cache is dropped, but a delete together with other changes is only noticed once the
+    ttl of the entry ran out. Keep the ttls finite. The last seen contextCSN is kept in the cache backend, so processes
+    sharing it do the work only once. The membership graphs of the other processes are not touched by that work, a
+    generation of the graph kept next to the contextCSN tells them to reload theirs.
+    """
+    def __init__(self, directory, context_dn, check_interval=5):
+        self.directory = directory
+        self.context_dn = context_dn
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._checked = None
+        # Graph generation of the shared state the graph of this process reflects
+        self._graph_generation = None
+
+    def read_csn(self):
+        # Values of contextCSN, one per server of a multi-master setup. None if the server does not maintain it
+        with self.directory.connection() as conn:
+            try:
+                result = conn.search_s(self.context_dn, ldap.SCOPE_BASE, "(objectClass=*)", ["contextCSN"])
+            except ldap.NO_SUCH_OBJECT:
+                return None
+        values = [value for attr, values in result[0][1].items() if attr.lower() == "contextcsn" for value in values]
+        return sorted(values) or None
+
+    def check(self):
+        if self._checked is not None and time.time() - self._checked < self.check_interval:
+            return
+        with self._lock:
+            if self._checked is not None and time.time() - self._checked < self.check_interval:
+                return
+            self._checked = time.time()
+            cache = self.directory.cache
+            try:
+                csn = self.read_csn()
+            except ldap.LDAPError:
+                # Reads will fail as well, no need to fail here
+                return
+            if csn is None:
+                # Nothing to compare with, the ttls of the cache apply
+                return
+            state = cache.backend.get(STATE_KEY) or {"csn": None, "generations": {}}
+            # Changes applied below are only complete for a graph that saw all earlier ones
+            synced = self._graph_generation == state.get("graph")
+            if state["csn"] != csn:
+                if state["csn"] is None:
+                    # Entries may have been cached before anybody watched the contextCSN
+                    self.flush(state, csn)
+                else:
+                    self.invalidate(state, min(state["csn"]), csn)
+                state["csn"] = csn
+                cache.backend.set(STATE_KEY, state, None)
+            cache.generations = dict(state["generations"])
+            if self.directory.graph is not None and not synced and state.get("graph") != self._graph_generation:
+                # Another process saw groups change
+                self.directory.graph.invalidate()
+            self._graph_generation = state.get("graph")
+
+    def flush(self, state, csn):
+        # Entries cached under another generation are never read again, whatever the backend
+        generation = max(csn)
+        state["generations"] = dict((kind, generation) for kind in self.directory.cache.ttls)
+        state["graph"] = generation
+        if self.directory.graph is not None:
+            self.directory.graph.invalidate()
+
+    def invalidate(self, state, since, csn):
+        directory = self.directory
+        # Strictly after since, the entry written at since was already there at the last check
+        filterstr = ldap.filter.filter_format("(&(entryCSN>=%s)(!(entryCSN=%s)))", [since, since])
+        changed = False
+        for dn, attrs in directory.search(directory.user_dn_base, filterstr, ["entryCSN"]):
+            directory.cache.delete("user", dn)
+            changed = True
+        groups_changed = False
+        for dn, attrs in directory.search(directory.group_dn_base, filterstr, ["entryCSN", "uniqueMember"]):
+            directory.cache.delete("group", dn)
+            if directory.graph is not None:
+                directory.graph.set_members(dn, attrs.get("uniqueMember", []))
+            changed = groups_changed = True
+        if not changed:
+            self.flush(state, csn)
+        elif groups_changed:
+            # Members that left a group cannot be told from the current entry, drop all memberships
+            state["generations"]["membership"] = max(csn)
+            state["graph"] = max(csn)
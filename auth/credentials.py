@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+
+class RateLimited(Exception):
+    pass
+
+
+def _hash(value):
+    # Keys every cache backend accepts
+    return hashlib.sha1(value.lower().encode("utf-8")).hexdigest()
+
+
+class RateLimiter:
+    """
+    Counts events per key, a key is limited once limit events happened within the last period seconds. With a
+    backend (see auth.cache) the events are kept there under name, so all processes sharing it count together. The
+    backend is read and written without a lock, concurrent events of a key may be undercounted by a few.
+    """
+    def __init__(self, limit, period, backend=None, name="ratelimit"):
+        self.limit = limit
+        self.period = period
+        self.backend = backend
+        self.name = name
+        self._lock = threading.Lock()
+        # key -> deque of event times, the oldest first
+        self._events = {}
+
+    def _expire(self, key, now):
+        events = self._events.get(key)
+        while events and events[0] <= now - self.period:
+            events.popleft()
+        if events is not None and not events:
+            del self._events[key]
+
+    def _backend_key(self, key):
+        return "auth:{0}:{1}".format(self.name, _hash(key))
+
+    def _shared_events(self, key, now):
+        return [event for event in self.backend.get(self._backend_key(key)) or () if event > now - self.period]
+
+    def is_limited(self, key):
+        if not self.limit:
+            return False
+        if self.backend is not None:
+            return len(self._shared_events(key, time.time())) >= self.limit
+        with self._lock:
+            self._expire(key, time.time())
+            return len(self._events.get(key, ())) >= self.limit
+
+    def add(self, key):
+        now = time.time()
+        if self.backend is not None:
+            self.backend.set(self._backend_key(key), self._shared_events(key, now) + [now], self.period)
+            return
+        with self._lock:
+            self._expire(key, now)
+            self._events.setdefault(key, collections.deque()).append(now)
+            # Drop keys that went quiet, so scanning addresses cannot grow the dict without bounds
+            if len(self._events) > 10000:
+                for other in list(self._events):
+                    self._expire(other, now)
+
+    def reset(self, key):
+        if self.backend is not None:
+            self.backend.delete(self._backend_key(key))
+            return
+        with self._lock:
+            self._events.pop(key, None)
+
+
+class CredentialChecker:
+    """
+    Verifies uid and password for other services. Successful checks are remembered for ttl seconds under an HMAC of
+    uid and password, the password itself is never kept. The HMAC key is random per process and never stored, so the
+    keys cannot be attacked offline without it. Failed checks count against the uid and the client address, once
+    user_limit or ip_limit failures happened within limit_period seconds further checks raise RateLimited. Only a
+    successful bind clears the failures of a uid, remembered checks do not.
+
+    With a backend shared by all processes the failures are counted there, and forget bumps a generation of the uid
+    kept there that is part of every HMAC, so remembered checks of the uid end in all processes at once.
+    """
+    def __init__(self, directory, ttl=60, max_entries=10000, user_limit=10, ip_limit=50, limit_period=300, backend=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        self.user_limiter = RateLimiter(user_limit, limit_period, backend, "ratelimit:user")
+        self.ip_limiter = RateLimiter(ip_limit, limit_period, backend, "ratelimit:ip")
+        self._secret = os.urandom(32)
+        self._lock = threading.Lock()
+        # key -> (expires, uid, result), the oldest first
+        self._entries = collections.OrderedDict()
+        self._metrics = dict.fromkeys(["hits", "misses", "failures", "limited"], 0)
+
+    def _count(self, metric):
+        with self._lock:
+            self._metrics[metric] += 1
+
+    def _generation(self, uid):
+        if self.backend is None:
+            return ""
+        return self.backend.get("auth:credentials:" + _hash(uid)) or ""
+
+    def _key(self, uid, password):
+        message = uid.lower().encode("utf-8") + "\0" + self._generation(uid) + "\0" + password.encode("utf-8")
+        return hmac.new(self._secret, message, hashlib.sha256).digest()
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+            return entry[2]
+
+    def _store(self, key, uid, result):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, uid.lower(), result)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def check(self, uid, password, address=None):
+        """
+        Returns a dict with name, display_name and the names of the groups of the user, or None if the credentials
+        are wrong
+        """
+        if self.user_limiter.is_limited(uid.lower()) or (address and self.ip_limiter.is_limited(address)):
+            self._count("limited")
+            raise RateLimited()
+
+        key = self._key(uid, password) if self.ttl else None
+        result = self._lookup(key) if key is not None else None
+        if result is not None:
+            self._count("hits")
+        else:
+            self._count("misses")
+            result = self._verify(uid, password)
+            if result is None:
+                self._count("failures")
+                self.user_limiter.add(uid.lower())
+                if address:
+                    self.ip_limiter.add(address)
+                return None
+            self.user_limiter.reset(uid.lower())
+            if key is not None:
+                self._store(key, uid, result)
+        return dict(result, groups=list(result["groups"]))
+
+    def _verify(self, uid, password):
+        directory = self.directory
+        dn = directory.get_user_dn(uid)
+        # Bind first, so wrong passwords cost no searches
+        if not directory.check_password(dn, password):
+            return None
+        try:
+            with directory.fanout() as fanout:
+                user = fanout.get_user(uid, ["cn"])
+                group_names = fanout.get_group_names(dn)
+            return {"name": user.get().name, "display_name": user.get().display_name, "groups": group_names.get()}
+        except AttributeError:
+            return None
+
+    def forget(self, uid):
+        # Drop the remembered checks of uid, after its password or groups changed
+        uid = uid.lower()
+        with self._lock:
+            for key, (expires, entry_uid, result) in self._entries.items():
+                if entry_uid == uid:
+                    del self._entries[key]
+        if self.backend is not None and self.ttl:
+            # Entries remembered before live at most ttl seconds, the generation does not have to live longer
+            self.backend.set("auth:credentials:" + _hash(uid), os.urandom(8).encode("hex"), self.ttl)
+
+    def get_metrics(self):
+        with self._lock:
+            return dict(self._metrics, entries=len(self._entries))
@@ -4,10 +4,12 @@ from django.http import HttpResponseRedirect, HttpResponseForbidden
 from django.core.urlresolvers import reverse_lazy
 from django.conf import settings
 
+import functools
 import urllib
 
 
 def require_login(view):
+    @functools.wraps(view)
     def check_permission(req, *args, **kwargs):
         if not req.user:
             redirect_url = req.META["RAW_URI"]
@@ -17,6 +19,7 @@ def require_login(view):
 
 
 def require_dn(dn, view):
+    @functools.wraps(view)
     def check_permission(req, *args, **kwargs):
         if not req.user:
             redirect_url = req.META["RAW_URI"]
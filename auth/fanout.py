@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+import ldap
+import ldap.filter
+
+import auth
+from auth.utils import normalize_dn
+
+
+class Request:
+    """
+    Result of a lookup started by a Fanout. get() waits for all outstanding searches of the fanout if needed and
+    returns the result or raises the error of the lookup.
+    """
+    def __init__(self, fanout=None, parse=None):
+        self.fanout = fanout
+        self.parse = parse
+        self.done = False
+        self.value = None
+        self.error = None
+
+    def set(self, value):
+        self.done = True
+        self.value = value
+        return self
+
+    def fail(self, error):
+        self.done = True
+        self.error = error
+        return self
+
+    def get(self):
+        if not self.done:
+            self.fanout.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Combined(Request):
+    # Computed from the results of other requests
+    def __init__(self, requests, combine):
+        Request.__init__(self)
+        self.requests = requests
+        self.combine = combine
+
+    def get(self):
+        return self.combine([request.get() for request in self.requests])
+
+
+class Fanout:
+    """
+    Sends independent searches over one connection without waiting for the previous ones, so their round trips
+    overlap. Every lookup returns a Request right away, lookups answered by the identity map, the cache or the
+    membership graph are resolved without a search. Use as
+
+        with directory.fanout() as fanout:
+            group = fanout.get_group(name)
+            group_dns = fanout.get_group_dns(user_dn)
+        group.get(), group_dns.get()
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        # Taken from the pool with the first search, lookups answered locally need none
+        self.conn = None
+        self._context = None
+        # (msgid, request) of searches without results yet
+        self._pending = []
+
+    def _connection(self):
+        if self.conn is None:
+            self._context = self.directory.connection()
+            self.conn = self._context.__enter__()
+        return self.conn
+
+    def release(self, *exc_info):
+        # Give the connection back, exc_info as passed to __exit__
+        if self._context is not None:
+            context, self._context, self.conn = self._context, None, None
+            context.__exit__(*exc_info)
+
+    def search(self, base, filterstr, attrlist=None, scope=ldap.SCOPE_ONELEVEL, parse=None):
+        request = Request(self, parse)
+        msgid = self._connection().search_ext(base, scope, filterstr, attrlist)
+        self._pending.append((msgid, request))
+        return request
+
+    def wait(self):
+        pending, self._pending = self._pending, []
+        for msgid, request in pending:
+            try:
+                rtype, rdata, rmsgid, controls = self.conn.result3(msgid)
+                # Skip search references
+                rdata = [(dn, attrs) for dn, attrs in rdata if dn is not None]
+                request.set(request.parse(rdata) if request.parse is not None else rdata)
+            except ldap.NO_SUCH_OBJECT:
+                request.fail(AttributeError("No such object"))
+            except ldap.LDAPError as e:
+                request.fail(e)
+
+    def abandon(self):
+        pending, self._pending = self._pending, []
+        for msgid, request in pending:
+            try:
+                self.conn.abandon(msgid)
+            except ldap.LDAPError:
+                pass
+            request.fail(ldap.TIMEOUT({"desc": "Abandoned"}))
+
+    def get_entry(self, cls, dn, attrlist=None):
+        directory = self.directory
+        identity_map = directory.get_identity_map()
+        entry = identity_map.get(cls, dn) if identity_map is not None else None
+        if entry is not None:
+            return Request().set(entry)
+        try:
+            attrs = directory.get_replicated(dn)
+        except AttributeError as e:
+            return Request().fail(e)
+        if attrs is not None:
+            return Request().set(directory._hydrate(cls, dn, attrs, None))
+        attrs = directory.cache.get(cls.cache_kind, dn) if directory.cache is not None else None
+        if attrs is not None:
+            return Request().set(directory._hydrate(cls, dn, attrs, None))
+
+        attrlist = auth.projection(cls, attrlist)
+        return self.search(dn, "(objectClass=*)", attrlist, ldap.SCOPE_BASE, lambda res: directory._hydrate(cls, dn, res[0][1], attrlist))
+
+    def get_user(self, uid, attrlist=None):
+        return self.get_entry(auth.User, self.directory.get_user_dn(uid), attrlist)
+
+    def get_group(self, group, attrlist=None):
+        return self.get_entry(auth.Group, self.directory.get_group_dn(group), attrlist)
+
+    def get_group_by_dn(self, dn, attrlist=None):
+        return self.get_entry(auth.Group, dn, attrlist)
+
+    def get_group_dns(self, dn):
+        directory = self.directory
+        group_dns = directory.get_known_group_dns(dn)
+        if group_dns is not None:
+            return Request().set(group_dns)
+
+        def parse(res):
+            group_dns = [normalize_dn(group_dn) for group_dn, attrs in res]
+            directory.set_group_dns(dn, group_dns, res)
+            return group_dns
+        return self.search(directory.group_dn_base, directory.membership_filter(dn), ["cn"], parse=parse)
+
+    def get_group_names(self, dn):
+        # The cn of the groups comes with the membership search. Already known group dns are normalized, their cn in
+        # its real spelling is looked up in group_names, or taken from the groups themselves
+        directory = self.directory
+        group_dns = directory.get_known_group_dns(dn)
+        if group_dns is not None:
+            names = [directory.group_names.get(group_dn) for group_dn in group_dns]
+            if None not in names:
+                return Request().set(names)
+            groups = self.get_groups_by_dn(group_dns, ["cn"])
+            return Combined([groups], lambda results: [group.name for group in results[0]])
+
+        def parse(res):
+            directory.set_group_dns(dn, [normalize_dn(group_dn) for group_dn, attrs in res], res)
+            return [attrs["cn"][0] for group_dn, attrs in res]
+        return self.search(directory.group_dn_base, directory.membership_filter(dn), ["cn"], parse=parse)
+
+    def get_users_by_dn(self, dns, attrlist=None):
+        return self._get_entries_by_dn(auth.User, self.directory.user_dn_base, "uid", dns, attrlist)
+
+    def get_groups_by_dn(self, dns, attrlist=None):
+        return self._get_entries_by_dn(auth.Group, self.directory.group_dn_base, "cn", dns, attrlist)
+
+    def _get_entries_by_dn(self, cls, base, attr, dns, attrlist):
+        # Entries of cls with an attr rdn directly below base, the ones not known locally are searched in batches
+        directory = self.directory
+        identity_map = directory.get_identity_map()
+        found = {}
+        names = {}
+        for dn in dns:
+            entry = identity_map.get(cls, dn) if identity_map is not None else None
+            name = directory.get_rdn_value(dn, base, attr)
+            if entry is None and name is not None:
+                try:
+                    attrs = directory.get_replicated(dn)
+                except AttributeError:
+                    continue
+                if attrs is None and directory.cache is not None:
+                    attrs = directory.cache.get(cls.cache_kind, dn)
+                if attrs is not None:
+                    entry = directory._hydrate(cls, dn, attrs, None)
+            if entry is not None:
+                found[normalize_dn(dn)] = entry
+            elif name is not None:
+                names[name.lower()] = dn
+
+        attrlist = auth.projection(cls, attrlist)
+        requests = []
+        pending = sorted(names)
+        for i in range(0, len(pending), directory.batch_size):
+            filterstr = "(|{0})".format("".join(ldap.filter.filter_format("({0}=%s)".format(attr), [name]) for name in pending[i:i + directory.batch_size]))
+            requests.append(self.search(base, filterstr, attrlist,
+                                        parse=lambda res: [directory._hydrate(cls, dn, attrs, attrlist) for dn, attrs in res]))
+
+        def combine(results):
+            for entries in results:
+                for entry in entries:
+                    # Match by name, the server may return the dn in another spelling than the one we asked for
+                    if entry.name.lower() in names:
+                        found[normalize_dn(names[entry.name.lower()])] = entry
+            return [found[normalize_dn(dn)] for dn in dns if normalize_dn(dn) in found]
+        return Combined(requests, combine)
@@ -2,6 +2,8 @@ from django import forms
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
+import ldap
+
 
 class LoginForm(forms.Form):
     user = forms.CharField()
@@ -15,5 +17,7 @@ class LoginForm(forms.Form):
                 raise AttributeError("wrong password")
         except AttributeError:
             raise forms.ValidationError(_("Wrong Username or Password"))
+        except ldap.BUSY:
+            raise forms.ValidationError(_("Too many logins at the moment, please try again in a minute"))
         cleaned_data['ldap_user'] = ldap_user
         return cleaned_data
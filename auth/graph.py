@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from auth.utils import normalize_dn
+
+
+class MembershipGraph:
+    """
+    In-process index of group memberships, to resolve nested groups. load() returns (group_dn, member_dns) for every
+    group and is expected to do a single bulk search. The transitive closure is precomputed, so looking up all groups
+    of some dn is a dict lookup. Writes through this process are applied incrementally, the whole graph is reloaded
+    after ttl seconds to pick up changes from elsewhere.
+    """
+    def __init__(self, load, ttl=300):
+        self.load = load
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._loaded = None
+        # group -> direct members, member -> groups it is a direct member of, member -> all groups containing it
+        self.members = {}
+        self.parents = {}
+        self.closure = {}
+
+    def rebuild(self):
+        records = self.load()
+        with self._lock:
+            self.members = {}
+            self.parents = {}
+            for group_dn, member_dns in records:
+                group = normalize_dn(group_dn)
+                self.members[group] = set(normalize_dn(dn) for dn in member_dns)
+                for member in self.members[group]:
+                    self.parents.setdefault(member, set()).add(group)
+            self.closure = {}
+            for node in self.parents:
+                self.closure[node] = self._ancestors(node)
+            self._loaded = time.time()
+
+    def _ensure_loaded(self):
+        if self._loaded is None or time.time() - self._loaded > self.ttl:
+            self.rebuild()
+
+    def _ancestors(self, node):
+        # Breadth-first over the parents, safe against cycles
+        found = set()
+        pending = list(self.parents.get(node, ()))
+        while pending:
+            group = pending.pop()
+            if group not in found:
+                found.add(group)
+                pending.extend(self.parents.get(group, ()))
+        return frozenset(found)
+
+    def _descendants(self, nodes):
+        found = set()
+        pending = list(nodes)
+        while pending:
+            node = pending.pop()
+            if node not in found:
+                found.add(node)
+                pending.extend(self.members.get(node, ()))
+        return found
+
+    def get_parents(self, dn):
+        with self._lock:
+            self._ensure_loaded()
+            return frozenset(self.parents.get(normalize_dn(dn), ()))
+
+    def get_groups(self, dn):
+        with self._lock:
+            self._ensure_loaded()
+            return self.closure.get(normalize_dn(dn), frozenset())
+
+    def invalidate(self):
+        # Reload on next use
+        with self._lock:
+            self._loaded = None
+
+    def set_members(self, group_dn, member_dns):
+        with self._lock:
+            old = self.members.get(normalize_dn(group_dn), set())
+            new = set(normalize_dn(dn) for dn in member_dns)
+            self.update_members(group_dn, new - old, old - new)
+
+    def update_members(self, group_dn, added=(), removed=()):
+        with self._lock:
+            if self._loaded is None:
+                return
+            group = normalize_dn(group_dn)
+            added = set(normalize_dn(dn) for dn in added)
+            removed = set(normalize_dn(dn) for dn in removed)
+            members = self.members.setdefault(group, set())
+            for member in removed:
+                members.discard(member)
+                self.parents.get(member, set()).discard(group)
+            for member in added:
+                members.add(member)
+                self.parents.setdefault(member, set()).add(group)
+            # Everything below the changed members may have gained or lost some ancestors
+            for node in self._descendants(added | removed):
+                self.closure[node] = self._ancestors(node)
+
+    def remove_group(self, group_dn):
+        self.set_members(group_dn, [])
+        with self._lock:
+            self.members.pop(normalize_dn(group_dn), None)
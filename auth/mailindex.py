@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import threading
+import time
+
+
+class MailIndex:
+    """
+    In-process map of lowercased mail addresses to the uids using them, so looking up the user of a mail needs no
+    search over all users. load() yields (uid, mails) for every user and is expected to do a single bulk search, it
+    is called again after ttl seconds. Writes through User keep the index current in between. Addresses the directory
+    did not know are remembered for negative_ttl seconds, in backend (see auth.cache) if given. Then a mail written by
+    any process sharing backend is no longer taken as unused by the others.
+    """
+    def __init__(self, load, ttl=3600, negative_ttl=60, backend=None):
+        self.load = load
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.backend = backend
+        self._lock = threading.RLock()
+        self._loaded = None
+        # mail -> uids, uid -> mails, mail -> time it is known to be unused until
+        self.uids = {}
+        self.mails = {}
+        self.missing = {}
+        # (uid, mails) written while a rebuild is loading, None if there is no rebuild running
+        self._updates = None
+
+    def rebuild(self):
+        # The load runs without the lock, lookups meanwhile use the old index. Only one thread rebuilds at a time
+        with self._lock:
+            if self._updates is not None:
+                return
+            self._updates = []
+        uids, mails = {}, {}
+        try:
+            for uid, user_mails in self.load():
+                self._set(uids, mails, {}, uid, user_mails)
+        except:
+            with self._lock:
+                self._updates = None
+            raise
+        with self._lock:
+            # The load may have missed writes done while it ran
+            for uid, user_mails in self._updates:
+                self._set(uids, mails, {}, uid, user_mails)
+            self.uids, self.mails, self.missing = uids, mails, {}
+            self._loaded = time.time()
+            self._updates = None
+
+    def _ensure_loaded(self):
+        if self._loaded is None or time.time() - self._loaded > self.ttl:
+            self.rebuild()
+
+    def _set(self, uids, mails_by_uid, missing, uid, mails):
+        for mail in mails_by_uid.pop(uid, ()):
+            uids[mail].discard(uid)
+            if not uids[mail]:
+                del uids[mail]
+        mails = set(mail.lower() for mail in mails)
+        for mail in mails:
+            uids.setdefault(mail, set()).add(uid)
+            missing.pop(mail, None)
+        if mails:
+            mails_by_uid[uid] = mails
+
+    def get_uids(self, mail):
+        """
+        Returns the set of uids using mail, or None if the index cannot tell whether mail is used
+        """
+        mail = mail.lower()
+        self._ensure_loaded()
+        with self._lock:
+            if mail in self.uids:
+                return set(self.uids[mail])
+            if self.backend is None and self.missing.get(mail, 0) > time.time():
+                return set()
+        if self.backend is not None and self.backend.get(self._missing_key(mail)):
+            return set()
+        return None
+
+    def _missing_key(self, mail):
+        return "auth:mailmissing:" + hashlib.sha1(mail.lower().encode("utf-8")).hexdigest()
+
+    def set_mails(self, uid, mails):
+        with self._lock:
+            self._set(self.uids, self.mails, self.missing, uid, mails)
+            if self._updates is not None:
+                self._updates.append((uid, mails))
+        if self.backend is not None:
+            for mail in mails:
+                self.backend.delete(self._missing_key(mail))
+
+    def set_missing(self, mail):
+        if self.backend is not None:
+            self.backend.set(self._missing_key(mail), True, self.negative_ttl)
+            return
+        with self._lock:
+            self.missing[mail.lower()] = time.time() + self.negative_ttl
@@ -0,0 +1,59 @@
+import sys
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from auth import bulk
+
+
+class Command(BaseCommand):
+    args = "export <group> | import <group> <file>"
+    help = "Writes the members of a group as CSV or LDIF, or changes them to the usernames or mails listed in a file"
+    option_list = BaseCommand.option_list + (
+        make_option("--format", choices=bulk.FORMATS, help="csv or ldif, guessed from the file name by default"),
+        make_option("--mode", choices=bulk.MODES, default="add",
+                    help="add the listed users, remove them or replace all users of the group by them"),
+        make_option("--output", help="File to export to instead of stdout"),
+        make_option("--dry-run", action="store_true", default=False, help="Only show what an import would change"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) < 2 or args[0] not in ("export", "import") or (args[0] == "import") != (len(args) == 3):
+            raise CommandError("Usage: groupmembers {0}".format(self.args))
+        try:
+            group = settings.DIRECTORY.get_group(args[1])
+        except AttributeError:
+            raise CommandError("No group {0}".format(args[1]))
+        if args[0] == "export":
+            self.export(group, options)
+        else:
+            self.import_(group, args[2], options)
+
+    def export(self, group, options):
+        format = options["format"] or bulk.guess_format(options["output"] or "")
+        export = bulk.export_ldif if format == "ldif" else bulk.export_csv
+        out = open(options["output"], "wb") if options["output"] else sys.stdout
+        try:
+            for chunk in export(bulk.iter_members(group)):
+                out.write(chunk)
+        finally:
+            if options["output"]:
+                out.close()
+
+    def import_(self, group, filename, options):
+        try:
+            with open(filename, "rb") as f:
+                identifiers = bulk.read_identifiers(f, options["format"] or bulk.guess_format(filename))
+        except (IOError, ValueError) as e:
+            raise CommandError("Cannot read {0}: {1}".format(filename, e))
+        try:
+            dns = bulk.resolve(settings.DIRECTORY, identifiers)
+        except bulk.InvalidMembers as e:
+            raise CommandError("Nothing changed. {0}".format(e))
+        added, removed = bulk.import_members(group, dns, options["mode"], options["dry_run"])
+        for dn in added:
+            self.stdout.write("+ {0}".format(dn))
+        for dn in removed:
+            self.stdout.write("- {0}".format(dn))
+        self.stdout.write("{0}{1} added, {2} removed".format("Dry run: " if options["dry_run"] else "", len(added), len(removed)))
@@ -0,0 +1,175 @@
+import json
+import os
+import time
+from collections import defaultdict
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.client import Client
+from django.test.simple import DjangoTestSuiteRunner
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from auth import Directory, testing
+from auth.cache import DirectoryCache, LocMemBackend
+
+SUFFIX = "dc=example,dc=org"
+USER_DN_BASE = "ou=users,dc=example,dc=org"
+GROUP_DN_BASE = "ou=groups,dc=example,dc=org"
+ADMIN_DN = "cn=admin,dc=example,dc=org"
+PASSWORD = "password"
+
+# name, method, path, POST data, whether to send the request logged in as user0
+ENDPOINTS = [
+    ("login", "post", "/login/", {"user": "user0", "password": PASSWORD}, False),
+    ("dashboard", "get", "/", None, True),
+    ("profile", "get", "/profile/", None, True),
+    ("groups", "get", "/groups/", None, True),
+    ("group_detail", "get", "/groups/group0", None, True),
+    ("group_json", "get", "/json/groups/group0", None, True),
+    ("check_user", "post", "/json/checkUser", {"user": "user0", "password": PASSWORD}, False),
+]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def summarize(durations, ops):
+    # durations in seconds, ops a list of {operation: count} per request
+    totals = defaultdict(int)
+    for counts in ops:
+        for op, count in counts.items():
+            totals[op] += count
+    result = dict((key, round(percentile(durations, p) * 1000, 3)) for key, p in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100)))
+    result["ops"] = dict((op, float(count) / len(ops)) for op, count in totals.items() if count)
+    return result
+
+
+def compare(baseline, results, tolerance=20):
+    """
+    Lines describing how results differ from baseline. Endpoints doing more LDAP operations than before, or with a
+    p50 more than tolerance percent above the baseline, are marked as regressions. Baselines saved with --ops-only
+    have no timings, only the operations are compared then.
+    """
+    lines = []
+    if baseline.get("parameters") != results.get("parameters"):
+        lines.append("Warning: baseline was recorded with {0}".format(baseline.get("parameters")))
+    for name, result in sorted(results["endpoints"].items()):
+        old = baseline["endpoints"].get(name)
+        if old is None:
+            lines.append("{0}: not in baseline".format(name))
+            continue
+        changes = []
+        regression = False
+        if "p50" in old:
+            change = (result["p50"] - old["p50"]) * 100.0 / old["p50"] if old["p50"] else 0
+            regression = change > tolerance
+            changes.append("p50 {0:.2f} -> {1:.2f} ms ({2:+.0f}%)".format(old["p50"], result["p50"], change))
+        for op in sorted(set(old["ops"]) | set(result["ops"])):
+            before, after = old["ops"].get(op, 0), result["ops"].get(op, 0)
+            if before != after:
+                changes.append("{0} {1:g} -> {2:g}".format(op, before, after))
+                regression = regression or after > before
+        lines.append("{0}{1}: {2}".format("REGRESSION " if regression else "", name, ", ".join(changes) or "unchanged"))
+    return lines
+
+
+class Command(BaseCommand):
+    help = "Runs the views against a generated in-memory directory and reports latency and LDAP operations per request"
+    option_list = BaseCommand.option_list + (
+        make_option("--users", type="int", default=1000),
+        make_option("--groups", type="int", default=50),
+        make_option("--members", type="int", default=100, help="Members per group"),
+        make_option("--requests", type="int", default=50, help="Requests per endpoint"),
+        make_option("--ldif", help="Seed the directory from this file, it is generated first if it does not exist"),
+        make_option("--nested-groups", action="store_true", default=False),
+        make_option("--mail-index", action="store_true", default=False),
+        make_option("--cache", action="store_true", default=False, help="Use a DirectoryCache with a LocMemBackend"),
+        make_option("--coherence", action="store_true", default=False, help="Drop changed entries from the cache once the contextCSN moves (implies --cache)"),
+        make_option("--save", help="Store the results as baseline in this file"),
+        make_option("--ops-only", action="store_true", default=False,
+                    help="Save only the LDAP operations, timings only compare with ones recorded on the same host"),
+        make_option("--compare", help="Compare the results with the baseline in this file. ldapbench_baseline.json next to "
+                                          "this command holds the operations of the default sizes with --cache, save "
+                                          "your own baseline before changes to compare timings too"),
+        make_option("--tolerance", type="int", default=20, help="Percent the p50 may grow before it is a regression"),
+    )
+
+    def handle(self, *args, **options):
+        options["cache"] = options["cache"] or options["coherence"]
+        parameters = dict((key, options[key]) for key in ("users", "groups", "members", "nested_groups", "mail_index", "cache", "coherence"))
+        server = testing.MemoryServer(ADMIN_DN, PASSWORD, suffix=SUFFIX)
+        server.load(self.get_records(options))
+
+        setup_test_environment()
+        runner = DjangoTestSuiteRunner(verbosity=0)
+        old_config = runner.setup_databases()
+        old_directory = settings.DIRECTORY
+        try:
+            with server.installed():
+                settings.DIRECTORY = Directory(
+                    ldap_host="ldap://benchmark", bind_user=ADMIN_DN, bind_password=PASSWORD,
+                    user_dn_base=USER_DN_BASE, group_dn_base=GROUP_DN_BASE,
+                    nested_groups=options["nested_groups"], mail_index=options["mail_index"],
+                    cache=self.get_cache(options), coherence_context=SUFFIX if options["coherence"] else None)
+                results = {"parameters": parameters, "endpoints": self.run(server, options["requests"])}
+        finally:
+            settings.DIRECTORY = old_directory
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+
+        self.stdout.write("{0:<14} {1:>9} {2:>9} {3:>9} {4:>9}  LDAP operations per request".format("endpoint", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+        for name, method, path, data, logged_in in ENDPOINTS:
+            result = results["endpoints"][name]
+            ops = " ".join("{0}={1:g}".format(op, count) for op, count in sorted(result["ops"].items()))
+            self.stdout.write("{0:<14} {1:>9.2f} {2:>9.2f} {3:>9.2f} {4:>9.2f}  {5}".format(name, result["p50"], result["p90"], result["p99"], result["max"], ops))
+
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                baseline = json.load(f)
+            for line in compare(baseline, results, options["tolerance"]):
+                self.stdout.write(line)
+        if options["save"]:
+            if options["ops_only"]:
+                for result in results["endpoints"].values():
+                    for key in ("p50", "p90", "p99", "max"):
+                        del result[key]
+            with open(options["save"], "w") as f:
+                json.dump(results, f, indent=2, separators=(",", ": "), sort_keys=True)
+
+    def get_cache(self, options):
+        if options["cache"]:
+            return DirectoryCache(LocMemBackend())
+        return None
+
+    def get_records(self, options):
+        records = testing.generate_records(USER_DN_BASE, GROUP_DN_BASE, options["users"], options["groups"], options["members"], PASSWORD)
+        if not options["ldif"]:
+            return records
+        if not os.path.exists(options["ldif"]):
+            with open(options["ldif"], "w") as f:
+                testing.write_ldif(records, f)
+        with open(options["ldif"]) as f:
+            return testing.read_ldif(f)
+
+    def run(self, server, requests):
+        anonymous = Client()
+        user = Client()
+        user.post("/login/", {"user": "user0", "password": PASSWORD})
+        results = {}
+        for name, method, path, data, logged_in in ENDPOINTS:
+            client = user if logged_in else anonymous
+            durations = []
+            ops = []
+            for i in range(requests):
+                server.reset_stats()
+                start = time.time()
+                response = getattr(client, method)(path, data or {})
+                durations.append(time.time() - start)
+                ops.append(dict(server.stats))
+                if response.status_code >= 400:
+                    self.stderr.write("{0}: status {1}".format(name, response.status_code))
+            results[name] = summarize(durations, ops)
+        return results
@@ -1,8 +1,78 @@
 # -*- coding: utf-8 -*-
 
+import time
+
 from django.conf import settings
 
+from auth import LazyUser, tracing
+
+
+class DirectoryScope:
+    """
+    Scopes the identity map of the directory to one request
+    """
+    def process_request(self, request):
+        settings.DIRECTORY.begin_request()
+
+    def process_response(self, request, response):
+        settings.DIRECTORY.end_request()
+        return response
+
+
+class TraceDirectory:
+    """
+    Collects the operations recorded by the tracer of the directory during a request. They are logged as a summary
+    to the auth.tracing logger at debug level, with AUTH_SERVER_TIMING set they are sent in a Server-Timing header.
+    """
+    def process_request(self, request):
+        if settings.DIRECTORY.tracer is not None:
+            settings.DIRECTORY.tracer.begin(request.path)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if settings.DIRECTORY.tracer is not None:
+            settings.DIRECTORY.tracer.set_view("{0}.{1}".format(view_func.__module__, getattr(view_func, "__name__", view_func)))
+
+    def process_response(self, request, response):
+        if settings.DIRECTORY.tracer is None:
+            return response
+        operations = settings.DIRECTORY.tracer.end()
+        if operations:
+            tracing.logger.debug("%s: %d operations in %.1f ms", request.path, len(operations),
+                                 sum(operation.duration for operation in operations) * 1000)
+        if getattr(settings, "AUTH_SERVER_TIMING", False):
+            response["Server-Timing"] = tracing.server_timing(operations)
+        return response
+
 
 class SetAuthentificated:
+    """
+    Sets request.user to a LazyUser, which does not touch the directory until the user is actually used. With
+    AUTH_SNAPSHOT_TTL set, name and mails of the user are kept in the session for that many seconds. Groups are not,
+    so access checks always see the current memberships.
+    """
     def process_request(self, request):
-        request.user = settings.DIRECTORY.get_user(request.session["user"]) if "user" in request.session else None
+        if "user" not in request.session:
+            request.user = None
+            return
+        snapshot = request.session.get("user_snapshot")
+        if snapshot is not None and (snapshot["name"] != request.session["user"] or snapshot["time"] + self.get_ttl() < time.time()):
+            snapshot = None
+        request.user = LazyUser(settings.DIRECTORY, request.session["user"], snapshot)
+
+    def process_response(self, request, response):
+        user = getattr(request, "user", None)
+        if not isinstance(user, LazyUser) or not self.get_ttl() or "user" not in request.session:
+            return response
+        # Writes may go through another object than request.user, catch them through the directory
+        if not user.is_loaded() and not user.is_changed():
+            return response
+        snapshot = user.snapshot()
+        old = request.session.get("user_snapshot")
+        # Avoid to save the session on every request, the old snapshot is fine as long as nothing changed
+        if old is None or old["time"] + self.get_ttl() < time.time() or dict(old, time=None) != dict(snapshot, time=None):
+            snapshot["time"] = time.time()
+            request.session["user_snapshot"] = snapshot
+        return response
+
+    def get_ttl(self):
+        return getattr(settings, "AUTH_SNAPSHOT_TTL", 0)
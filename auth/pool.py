@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from contextlib import contextmanager
+
+import ldap
+
+
+class BasePool:
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except ldap.SERVER_DOWN:
+            # Do not hand out a connection the server dropped
+            self.release(conn, discard=True)
+            raise
+        except:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+
+class ConnectionPool(BasePool):
+    """
+    Thread-safe pool of bound connections. Connections idle for longer than idle_timeout are closed, connections
+    idle for longer than check_interval are probed with a whoami before they are handed out again. Waiting longer than
+    timeout seconds (None waits forever) for a free connection raises ldap.TIMEOUT.
+    """
+    def __init__(self, factory, size=10, timeout=10, idle_timeout=300, check_interval=30):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+
+        self._cond = threading.Condition()
+        # (connection, last_used) tuples, the most recently used at the end
+        self._idle = []
+        self._open = 0
+
+    def acquire(self):
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        with self._cond:
+            while True:
+                self._evict()
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise ldap.TIMEOUT({"desc": "No free connection in pool"})
+                self._cond.wait(remaining)
+
+        try:
+            if conn is not None and time.time() - last_used > self.check_interval and not is_alive(conn):
+                close(conn)
+                conn = None
+            if conn is None:
+                conn = self.factory()
+        except:
+            self._forget()
+            raise
+        return conn
+
+    def release(self, conn, discard=False):
+        if discard:
+            close(conn)
+            self._forget()
+            return
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._cond.notify_all()
+        for conn, last_used in idle:
+            close(conn)
+
+    def _evict(self):
+        # Called with self._cond held
+        if self.idle_timeout is None:
+            return
+        limit = time.time() - self.idle_timeout
+        while self._idle and self._idle[0][1] < limit:
+            conn, last_used = self._idle.pop(0)
+            self._open -= 1
+            close(conn)
+
+    def _forget(self):
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+
+class PersistentConnections(BasePool):
+    """
+    One long-living connection per worker thread, for deployments running a fixed number of workers.
+    """
+    def __init__(self, factory, check_interval=30):
+        self.factory = factory
+        self.check_interval = check_interval
+        self._local = threading.local()
+
+    def acquire(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and time.time() - self._local.last_used > self.check_interval and not is_alive(conn):
+            close(conn)
+            conn = None
+        if conn is None:
+            conn = self.factory()
+        self._local.conn = None
+        return conn
+
+    def release(self, conn, discard=False):
+        if discard or getattr(self._local, "conn", None) is not None:
+            close(conn)
+            return
+        self._local.conn = conn
+        self._local.last_used = time.time()
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            close(conn)
+
+
+class BindPool:
+    """
+    Connections used only to check passwords, apart from the bound pool used for everything else. A check binds as
+    the user and resets the connection with an anonymous bind before it is reused. At most size checks run at once,
+    a check waiting longer than timeout for a connection raises ldap.BUSY. factory should set the per-operation
+    timeout on its connections, a check running into it raises ldap.BUSY as well.
+    """
+    def __init__(self, factory, size=5, timeout=5, idle_timeout=300, check_interval=30):
+        self.pool = ConnectionPool(factory, size=size, timeout=timeout, idle_timeout=idle_timeout, check_interval=check_interval)
+
+    def check(self, dn, password):
+        if not password:
+            # An empty password would be an unauthenticated bind, which servers may accept
+            return False
+        try:
+            conn = self.pool.acquire()
+        except ldap.TIMEOUT:
+            raise ldap.BUSY({"desc": "Too many concurrent password checks"})
+        try:
+            try:
+                conn.simple_bind_s(dn, password)
+                valid = True
+            except (ldap.INVALID_CREDENTIALS, ldap.UNWILLING_TO_PERFORM):
+                valid = False
+            conn.simple_bind_s("", "")
+        except ldap.TIMEOUT:
+            self.pool.release(conn, discard=True)
+            raise ldap.BUSY({"desc": "Password check timed out"})
+        except:
+            self.pool.release(conn, discard=True)
+            raise
+        self.pool.release(conn)
+        return valid
+
+    def close(self):
+        self.pool.close()
+
+
+def is_alive(conn):
+    try:
+        conn.whoami_s()
+        return True
+    except ldap.LDAPError:
+        return False
+
+
+def close(conn):
+    try:
+        conn.unbind_s()
+    except ldap.LDAPError:
+        pass
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+import ldap
+import ldap.ldapobject
+
+from auth.utils import normalize_dn, parent_dn
+
+logger = logging.getLogger(__name__)
+
+
+def _values(attrs, name):
+    # Attribute names are case-insensitive
+    name = name.lower()
+    for attr, values in attrs.items():
+        if attr.lower() == name:
+            return values
+    return []
+
+
+class ReplicaStore:
+    """
+    Copy of the replicated entries, indexed by dn, uid, mail and group membership. Entries are identified by the
+    entryUUID the server sends with them, so renamed entries replace their old dn.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        # uuid -> normalized dn, normalized dn -> (dn, attrs)
+        self.uuids = {}
+        self.entries = {}
+        # lowercased uid -> normalized dn, lowercased mail -> normalized dns, member dn -> group dns
+        self.by_uid = {}
+        self.by_mail = {}
+        self.memberships = {}
+
+    def put(self, uuid, dn, attrs):
+        # Password hashes are not needed for reads, do not keep them in memory
+        attrs = dict((attr, values) for attr, values in attrs.items() if attr.lower() != "userpassword")
+        with self._lock:
+            self._remove(uuid)
+            key = normalize_dn(dn)
+            self.uuids[uuid] = key
+            self.entries[key] = (dn, attrs)
+            for uid in _values(attrs, "uid"):
+                self.by_uid[uid.lower()] = key
+            for attr in ("mail", "email", "otherMailbox"):
+                for mail in _values(attrs, attr):
+                    self.by_mail.setdefault(mail.lower(), set()).add(key)
+            for member in _values(attrs, "uniqueMember"):
+                self.memberships.setdefault(normalize_dn(member), set()).add(key)
+
+    def remove(self, uuid):
+        with self._lock:
+            self._remove(uuid)
+
+    def _remove(self, uuid):
+        key = self.uuids.pop(uuid, None)
+        if key is None:
+            return
+        dn, attrs = self.entries.pop(key)
+        for uid in _values(attrs, "uid"):
+            if self.by_uid.get(uid.lower()) == key:
+                del self.by_uid[uid.lower()]
+        for attr in ("mail", "email", "otherMailbox"):
+            for mail in _values(attrs, attr):
+                self._discard(self.by_mail, mail.lower(), key)
+        for member in _values(attrs, "uniqueMember"):
+            self._discard(self.memberships, normalize_dn(member), key)
+
+    def _discard(self, index, key, value):
+        values = index.get(key)
+        if values is not None:
+            values.discard(value)
+            if not values:
+                del index[key]
+
+    def get(self, dn):
+        # (dn, attrs) or None. The attribute lists are copies
+        with self._lock:
+            entry = self.entries.get(normalize_dn(dn))
+        if entry is None:
+            return None
+        return entry[0], dict((attr, list(values)) for attr, values in entry[1].items())
+
+    def get_by_uid(self, uid):
+        with self._lock:
+            key = self.by_uid.get(uid.lower())
+        return self.get(key) if key is not None else None
+
+    def get_dns_by_mail(self, mail):
+        with self._lock:
+            return [self.entries[key][0] for key in sorted(self.by_mail.get(mail.lower(), ()))]
+
+    def get_group_dns(self, dn):
+        with self._lock:
+            return sorted(self.memberships.get(normalize_dn(dn), ()))
+
+    def get_entries(self, base):
+        # Entries directly below base
+        base = normalize_dn(base)
+        with self._lock:
+            keys = sorted(key for key in self.entries if parent_dn(key) == base)
+        return [entry for entry in (self.get(key) for key in keys) if entry is not None]
+
+
+class SyncHandler:
+    """
+    The callbacks of ldap.syncrepl.SyncreplConsumer for the entries below one base, writing to a ReplicaStore. The
+    replica is ready once the refresh phase is done.
+    """
+    def __init__(self, store, base):
+        self.store = store
+        self.base = base
+        self.cookie = None
+        self.ready = False
+        # entryUUIDs of the entries below base, and of the entries the server reported as present during a refresh
+        self.uuids = set()
+        self.present = set()
+
+    def syncrepl_get_cookie(self):
+        return self.cookie
+
+    def syncrepl_set_cookie(self, cookie):
+        self.cookie = cookie
+
+    def syncrepl_entry(self, dn, attrs, uuid):
+        self.store.put(uuid, dn, attrs)
+        self.uuids.add(uuid)
+
+    def syncrepl_delete(self, uuids):
+        for uuid in uuids:
+            self.store.remove(uuid)
+            self.uuids.discard(uuid)
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        if uuids is None:
+            if not refreshDeletes:
+                # End of a present phase, everything not reported as present is gone
+                self.syncrepl_delete(self.uuids - self.present)
+            self.present = set()
+        elif refreshDeletes:
+            self.syncrepl_delete(uuids)
+        else:
+            self.present.update(uuids)
+
+    def syncrepl_refreshdone(self):
+        self.ready = True
+
+    def start_session(self):
+        # Called before every connect. Without a cookie the server sends everything again, including nothing about
+        # entries deleted meanwhile, so start from an empty copy
+        self.present = set()
+        self.ready = False
+        if self.cookie is None:
+            self.syncrepl_delete(list(self.uuids))
+
+    def end_session(self):
+        # A refresh that did not complete may have failed because the server rejected the cookie, do not send it again
+        if not self.ready:
+            self.cookie = None
+        self.ready = False
+
+
+class Replica:
+    """
+    Keeps a ReplicaStore of the entries directly below bases current with a refreshAndPersist content
+    synchronization (RFC 4533) per base, each running in a background thread started on first use. Reads are only
+    answered while all bases are synchronized. Entries written by this process are stale for stale_timeout seconds:
+    the server may still send older versions of them, which cannot be told apart from the written one.
+    """
+    def __init__(self, uri, bind_user, bind_password, bases, retry_delay=5, stale_timeout=10):
+        self.uri = uri
+        self.bind_user = bind_user
+        self.bind_password = bind_password
+        self.retry_delay = retry_delay
+        self.stale_timeout = stale_timeout
+        self.bases = [normalize_dn(base) for base in bases]
+        self.store = ReplicaStore()
+        self.handlers = [SyncHandler(self.store, base) for base in bases]
+        self._lock = threading.Lock()
+        self._started = False
+        # normalized dn -> (expires, normalized dns of members whose memberships are stale as well)
+        self._stale = {}
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for handler in self.handlers:
+            thread = threading.Thread(target=self._run, args=(handler,), name="replica {0}".format(handler.base))
+            thread.daemon = True
+            thread.start()
+
+    def _run(self, handler):
+        consumer_class = make_consumer_class()
+        while True:
+            handler.start_session()
+            try:
+                conn = consumer_class(self.uri, handler)
+                conn.simple_bind_s(self.bind_user, self.bind_password)
+                msgid = conn.syncrepl_search(handler.base, ldap.SCOPE_ONELEVEL, mode="refreshAndPersist")
+                while conn.syncrepl_poll(msgid=msgid, all=1):
+                    pass
+            except ldap.LDAPError as e:
+                logger.warning("Synchronization of %s failed: %s", handler.base, e)
+            handler.end_session()
+            time.sleep(self.retry_delay)
+
+    def is_ready(self):
+        self.start()
+        return all(handler.ready for handler in self.handlers)
+
+    def _in_bases(self, dn):
+        return parent_dn(normalize_dn(dn)) in self.bases
+
+    def mark_stale(self, dn, member_dns=()):
+        with self._lock:
+            self._stale[normalize_dn(dn)] = (time.time() + self.stale_timeout, set(normalize_dn(member) for member in member_dns))
+
+    def is_stale(self, dn=None):
+        # Whether dn, or any entry if dn is None, was written and not sent back yet
+        dn = normalize_dn(dn) if dn is not None else None
+        now = time.time()
+        with self._lock:
+            for key, (expires, members) in self._stale.items():
+                if expires < now:
+                    del self._stale[key]
+                elif dn is None or key == dn or dn in members:
+                    return True
+        return False
+
+    def can_answer(self, dn):
+        return self._in_bases(dn) and self.is_ready() and not self.is_stale(dn)
+
+    def get_entry(self, dn):
+        """
+        attrs of dn, or None if the replica cannot answer for dn. Raises AttributeError if dn does not exist.
+        """
+        if not self.can_answer(dn):
+            return None
+        entry = self.store.get(dn)
+        if entry is None:
+            raise AttributeError("No such object")
+        return entry[1]
+
+    def get_group_dns(self, dn):
+        # dns of the groups dn is a direct member of, None if the replica cannot answer
+        if not self.is_ready() or self.is_stale(dn):
+            return None
+        return self.store.get_group_dns(dn)
+
+    def get_entries(self, base):
+        # (dn, attrs) of all entries directly below base, None if the replica cannot answer
+        if normalize_dn(base) not in self.bases or not self.is_ready() or self.is_stale():
+            return None
+        return self.store.get_entries(base)
+
+    def get_dns_by_mail(self, mail):
+        if not self.is_ready() or self.is_stale():
+            return None
+        return self.store.get_dns_by_mail(mail)
+
+
+def make_consumer_class():
+    # ldap.syncrepl needs python-ldap 2.4.14 or later, only import it when a replica is used
+    from ldap.syncrepl import SyncreplConsumer
+
+    class Consumer(ldap.ldapobject.SimpleLDAPObject, SyncreplConsumer):
+        def __init__(self, uri, handler):
+            ldap.ldapobject.SimpleLDAPObject.__init__(self, uri)
+            self.handler = handler
+
+        def syncrepl_get_cookie(self):
+            return self.handler.syncrepl_get_cookie()
+
+        def syncrepl_set_cookie(self, cookie):
+            self.handler.syncrepl_set_cookie(cookie)
+
+        def syncrepl_entry(self, dn, attrs, uuid):
+            self.handler.syncrepl_entry(dn, attrs, uuid)
+
+        def syncrepl_delete(self, uuids):
+            self.handler.syncrepl_delete(uuids)
+
+        def syncrepl_present(self, uuids, refreshDeletes=False):
+            self.handler.syncrepl_present(uuids, refreshDeletes)
+
+        def syncrepl_refreshdone(self):
+            self.handler.syncrepl_refreshdone()
+    return Consumer
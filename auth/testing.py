@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+import random
+import re
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+import ldap
+import ldap.dn
+import ldap.ldapobject
+import ldif
+from ldap.controls import SimplePagedResultsControl
+
+# Attributes compared as dns instead of plain strings
+DN_ATTRIBUTES = set(["uniquemember", "member", "owner", "manager", "secretary"])
+
+# Attribute names the server resolves to another one
+ATTRIBUTE_ALIASES = {"emailaddress": "email", "pkcs9email": "email"}
+
+
+def _attr_key(attr):
+    attr = attr.lower()
+    return ATTRIBUTE_ALIASES.get(attr, attr)
+
+
+def _norm_dn(dn):
+    try:
+        return ldap.dn.dn2str(ldap.dn.str2dn(dn.lower()))
+    except ldap.DECODING_ERROR:
+        return dn.strip().lower()
+
+
+def _norm_value(attr, value):
+    if _attr_key(attr) in DN_ATTRIBUTES:
+        return _norm_dn(value)
+    if _attr_key(attr) == "userpassword":
+        return value
+    return value.lower()
+
+
+def _unescape(value):
+    return re.sub(r"\\([0-9a-fA-F]{2})", lambda m: chr(int(m.group(1), 16)), value)
+
+
+class Filter:
+    """
+    Search filter supporting &, |, !, presence, equality, substrings, >= and <=
+    """
+    def __init__(self, text):
+        # libldap accepts a single item without surrounding parentheses
+        self.text = text if text.startswith("(") else "(" + text + ")"
+        self.pos = 0
+        try:
+            self.tree = self._parse()
+        except (IndexError, ValueError):
+            raise ldap.FILTER_ERROR({"desc": "Bad search filter"})
+
+    def _parse(self):
+        if self.text[self.pos] != "(":
+            raise ValueError()
+        self.pos += 1
+        op = self.text[self.pos]
+        if op in "&|!":
+            self.pos += 1
+            children = []
+            while self.text[self.pos] == "(":
+                children.append(self._parse())
+            self.pos += 1
+            return (op, children)
+        end = self.text.index(")", self.pos)
+        item = self.text[self.pos:end]
+        self.pos = end + 1
+        for cmp in (">=", "<=", "="):
+            if cmp in item:
+                attr, value = item.split(cmp, 1)
+                return (cmp, attr, value)
+        raise ValueError()
+
+    def match(self, entry, node=None):
+        node = node or self.tree
+        if node[0] == "&":
+            return all(self.match(entry, child) for child in node[1])
+        if node[0] == "|":
+            return any(self.match(entry, child) for child in node[1])
+        if node[0] == "!":
+            return not self.match(entry, node[1][0])
+        cmp, attr, value = node
+        values = entry.get(_attr_key(attr))
+        if values is None:
+            return False
+        if cmp == "=" and value == "*":
+            return True
+        if cmp == "=" and "*" in value:
+            pattern = ".*".join(re.escape(_unescape(part).lower()) for part in value.split("*"))
+            return any(re.match("^" + pattern + "$", v.lower()) for v in values)
+        wanted = _norm_value(attr, _unescape(value))
+        if cmp == "=":
+            return any(_norm_value(attr, v) == wanted for v in values)
+        if cmp == ">=":
+            return any(v >= _unescape(value) for v in values)
+        return any(v <= _unescape(value) for v in values)
+
+
+class MemoryServer:
+    """
+    In-memory stand-in for a slapd, for tests and benchmarks. Connections from connect() implement the part of
+    LDAPObject used by auth, every operation is counted in stats. admin_dn may bind with admin_password without
+    having an entry. A base search on suffix returns its contextCSN. Use installed() to have ldap.initialize and
+    ReconnectLDAPObject connect to it.
+    """
+    def __init__(self, admin_dn=None, admin_password=None, sizelimit=None, suffix="dc=example,dc=org"):
+        self.admin_dn = admin_dn
+        self.admin_password = admin_password
+        self.suffix = suffix
+        self.sizelimit = sizelimit
+        self.entries = {}
+        self.stats = defaultdict(int)
+        self.lock = threading.RLock()
+        self.csn = 0
+
+    def load(self, records):
+        for dn, attrs in records:
+            self.add(dn, attrs)
+
+    def add(self, dn, attrs):
+        with self.lock:
+            if _norm_dn(dn) in self.entries:
+                raise ldap.ALREADY_EXISTS({"desc": "Already exists"})
+            self.csn += 1
+            entry = {"__dn__": dn, "__names__": {}}
+            for attr, values in attrs.items():
+                if not isinstance(values, list):
+                    values = [values]
+                entry[_attr_key(attr)] = list(values)
+                entry["__names__"][_attr_key(attr)] = attr if attr.lower() not in ATTRIBUTE_ALIASES else _attr_key(attr)
+            entry["entrycsn"] = [self._csn()]
+            self.entries[_norm_dn(dn)] = entry
+
+    def _csn(self):
+        return "20000101000000.{0:06d}Z#000000#000#000000".format(self.csn)
+
+    def get(self, dn):
+        try:
+            return self.entries[_norm_dn(dn)]
+        except KeyError:
+            raise ldap.NO_SUCH_OBJECT({"desc": "No such object", "matched": ""})
+
+    def reset_stats(self):
+        self.stats.clear()
+
+    def connect(self, uri=None, *args, **kwargs):
+        return MemoryConnection(self)
+
+    @contextmanager
+    def installed(self):
+        saved = (ldap.initialize, ldap.ldapobject.ReconnectLDAPObject)
+        ldap.initialize = ldap.ldapobject.ReconnectLDAPObject = self.connect
+        try:
+            yield self
+        finally:
+            ldap.initialize, ldap.ldapobject.ReconnectLDAPObject = saved
+
+
+class MemoryConnection:
+    def __init__(self, server):
+        self.server = server
+        self.bound_dn = None
+        self.timeout = -1
+        self.options = {}
+        self._results = {}
+        self._msgid = 0
+
+    def _count(self, op):
+        self.server.stats[op] += 1
+
+    def set_option(self, option, value):
+        self.options[option] = value
+
+    def simple_bind_s(self, who='', cred=''):
+        self._count("bind")
+        if who:
+            if not cred:
+                raise ldap.UNWILLING_TO_PERFORM({"desc": "Unauthenticated bind not allowed"})
+            entry = self.server.entries.get(_norm_dn(who))
+            if entry is None:
+                valid = self.server.admin_dn is not None and _norm_dn(who) == _norm_dn(self.server.admin_dn) and cred == self.server.admin_password
+            else:
+                valid = cred in entry.get("userpassword", [])
+            if not valid:
+                raise ldap.INVALID_CREDENTIALS({"desc": "Invalid credentials"})
+        self.bound_dn = who
+        return (ldap.RES_BIND, [])
+
+    def whoami_s(self):
+        self._count("whoami")
+        return "dn:" + self.bound_dn if self.bound_dn else ""
+
+    def unbind_s(self):
+        self._count("unbind")
+        self.bound_dn = None
+
+    def _format(self, entry, attrlist):
+        wanted = set(_attr_key(attr) for attr in attrlist or [])
+        attrs = {}
+        for key, values in entry.items():
+            if key.startswith("__"):
+                continue
+            # Operational attributes only when asked for
+            if key == "entrycsn" and key not in wanted:
+                continue
+            if wanted and "*" not in wanted and key not in wanted:
+                continue
+            attrs[entry["__names__"].get(key, key)] = list(values)
+        return (entry["__dn__"], attrs)
+
+    def _search(self, base, scope, filterstr, attrlist):
+        self._count("search")
+        search_filter = Filter(filterstr or "(objectClass=*)")
+        base = _norm_dn(base)
+        with self.server.lock:
+            if scope == ldap.SCOPE_BASE and base == _norm_dn(self.server.suffix) and base not in self.server.entries:
+                candidates = [{"__dn__": self.server.suffix, "__names__": {"contextcsn": "contextCSN"},
+                               "objectclass": ["dcObject"], "contextcsn": [self.server._csn()]}]
+            elif scope == ldap.SCOPE_BASE:
+                candidates = [self.server.get(base)]
+            else:
+                candidates = []
+                for dn, entry in sorted(self.server.entries.items()):
+                    parent = dn.split(",", 1)[1] if "," in dn else ""
+                    if scope == ldap.SCOPE_ONELEVEL and parent == base:
+                        candidates.append(entry)
+                    elif scope == ldap.SCOPE_SUBTREE and (dn == base or dn.endswith("," + base)):
+                        candidates.append(entry)
+            return [self._format(entry, attrlist) for entry in candidates if search_filter.match(entry)]
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0):
+        result = self._search(base, scope, filterstr, attrlist)
+        if self.server.sizelimit and len(result) > self.server.sizelimit:
+            raise ldap.SIZELIMIT_EXCEEDED({"desc": "Size limit exceeded"})
+        return result
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0, serverctrls=None,
+                   clientctrls=None, timeout=-1, sizelimit=0):
+        # Like libldap, errors are only reported by result3
+        try:
+            result = self._search(base, scope, filterstr, attrlist)
+        except ldap.LDAPError as e:
+            return self._queue(e)
+        controls = []
+        for control in serverctrls or []:
+            if control.controlType == SimplePagedResultsControl.controlType:
+                offset = int(control.cookie or 0)
+                cookie = str(offset + control.size) if offset + control.size < len(result) else ''
+                result = result[offset:offset + control.size]
+                controls.append(SimplePagedResultsControl(True, size=control.size, cookie=cookie))
+        if self.server.sizelimit and len(result) > self.server.sizelimit:
+            return self._queue(ldap.SIZELIMIT_EXCEEDED({"desc": "Size limit exceeded"}))
+        return self._queue((ldap.RES_SEARCH_RESULT, result, controls))
+
+    def _queue(self, result):
+        self._msgid += 1
+        self._results[self._msgid] = result
+        return self._msgid
+
+    def result3(self, msgid=-1, all=1, timeout=None):
+        if msgid == -1:
+            msgid = min(self._results)
+        result = self._results.pop(msgid)
+        if isinstance(result, Exception):
+            raise result
+        rtype, rdata, controls = result
+        return rtype, rdata, msgid, controls
+
+    def abandon(self, msgid):
+        self._results.pop(msgid, None)
+
+    def compare_s(self, dn, attr, value):
+        self._count("compare")
+        entry = self.server.get(dn)
+        return 1 if _norm_value(attr, value) in [_norm_value(attr, v) for v in entry.get(_attr_key(attr), [])] else 0
+
+    def add_s(self, dn, modlist):
+        self._count("add")
+        self.server.add(dn, dict(modlist))
+
+    def delete_s(self, dn):
+        self._count("delete")
+        with self.server.lock:
+            self.server.get(dn)
+            del self.server.entries[_norm_dn(dn)]
+            self.server.csn += 1
+
+    def modify_s(self, dn, modlist):
+        self._count("modify")
+        with self.server.lock:
+            entry = self.server.get(dn)
+            updated = dict((key, list(values)) for key, values in entry.items() if not key.startswith("__"))
+            for op, attr, values in modlist:
+                key = _attr_key(attr)
+                if values is not None and not isinstance(values, list):
+                    values = [values]
+                current = updated.get(key, [])
+                if op == ldap.MOD_ADD:
+                    for value in values:
+                        if _norm_value(attr, value) in [_norm_value(attr, v) for v in current]:
+                            raise ldap.TYPE_OR_VALUE_EXISTS({"desc": "Type or value exists"})
+                        current = current + [value]
+                elif op == ldap.MOD_DELETE:
+                    if key not in updated:
+                        raise ldap.NO_SUCH_ATTRIBUTE({"desc": "No such attribute"})
+                    if values is None:
+                        current = []
+                    else:
+                        for value in values:
+                            remaining = [v for v in current if _norm_value(attr, v) != _norm_value(attr, value)]
+                            if len(remaining) == len(current):
+                                raise ldap.NO_SUCH_ATTRIBUTE({"desc": "No such attribute"})
+                            current = remaining
+                else:
+                    current = list(values or [])
+                if current:
+                    updated[key] = current
+                    entry["__names__"].setdefault(key, attr if attr.lower() not in ATTRIBUTE_ALIASES else key)
+                else:
+                    updated.pop(key, None)
+            if "groupofuniquenames" in [value.lower() for value in updated.get("objectclass", [])] and not updated.get("uniquemember"):
+                raise ldap.OBJECT_CLASS_VIOLATION({"desc": "Object class violation"})
+            self.server.csn += 1
+            updated["entrycsn"] = [self.server._csn()]
+            for key in [key for key in entry if not key.startswith("__")]:
+                del entry[key]
+            entry.update(updated)
+
+    def passwd_s(self, user, oldpw, newpw):
+        self._count("passwd")
+        with self.server.lock:
+            entry = self.server.get(user)
+            entry["userpassword"] = [newpw]
+            self.server.csn += 1
+            entry["entrycsn"] = [self.server._csn()]
+
+
+def generate_records(user_dn_base, group_dn_base, users=100, groups=10, members=10, password="password", seed=0):
+    """
+    Generates (dn, attrs) of users user0.. and groups group0.., each group having members random users. user0 is a
+    member and manager of group0.
+    """
+    rng = random.Random(seed)
+    uids = ["user{0}".format(i) for i in range(users)]
+    for uid in uids:
+        yield "uid={0},{1}".format(uid, user_dn_base), {
+            "objectClass": ["inetOrgPerson", "extensibleObject"],
+            "uid": [uid],
+            "cn": ["User {0}".format(uid[4:])],
+            "sn": ["-"],
+            "userPassword": [password],
+            "otherMailbox": ["{0}@example.org".format(uid)],
+        }
+    for i in range(groups):
+        member_uids = rng.sample(uids, min(members, users))
+        if i == 0 and uids and uids[0] not in member_uids:
+            member_uids[0:1] = [uids[0]]
+        member_dns = ["uid={0},{1}".format(uid, user_dn_base) for uid in member_uids] or ["cn=empty"]
+        yield "cn=group{0},{1}".format(i, group_dn_base), {
+            "objectClass": ["groupOfUniqueNames", "extensibleObject"],
+            "cn": ["group{0}".format(i)],
+            "displayName": ["Group {0}".format(i)],
+            "description": ["Generated group {0}".format(i)],
+            "uniqueMember": member_dns,
+            "manager": member_dns[:1],
+        }
+
+
+def write_ldif(records, f):
+    writer = ldif.LDIFWriter(f)
+    for dn, attrs in records:
+        writer.unparse(dn, attrs)
+
+
+def read_ldif(f):
+    reader = ldif.LDIFRecordList(f)
+    reader.parse()
+    return reader.all_records
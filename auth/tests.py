@@ -5,8 +5,19 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import shutil
+import StringIO
+import tempfile
+import threading
+import time
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
 from django.test import TestCase
 
+from auth import ANONYMOUS_IDENTIFIER, EMPTY_LIST_IDENTIFIER, EVERYBODY_IDENTIFIER, Directory, Group, LazyUser, User, bulk, cache, credentials, graph, mailindex, normalize_dn, pool, replica, testing, tracing
+from auth.management.commands import ldapbench
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +25,1174 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+
+    def whoami_s(self):
+        if not self.alive:
+            raise ldap.SERVER_DOWN({"desc": "Can't contact LDAP server"})
+        return ""
+
+    def unbind_s(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(TestCase):
+    def setUp(self):
+        self.created = []
+
+        def factory():
+            self.created.append(FakeConnection())
+            return self.created[-1]
+        self.factory = factory
+
+    def test_reuses_connections(self):
+        connections = pool.ConnectionPool(self.factory, size=2)
+        with connections.connection() as conn:
+            pass
+        with connections.connection() as conn2:
+            self.assertIs(conn, conn2)
+        self.assertEqual(len(self.created), 1)
+
+    def test_size_limit(self):
+        connections = pool.ConnectionPool(self.factory, size=1, timeout=0.01)
+        conn = connections.acquire()
+        self.assertRaises(ldap.TIMEOUT, connections.acquire)
+        connections.release(conn)
+        self.assertIs(connections.acquire(), conn)
+
+    def test_discards_dead_connections(self):
+        connections = pool.ConnectionPool(self.factory, size=1, check_interval=0)
+        with connections.connection() as conn:
+            conn.alive = False
+        with connections.connection() as conn2:
+            self.assertIsNot(conn, conn2)
+        self.assertTrue(conn.closed)
+
+    def test_server_down_is_not_returned(self):
+        connections = pool.ConnectionPool(self.factory, size=1)
+        try:
+            with connections.connection() as conn:
+                raise ldap.SERVER_DOWN({"desc": "Can't contact LDAP server"})
+        except ldap.SERVER_DOWN:
+            pass
+        self.assertTrue(conn.closed)
+        with connections.connection() as conn2:
+            self.assertIsNot(conn, conn2)
+
+    def test_idle_eviction(self):
+        connections = pool.ConnectionPool(self.factory, size=1, idle_timeout=0)
+        with connections.connection() as conn:
+            pass
+        time.sleep(0.01)
+        with connections.connection() as conn2:
+            self.assertIsNot(conn, conn2)
+        self.assertTrue(conn.closed)
+
+    def test_persistent_connection_per_thread(self):
+        connections = pool.PersistentConnections(self.factory)
+        with connections.connection() as conn:
+            pass
+        with connections.connection() as conn2:
+            self.assertIs(conn, conn2)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(connections.acquire()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], conn)
+
+
+class BindConnection(FakeConnection):
+    def __init__(self, hang=False):
+        FakeConnection.__init__(self)
+        self.hang = hang
+        self.binds = []
+
+    def simple_bind_s(self, who, cred):
+        if self.hang:
+            raise ldap.TIMEOUT({"desc": "Timeout"})
+        self.binds.append(who)
+        if who and cred != "secret":
+            raise ldap.INVALID_CREDENTIALS({"desc": "Invalid credentials"})
+
+
+class BindPoolTest(TestCase):
+    def setUp(self):
+        self.created = []
+
+        def factory():
+            conn = BindConnection()
+            self.created.append(conn)
+            return conn
+        self.pool = pool.BindPool(factory, size=1, timeout=0)
+
+    def test_rebinds_and_resets(self):
+        self.assertTrue(self.pool.check("uid=alice", "secret"))
+        self.assertFalse(self.pool.check("uid=bob", "wrong"))
+        self.assertFalse(self.pool.check("uid=bob", ""))
+        self.assertEqual(len(self.created), 1)
+        self.assertEqual(self.created[0].binds, ["uid=alice", "", "uid=bob", ""])
+
+    def test_busy(self):
+        conn = self.pool.pool.acquire()
+        self.assertRaises(ldap.BUSY, self.pool.check, "uid=alice", "secret")
+        self.pool.pool.release(conn)
+        self.assertTrue(self.pool.check("uid=alice", "secret"))
+
+    def test_timeout_discards_connection(self):
+        self.pool = pool.BindPool(lambda: BindConnection(hang=True), size=1, timeout=0)
+        self.assertRaises(ldap.BUSY, self.pool.check, "uid=alice", "secret")
+        self.assertEqual(self.pool.pool._open, 0)
+
+
+class CountingEntry:
+    created = 0
+
+    def __init__(self, directory, dn, attrs=None, attrlist=None):
+        CountingEntry.created += 1
+        self.dn = dn
+
+
+class IdentityMapTest(TestCase):
+    def setUp(self):
+        self.directory = Directory(user_dn_base="ou=users,dc=example,dc=org", group_dn_base="ou=groups,dc=example,dc=org")
+        CountingEntry.created = 0
+
+    def test_entries_are_shared_within_request(self):
+        self.directory.begin_request()
+        entry = self.directory._get_entry(CountingEntry, "uid=alice,ou=users,dc=example,dc=org")
+        self.assertIs(self.directory._get_entry(CountingEntry, "UID=Alice,ou=users,dc=example,dc=org"), entry)
+        self.assertEqual(CountingEntry.created, 1)
+        self.directory.end_request()
+        self.assertIsNot(self.directory._get_entry(CountingEntry, "uid=alice,ou=users,dc=example,dc=org"), entry)
+
+    def test_write_through(self):
+        self.directory.begin_request()
+        identity_map = self.directory.get_identity_map()
+        identity_map.set_memberships("uid=alice,ou=users,dc=example,dc=org", ["cn=g1,ou=groups,dc=example,dc=org"])
+        identity_map.set_memberships("uid=bob,ou=users,dc=example,dc=org", [])
+
+        written = CountingEntry(self.directory, "cn=g1,ou=groups,dc=example,dc=org")
+        self.directory.entry_changed(written, ["uid=Alice,ou=users,dc=example,dc=org"])
+        self.assertIs(self.directory._get_entry(CountingEntry, written.dn), written)
+        self.assertIsNone(identity_map.get_memberships("uid=alice,ou=users,dc=example,dc=org"))
+        self.assertEqual(identity_map.get_memberships("uid=bob,ou=users,dc=example,dc=org"), [])
+
+        self.directory.entry_deleted(written)
+        self.assertIsNot(self.directory._get_entry(CountingEntry, written.dn), written)
+        self.directory.end_request()
+
+
+class GetUidTest(TestCase):
+    def test_get_uid(self):
+        directory = Directory(user_dn_base="ou=users,dc=example,dc=org")
+        self.assertEqual(directory.get_uid("uid=alice,ou=users,dc=example,dc=org"), "alice")
+        self.assertEqual(directory.get_uid("uid=alice,OU=Users,dc=example,dc=org"), "alice")
+        self.assertIsNone(directory.get_uid("cn=g1,ou=users,dc=example,dc=org"))
+        self.assertIsNone(directory.get_uid("uid=alice,ou=other,dc=example,dc=org"))
+        self.assertIsNone(directory.get_uid("cn=empty"))
+
+
+class FakeGroup:
+    def __init__(self, secretary):
+        self.secretary = secretary
+
+    def may_see(self, user):
+        return ANONYMOUS_IDENTIFIER in self.secretary
+
+
+class FakeUser(User):
+    def __init__(self, dn, group_dns):
+        self.directory = Directory()
+        self.dn = dn
+        self.group_dns = group_dns
+        self.lookups = 0
+
+    def get_group_dns(self):
+        self.lookups += 1
+        return self.group_dns
+
+
+class FilterVisibleTest(TestCase):
+    def test_filter_visible(self):
+        directory = Directory()
+        public = FakeGroup([ANONYMOUS_IDENTIFIER, EVERYBODY_IDENTIFIER])
+        internal = FakeGroup([EVERYBODY_IDENTIFIER])
+        secret = FakeGroup(["CN=g1,ou=groups,dc=example,dc=org"])
+        personal = FakeGroup(["uid=alice,ou=users,dc=example,dc=org"])
+        hidden = FakeGroup(["cn=g2,ou=groups,dc=example,dc=org"])
+        groups = [public, internal, secret, personal, hidden]
+
+        user = FakeUser("uid=alice,ou=users,dc=example,dc=org", ["cn=g1,ou=groups,dc=example,dc=org"])
+        self.assertEqual(directory.filter_visible(groups, user), [public, internal, secret, personal])
+        self.assertEqual(user.lookups, 1)
+        self.assertEqual(directory.filter_visible(groups, None), [public])
+
+
+class MatchDnTest(TestCase):
+    def test_normalize_dn(self):
+        self.assertEqual(normalize_dn("UID=Alice, ou=Users,dc=example,dc=org"), "uid=alice,ou=users,dc=example,dc=org")
+        self.assertEqual(normalize_dn(EMPTY_LIST_IDENTIFIER), EMPTY_LIST_IDENTIFIER)
+
+    def test_memberships_are_looked_up_once(self):
+        user = FakeUser("uid=alice,ou=users,dc=example,dc=org", ["cn=g1,ou=groups,dc=example,dc=org"])
+        self.assertTrue(user.match_dn("cn=G1, ou=groups,dc=example,dc=org"))
+        self.assertTrue(user.match_dn("uid=alice,ou=users,dc=example,dc=org"))
+        self.assertTrue(user.match_dn(EVERYBODY_IDENTIFIER))
+        self.assertFalse(user.match_dn("cn=g2,ou=groups,dc=example,dc=org"))
+        self.assertEqual(user.lookups, 1)
+
+    def test_membership_changes(self):
+        user = FakeUser("uid=alice,ou=users,dc=example,dc=org", [])
+        group = FakeGroup([])
+        group.dn = "cn=g2,ou=groups,dc=example,dc=org"
+        self.assertFalse(user.match_dn(group.dn))
+        user.group_joined(group)
+        self.assertTrue(user.match_dn(group.dn))
+        user.group_left(group)
+        self.assertFalse(user.match_dn(group.dn))
+        self.assertEqual(user.lookups, 1)
+
+
+class MembershipGraphTest(TestCase):
+    def setUp(self):
+        self.loads = 0
+        self.records = [
+            ("cn=all,ou=groups,dc=example,dc=org", ["cn=board,ou=groups,dc=example,dc=org", "uid=bob,ou=users,dc=example,dc=org"]),
+            ("cn=board,ou=groups,dc=example,dc=org", ["uid=alice,ou=users,dc=example,dc=org", "cn=all,ou=groups,dc=example,dc=org"]),
+            ("cn=other,ou=groups,dc=example,dc=org", [EMPTY_LIST_IDENTIFIER]),
+        ]
+
+        def load():
+            self.loads += 1
+            return self.records
+        self.graph = graph.MembershipGraph(load)
+
+    def test_transitive_groups(self):
+        self.assertEqual(self.graph.get_groups("uid=alice,ou=users,dc=example,dc=org"), frozenset([
+            "cn=all,ou=groups,dc=example,dc=org", "cn=board,ou=groups,dc=example,dc=org"]))
+        # all and board contain each other
+        self.assertEqual(self.graph.get_groups("uid=bob,ou=users,dc=example,dc=org"), frozenset([
+            "cn=all,ou=groups,dc=example,dc=org", "cn=board,ou=groups,dc=example,dc=org"]))
+        self.assertEqual(self.graph.get_parents("uid=alice,ou=users,dc=example,dc=org"), frozenset([
+            "cn=board,ou=groups,dc=example,dc=org"]))
+        self.assertEqual(self.graph.get_groups("uid=carol,ou=users,dc=example,dc=org"), frozenset())
+        self.assertEqual(self.loads, 1)
+
+    def test_incremental_update(self):
+        self.graph.get_groups("uid=alice,ou=users,dc=example,dc=org")
+        self.graph.set_members("cn=other,ou=groups,dc=example,dc=org", ["cn=all,ou=groups,dc=example,dc=org"])
+        self.assertIn("cn=other,ou=groups,dc=example,dc=org", self.graph.get_groups("uid=alice,ou=users,dc=example,dc=org"))
+        self.assertIn("cn=other,ou=groups,dc=example,dc=org", self.graph.get_groups("uid=bob,ou=users,dc=example,dc=org"))
+
+        self.graph.set_members("cn=all,ou=groups,dc=example,dc=org", ["uid=bob,ou=users,dc=example,dc=org"])
+        self.assertEqual(self.graph.get_groups("uid=alice,ou=users,dc=example,dc=org"), frozenset([
+            "cn=board,ou=groups,dc=example,dc=org"]))
+
+        self.graph.remove_group("cn=all,ou=groups,dc=example,dc=org")
+        self.assertEqual(self.graph.get_groups("uid=bob,ou=users,dc=example,dc=org"), frozenset())
+        self.assertEqual(self.loads, 1)
+
+    def test_update_members(self):
+        self.graph.get_groups("uid=alice,ou=users,dc=example,dc=org")
+        self.graph.update_members("cn=other,ou=groups,dc=example,dc=org", added=["uid=carol,ou=users,dc=example,dc=org"])
+        self.graph.update_members("cn=board,ou=groups,dc=example,dc=org", removed=["uid=alice,ou=users,dc=example,dc=org"])
+        self.assertEqual(self.graph.get_groups("uid=carol,ou=users,dc=example,dc=org"), frozenset(["cn=other,ou=groups,dc=example,dc=org"]))
+        self.assertEqual(self.graph.get_groups("uid=alice,ou=users,dc=example,dc=org"), frozenset())
+
+
+class DirectoryCacheTest(TestCase):
+    def check_backend(self, backend):
+        directory_cache = cache.DirectoryCache(backend, ttls={"user": 60, "membership": 0.01})
+        attrs = {"uid": ["alice"], "cn": ["Alice"]}
+        directory_cache.set("user", "uid=alice,ou=users,dc=example,dc=org", attrs)
+        directory_cache.set("membership", "uid=alice,ou=users,dc=example,dc=org", [])
+        self.assertEqual(directory_cache.get("user", "UID=Alice,ou=users,dc=example,dc=org"), attrs)
+        self.assertIsNone(directory_cache.get("group", "uid=alice,ou=users,dc=example,dc=org"))
+        time.sleep(0.02)
+        self.assertIsNone(directory_cache.get("membership", "uid=alice,ou=users,dc=example,dc=org"))
+        directory_cache.delete("user", "uid=alice,ou=users,dc=example,dc=org")
+        self.assertIsNone(directory_cache.get("user", "uid=alice,ou=users,dc=example,dc=org"))
+
+    def test_locmem_backend(self):
+        self.check_backend(cache.LocMemBackend())
+
+    def test_file_backend(self):
+        path = tempfile.mkdtemp()
+        try:
+            self.check_backend(cache.FileBackend(path))
+        finally:
+            shutil.rmtree(path)
+
+    def test_lru_eviction(self):
+        backend = cache.LocMemBackend(max_entries=2)
+        backend.set("a", 1, None)
+        backend.set("b", 2, None)
+        backend.get("a")
+        backend.set("c", 3, None)
+        self.assertEqual(backend.get("a"), 1)
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.get("c"), 3)
+
+    def test_cached_values_are_copies(self):
+        backend = cache.LocMemBackend()
+        attrs = {"cn": ["Alice"]}
+        backend.set("a", attrs, None)
+        backend.get("a")["cn"] = ["Bob"]
+        self.assertEqual(backend.get("a"), attrs)
+
+    def test_write_through_invalidation(self):
+        directory = Directory(cache=cache.DirectoryCache(cache.LocMemBackend()))
+        directory.cache_entry("user", "uid=alice,ou=users,dc=example,dc=org", {"uid": ["alice"], "userPassword": ["secret"]})
+        directory.cache.set("membership", "uid=alice,ou=users,dc=example,dc=org", [])
+        directory.cache.set("group", "cn=g1,ou=groups,dc=example,dc=org", {"cn": ["g1"]})
+        self.assertEqual(directory.cache.get("user", "uid=alice,ou=users,dc=example,dc=org"), {"uid": ["alice"]})
+
+        group = CountingEntry(directory, "cn=g1,ou=groups,dc=example,dc=org")
+        group.cache_kind = "group"
+        directory.entry_changed(group, ["uid=alice,ou=users,dc=example,dc=org"])
+        self.assertIsNone(directory.cache.get("group", "cn=g1,ou=groups,dc=example,dc=org"))
+        self.assertIsNone(directory.cache.get("membership", "uid=alice,ou=users,dc=example,dc=org"))
+        self.assertIsNotNone(directory.cache.get("user", "uid=alice,ou=users,dc=example,dc=org"))
+
+
+class PagedConnection:
+    def __init__(self, entries):
+        self.entries = entries
+        self.requests = []
+        self._results = {}
+
+    def search_ext(self, base, scope, filterstr, attrlist=None, serverctrls=None):
+        control = serverctrls[0]
+        offset = int(control.cookie or 0)
+        self.requests.append((offset, control.size))
+        cookie = str(offset + control.size) if offset + control.size < len(self.entries) else ''
+        self._results[len(self.requests)] = (ldap.RES_SEARCH_RESULT, self.entries[offset:offset + control.size],
+                                             [SimplePagedResultsControl(True, size=control.size, cookie=cookie)])
+        return len(self.requests)
+
+    def result3(self, msgid):
+        rtype, rdata, controls = self._results.pop(msgid)
+        return rtype, rdata, msgid, controls
+
+    def search_s(self, base, scope, filterstr, attrlist=None):
+        self.requests.append((0, None))
+        return self.entries
+
+
+class PagedSearchTest(TestCase):
+    def setUp(self):
+        self.conn = PagedConnection([("cn=g{0},ou=groups,dc=example,dc=org".format(i), {"cn": ["g{0}".format(i)], "uniqueMember": [EMPTY_LIST_IDENTIFIER]}) for i in range(7)])
+        self.directory = Directory(group_dn_base="ou=groups,dc=example,dc=org", page_size=3)
+        self.directory.connection = pool.ConnectionPool(lambda: self.conn, size=1).connection
+
+    def test_pages(self):
+        self.assertEqual([group.name for group in self.directory.iter_groups()], ["g{0}".format(i) for i in range(7)])
+        self.assertEqual(self.conn.requests, [(0, 3), (3, 3), (6, 3)])
+
+    def test_streams(self):
+        groups = self.directory.iter_groups(attrlist=["cn"])
+        next(groups)
+        self.assertEqual(len(self.conn.requests), 1)
+        groups.close()
+        # The connection went back to the pool
+        self.assertEqual(len(self.directory.get_groups()), 7)
+
+    def test_without_paging(self):
+        self.directory.page_size = None
+        self.assertEqual(len(self.directory.get_groups()), 7)
+        self.assertEqual(self.conn.requests, [(0, None)])
+
+    def test_lookups_while_iterating(self):
+        # The only connection is free again while the last page is iterated
+        self.directory.page_size = 10
+        for group in self.directory.iter_groups(attrlist=["cn"]):
+            self.assertEqual(len(self.directory.get_groups()), 7)
+        self.directory.page_size = None
+        for group in self.directory.iter_groups(attrlist=["cn"]):
+            self.assertEqual(len(self.directory.get_groups()), 7)
+
+
+class EntryConnection:
+    def __init__(self, entries):
+        self.entries = entries
+        self.searches = []
+
+    def search_s(self, base, scope, filterstr="(objectClass=*)", attrlist=None):
+        self.searches.append((base, attrlist))
+        attrs = self.entries[base]
+        if attrlist is not None:
+            attrs = dict((attr, values) for attr, values in attrs.items() if attr in attrlist)
+        return [(base, attrs)]
+
+
+class ProjectionTest(TestCase):
+    dn = "cn=g1,ou=groups,dc=example,dc=org"
+
+    def setUp(self):
+        self.conn = EntryConnection({self.dn: {"cn": ["g1"], "displayName": ["Group One"], "uniqueMember": ["uid=alice,ou=users,dc=example,dc=org"]}})
+        self.directory = Directory(group_dn_base="ou=groups,dc=example,dc=org")
+        self.directory.connection = pool.ConnectionPool(lambda: self.conn).connection
+
+    def test_lazy_members(self):
+        group = self.directory.get_group("g1", ["displayName"])
+        self.assertEqual(self.conn.searches, [(self.dn, ["displayName", "cn"])])
+        self.assertEqual((group.name, group.display_name), ("g1", "Group One"))
+        self.assertEqual(len(self.conn.searches), 1)
+        self.assertEqual(group.members, ["uid=alice,ou=users,dc=example,dc=org"])
+        self.assertEqual(self.conn.searches[1], (self.dn, None))
+        self.assertEqual(group.secretary, [ANONYMOUS_IDENTIFIER, EVERYBODY_IDENTIFIER])
+        self.assertEqual(len(self.conn.searches), 2)
+
+    def test_unknown_attribute(self):
+        group = self.directory.get_group("g1", ["displayName"])
+        self.assertRaises(AttributeError, getattr, group, "no_such_field")
+        self.assertEqual(len(self.conn.searches), 1)
+
+    def test_shared_within_request(self):
+        self.directory.begin_request()
+        try:
+            partial = self.directory.get_group("g1", ["displayName"])
+            self.assertIs(self.directory.get_group("g1"), partial)
+        finally:
+            self.directory.end_request()
+
+
+class MemberConnection(EntryConnection):
+    def __init__(self, entries):
+        EntryConnection.__init__(self, entries)
+        self.modifications = []
+        self.compares = []
+
+    def compare_s(self, dn, attr, value):
+        self.compares.append((attr, value))
+        return int(value in self.entries[dn].get(attr, []))
+
+    def modify_s(self, dn, modlist):
+        self.modifications.append(modlist)
+        members = list(self.entries[dn]["uniqueMember"])
+        for op, attr, values in modlist:
+            for value in values:
+                if op == ldap.MOD_ADD:
+                    if value in members:
+                        raise ldap.TYPE_OR_VALUE_EXISTS({"desc": "Type or value exists"})
+                    members.append(value)
+                else:
+                    if value not in members:
+                        raise ldap.NO_SUCH_ATTRIBUTE({"desc": "No such attribute"})
+                    members.remove(value)
+        if not members:
+            raise ldap.OBJECT_CLASS_VIOLATION({"desc": "Object class violation"})
+        self.entries[dn]["uniqueMember"] = members
+
+
+class GroupMembershipTest(TestCase):
+    dn = "cn=g1,ou=groups,dc=example,dc=org"
+    alice = "uid=alice,ou=users,dc=example,dc=org"
+    bob = "uid=bob,ou=users,dc=example,dc=org"
+
+    def setUp(self):
+        self.conn = MemberConnection({self.dn: {"cn": ["g1"], "uniqueMember": [self.alice]}})
+        self.directory = Directory(group_dn_base="ou=groups,dc=example,dc=org")
+        self.directory.connection = pool.ConnectionPool(lambda: self.conn).connection
+
+    def test_is_member_compares(self):
+        group = self.directory.get_group("g1", ["cn"])
+        self.assertTrue(group.is_member(FakeUser(self.alice, [])))
+        self.assertFalse(group.is_member(FakeUser(self.bob, [])))
+        self.assertEqual(len(self.conn.compares), 2)
+        self.assertNotIn("members", group.__dict__)
+
+    def test_single_value_changes(self):
+        group = self.directory.get_group("g1", ["cn", "owner"])
+        group.add_member(FakeUser(self.bob, []))
+        group.add_member(FakeUser(self.bob, []))
+        # Without the members loaded the placeholder is dropped too, and the modify repeated if there is none
+        add = (ldap.MOD_ADD, "uniqueMember", [self.bob])
+        delete = (ldap.MOD_DELETE, "uniqueMember", [EMPTY_LIST_IDENTIFIER])
+        self.assertEqual(self.conn.modifications, [[add, delete], [add], [add, delete]])
+        self.assertEqual(self.conn.entries[self.dn]["uniqueMember"], [self.alice, self.bob])
+
+    def test_last_member_leaves(self):
+        group = self.directory.get_group("g1")
+        group.del_member(FakeUser(self.alice, []))
+        self.assertEqual(self.conn.entries[self.dn]["uniqueMember"], [EMPTY_LIST_IDENTIFIER])
+        self.assertEqual((group.members, group._members), ([], [EMPTY_LIST_IDENTIFIER]))
+        # The placeholder is known now and removed together with adding the next member
+        group.add_member(FakeUser(self.bob, []))
+        self.assertEqual(self.conn.entries[self.dn]["uniqueMember"], [self.bob])
+        self.assertEqual(group.members, [self.bob])
+
+
+class ExternalMailsTest(TestCase):
+    def setUp(self):
+        self.conn = MemberConnection({})
+        self.conn.modify_s = lambda dn, modlist: self.conn.modifications.append(modlist)
+        directory = Directory()
+        directory.connection = pool.ConnectionPool(lambda: self.conn).connection
+        self.user = User(directory, "uid=alice,ou=users,dc=example,dc=org", {
+            "uid": ["alice"], "otherMailbox": ["new@example.org"], "email": ["first@example.org", "second@example.org"]})
+
+    def test_single_replace(self):
+        self.user.verify_external_mail("new@example.org")
+        self.assertEqual(self.conn.modifications, [[
+            (ldap.MOD_REPLACE, "otherMailbox", []),
+            (ldap.MOD_REPLACE, "emailAddress", ["new@example.org", "first@example.org", "second@example.org"])]])
+        self.assertEqual(self.user.get_mails(only_verified=True), [{"verified": True, "mail": "new@example.org"},
+            {"verified": True, "mail": "first@example.org"}, {"verified": True, "mail": "second@example.org"}])
+        self.assertNotIn("otherMailbox", self.user.attrs)
+
+    def test_only_changed_attributes(self):
+        self.user.set_primary_mail("second@example.org")
+        self.assertEqual(self.conn.modifications, [[(ldap.MOD_REPLACE, "emailAddress", ["second@example.org", "first@example.org"])]])
+        self.assertEqual(self.user.primary_mail, "second@example.org")
+        self.assertEqual(self.user.attrs["email"], ["second@example.org", "first@example.org"])
+        self.user.set_primary_mail("second@example.org")
+        self.assertEqual(len(self.conn.modifications), 1)
+
+
+class MailIndexTest(TestCase):
+    def setUp(self):
+        self.loads = 0
+
+        def load():
+            self.loads += 1
+            return [("alice", ["Alice@Example.org", "alice@ext.org"]), ("bob", ["shared@example.org"]), ("carol", ["shared@example.org"])]
+        self.index = mailindex.MailIndex(load, negative_ttl=60)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.get_uids("alice@example.org"), set(["alice"]))
+        self.assertEqual(self.index.get_uids("shared@example.org"), set(["bob", "carol"]))
+        self.assertIsNone(self.index.get_uids("free@example.org"))
+        self.assertEqual(self.loads, 1)
+
+    def test_updates(self):
+        self.index.rebuild()
+        self.index.set_missing("free@example.org")
+        self.assertEqual(self.index.get_uids("FREE@example.org"), set())
+        self.index.set_mails("alice", ["free@example.org"])
+        self.assertEqual(self.index.get_uids("free@example.org"), set(["alice"]))
+        self.assertIsNone(self.index.get_uids("alice@ext.org"))
+
+    def test_negative_ttl(self):
+        self.index.rebuild()
+        self.index.negative_ttl = 0
+        self.index.set_missing("free@example.org")
+        self.assertIsNone(self.index.get_uids("free@example.org"))
+
+    def test_lookups_do_not_wait_for_rebuild(self):
+        self.index.rebuild()
+        loading = threading.Event()
+        proceed = threading.Event()
+
+        def load():
+            loading.set()
+            proceed.wait(5)
+            return [("alice", ["alice@example.org"])]
+        self.index.load = load
+        thread = threading.Thread(target=self.index.rebuild)
+        thread.start()
+        loading.wait(5)
+        # Answered from the old index while the rebuild is loading, writes meanwhile survive it
+        self.assertEqual(self.index.get_uids("shared@example.org"), set(["bob", "carol"]))
+        self.index.set_mails("dave", ["dave@example.org"])
+        proceed.set()
+        thread.join()
+        self.assertEqual(self.index.get_uids("dave@example.org"), set(["dave"]))
+        self.assertIsNone(self.index.get_uids("shared@example.org"))
+
+
+class SearchConnection:
+    def __init__(self, results):
+        self.results = results
+        self.filters = []
+
+    def search_s(self, base, scope, filterstr, attrlist=None):
+        self.filters.append(filterstr)
+        return self.results
+
+
+class GetUserByMailTest(TestCase):
+    def test_escaped_hydrated_search(self):
+        conn = SearchConnection([("uid=alice,ou=users,dc=example,dc=org", {"uid": ["alice"], "otherMailbox": ["a*b@example.org"]})])
+        directory = Directory(user_dn_base="ou=users,dc=example,dc=org", page_size=None, mail_index=True)
+        directory.connection = pool.ConnectionPool(lambda: conn).connection
+        directory.mail_index.rebuild = lambda: None
+        directory.mail_index._loaded = time.time()
+
+        self.assertEqual(directory.get_user_by_mail("a*b@example.org").name, "alice")
+        self.assertEqual(conn.filters, ["(|(mail=a\\2ab@example.org)(email=a\\2ab@example.org)(otherMailbox=a\\2ab@example.org))"])
+        self.assertEqual(directory.mail_index.get_uids("A*B@example.org"), set(["alice"]))
+
+        conn.results = []
+        self.assertRaises(AttributeError, directory.get_user_by_mail, "free@example.org")
+        self.assertRaises(AttributeError, directory.get_user_by_mail, "free@example.org")
+        self.assertEqual(len(conn.filters), 2)
+
+    def test_outdated_duplicate(self):
+        conn = SearchConnection([("uid=alice,ou=users,dc=example,dc=org", {"uid": ["alice"], "mail": ["a@example.org"]})])
+        directory = Directory(user_dn_base="ou=users,dc=example,dc=org", page_size=None, mail_index=True)
+        directory.connection = pool.ConnectionPool(lambda: conn).connection
+        directory.mail_index.load = lambda: [("alice", ["a@example.org"]), ("bob", ["a@example.org"])]
+        # bob gave up the address since the index was loaded
+        self.assertEqual(directory.get_user_by_mail("a@example.org").name, "alice")
+        self.assertEqual(directory.mail_index.get_uids("a@example.org"), set(["alice", "bob"]))
+
+    def test_shared_missing_mails(self):
+        backend = cache.LocMemBackend()
+        indexes = [mailindex.MailIndex(lambda: [], backend=backend) for i in range(2)]
+        indexes[0].set_missing("new@example.org")
+        self.assertEqual(indexes[1].get_uids("New@example.org"), set())
+        indexes[1].set_mails("alice", ["new@example.org"])
+        self.assertIsNone(indexes[0].get_uids("new@example.org"))
+
+
+class AsyncConnection:
+    def __init__(self, entries):
+        self.entries = entries
+        self.calls = []
+        self._results = {}
+
+    def search_ext(self, base, scope, filterstr, attrlist=None):
+        self.calls.append("search")
+        msgid = len(self.calls)
+        if scope == ldap.SCOPE_BASE:
+            self._results[msgid] = [(base, self.entries[base])] if base in self.entries else ldap.NO_SUCH_OBJECT({"desc": "No such object"})
+        else:
+            # Understands (uniqueMember=..) and (|(uid=..)(uid=..))
+            wanted = [item.split("=", 1) for item in filterstr.strip("(|)").split(")(")]
+            self._results[msgid] = [(dn, attrs) for dn, attrs in sorted(self.entries.items())
+                                    if any(value in attrs.get(attr, []) for attr, value in wanted)]
+        return msgid
+
+    def result3(self, msgid):
+        self.calls.append("result")
+        result = self._results.pop(msgid)
+        if isinstance(result, Exception):
+            raise result
+        return ldap.RES_SEARCH_RESULT, result, msgid, []
+
+    def abandon(self, msgid):
+        self._results.pop(msgid, None)
+
+
+class FanoutTest(TestCase):
+    group = "cn=g1,ou=groups,dc=example,dc=org"
+    alice = "uid=alice,ou=users,dc=example,dc=org"
+
+    def setUp(self):
+        self.conn = AsyncConnection({
+            self.group: {"cn": ["g1"], "uniqueMember": [self.alice]},
+            self.alice: {"uid": ["alice"]},
+        })
+        self.directory = Directory(user_dn_base="ou=users,dc=example,dc=org", group_dn_base="ou=groups,dc=example,dc=org", batch_size=1)
+        self.directory.connection = pool.ConnectionPool(lambda: self.conn).connection
+
+    def test_concurrent_lookups(self):
+        with self.directory.fanout() as fanout:
+            group = fanout.get_group("g1")
+            missing = fanout.get_group("missing")
+            group_dns = fanout.get_group_dns(self.alice)
+        self.assertEqual(self.conn.calls, ["search"] * 3 + ["result"] * 3)
+        self.assertEqual(group.get().members, [self.alice])
+        self.assertRaises(AttributeError, missing.get)
+        self.assertEqual(group_dns.get(), [self.group])
+
+    def test_sync_wrapper(self):
+        users = self.directory.get_users_by_dn([self.alice, "uid=bob,ou=users,dc=example,dc=org", "cn=nested,ou=groups,dc=example,dc=org"])
+        self.assertEqual([user.name for user in users], ["alice"])
+        # One chunk per uid, all sent before the first result is read
+        self.assertEqual(self.conn.calls, ["search", "search", "result", "result"])
+
+    def test_known_lookups_need_no_search(self):
+        self.directory.begin_request()
+        try:
+            self.directory.set_group_dns(self.alice, [self.group])
+            with self.directory.fanout() as fanout:
+                group_dns = fanout.get_group_dns(self.alice)
+            self.assertEqual(group_dns.get(), [self.group])
+            self.assertEqual(self.conn.calls, [])
+        finally:
+            self.directory.end_request()
+
+
+class CredentialCheckerTest(TestCase):
+    group = "cn=g1,ou=groups,dc=example,dc=org"
+    alice = "uid=alice,ou=users,dc=example,dc=org"
+
+    def setUp(self):
+        self.conn = AsyncConnection({
+            self.group: {"cn": ["g1"], "uniqueMember": [self.alice]},
+            self.alice: {"uid": ["alice"], "cn": ["Alice"]},
+        })
+        self.directory = Directory(user_dn_base="ou=users,dc=example,dc=org", group_dn_base="ou=groups,dc=example,dc=org",
+                                   credential_user_limit=2, credential_ip_limit=3)
+        self.directory.connection = pool.ConnectionPool(lambda: self.conn).connection
+        self.binds = []
+
+        def check_password(dn, password):
+            self.binds.append(dn)
+            return password == "secret"
+        self.directory.check_password = check_password
+        self.checker = self.directory.credentials
+
+    def test_cached_verification(self):
+        result = self.checker.check("alice", u"secret", "10.0.0.1")
+        self.assertEqual(result, {"name": "alice", "display_name": "Alice", "groups": ["g1"]})
+        self.assertEqual(self.conn.calls, ["search", "search", "result", "result"])
+        self.assertEqual(self.checker.check("Alice", u"secret", "10.0.0.1"), result)
+        self.assertEqual(len(self.binds), 1)
+        self.assertIsNone(self.checker.check("alice", u"wrong", "10.0.0.1"))
+        self.assertEqual(self.checker.get_metrics(), {"hits": 1, "misses": 2, "failures": 1, "limited": 0, "entries": 1})
+        self.assertNotIn("secret", repr(self.checker._entries.keys()))
+
+        self.checker.forget("ALICE")
+        self.checker.check("alice", u"secret")
+        self.assertEqual(len(self.binds), 3)
+
+    def test_rate_limits(self):
+        for i in range(2):
+            self.assertIsNone(self.checker.check("alice", u"wrong", "10.0.0.1"))
+        self.assertRaises(credentials.RateLimited, self.checker.check, "alice", u"secret", "10.0.0.2")
+        self.assertIsNone(self.checker.check("bob", u"wrong", "10.0.0.1"))
+        self.assertRaises(credentials.RateLimited, self.checker.check, "carol", u"secret", "10.0.0.1")
+        self.assertEqual(len(self.binds), 3)
+        self.assertEqual(self.checker.get_metrics()["limited"], 2)
+
+    def test_remembered_check_keeps_failures(self):
+        self.checker.check("alice", u"secret")
+        self.assertIsNone(self.checker.check("alice", u"wrong"))
+        self.checker.check("alice", u"secret")
+        self.assertIsNone(self.checker.check("alice", u"wrong"))
+        self.assertRaises(credentials.RateLimited, self.checker.check, "alice", u"secret")
+
+    def test_group_names_keep_their_case(self):
+        server = testing.MemoryServer("cn=admin,dc=example,dc=org", "secret")
+        server.load(testing.generate_records("ou=users,dc=example,dc=org", "ou=groups,dc=example,dc=org", users=2, groups=0))
+        server.add("cn=JungePiraten,ou=groups,dc=example,dc=org", {"objectClass": ["groupOfUniqueNames"], "cn": ["JungePiraten"],
+                                                                   "uniqueMember": ["uid=user0,ou=users,dc=example,dc=org"]})
+        with server.installed():
+            for options in ({"cache": cache.DirectoryCache(cache.LocMemBackend())}, {"nested_groups": True}):
+                directory = Directory(bind_user="cn=admin,dc=example,dc=org", bind_password="secret", credential_ttl=0,
+                                      user_dn_base="ou=users,dc=example,dc=org", group_dn_base="ou=groups,dc=example,dc=org", **options)
+                # The second check finds the memberships in the cache or the graph
+                for i in range(2):
+                    directory.begin_request()
+                    self.assertEqual(directory.credentials.check("user0", u"password")["groups"], ["JungePiraten"])
+                    directory.end_request()
+
+    def test_shared_backend(self):
+        backend = cache.LocMemBackend()
+        checkers = [credentials.CredentialChecker(self.directory, user_limit=2, backend=backend) for i in range(2)]
+        for checker in checkers:
+            checker.check("alice", u"secret")
+        checkers[1].check("alice", u"secret")
+        self.assertEqual(len(self.binds), 2)
+        # A password change handled by one process ends the remembered checks of all others
+        checkers[0].forget("alice")
+        checkers[1].check("alice", u"secret")
+        self.assertEqual(len(self.binds), 3)
+
+        self.assertIsNone(checkers[0].check("bob", u"wrong"))
+        self.assertIsNone(checkers[1].check("bob", u"wrong"))
+        for checker in checkers:
+            self.assertRaises(credentials.RateLimited, checker.check, "bob", u"secret")
+
+    def test_limits_expire(self):
+        limiter = credentials.RateLimiter(1, 0.01)
+        limiter.add("alice")
+        self.assertTrue(limiter.is_limited("alice"))
+        time.sleep(0.02)
+        self.assertFalse(limiter.is_limited("alice"))
+        self.assertEqual(limiter._events, {})
+
+
+class MemoryServerTest(TestCase):
+    def setUp(self):
+        f = StringIO.StringIO()
+        testing.write_ldif(testing.generate_records("ou=users,dc=example,dc=org", "ou=groups,dc=example,dc=org", users=20, groups=3, members=5), f)
+        f.seek(0)
+        self.server = testing.MemoryServer("cn=admin,dc=example,dc=org", "secret")
+        self.server.load(testing.read_ldif(f))
+
+    def test_directory_on_generated_tree(self):
+        with self.server.installed():
+            directory = Directory(bind_user="cn=admin,dc=example,dc=org", bind_password="secret",
+                                  user_dn_base="ou=users,dc=example,dc=org", group_dn_base="ou=groups,dc=example,dc=org")
+            group = directory.get_group("group0")
+            self.assertEqual(len(group.members), 5)
+            self.assertIn("group0", directory.get_group_names(directory.get_user_dn("user0")))
+            self.assertTrue(directory.check_password(directory.get_user_dn("user0"), u"password"))
+            self.assertFalse(directory.check_password(directory.get_user_dn("user0"), u"wrong"))
+        self.assertEqual(self.server.stats["search"], 2)
+        self.assertEqual(self.server.stats["bind"], 5)
+
+    def test_groups_of_user_in_one_search(self):
+        with self.server.installed():
+            directory = Directory(bind_user="cn=admin,dc=example,dc=org", bind_password="secret", cache=cache.DirectoryCache(cache.LocMemBackend()),
+                                  user_dn_base="ou=users,dc=example,dc=org", group_dn_base="ou=groups,dc=example,dc=org")
+            self.server.connect().modify_s("cn=group1,ou=groups,dc=example,dc=org", [(ldap.MOD_REPLACE, "uniqueMember", ["uid=user0,ou=users,dc=example,dc=org"])])
+            user = directory.get_user("user0")
+            group_dns = user.get_group_dns()
+            directory.get_group_by_dn(group_dns[0])
+            self.server.reset_stats()
+            groups = user.get_groups(Group.SUMMARY_ATTRS)
+        self.assertEqual([normalize_dn(group.dn) for group in groups], group_dns)
+        # The first group comes from the cache, the others with one OR-search
+        self.assertEqual(len(groups), 2)
+        self.assertEqual(dict(self.server.stats), {"search": 1})
+
+    def test_add_member_with_access_attrs(self):
+        dn = u"uid=j\xfcrgen,ou=users,dc=example,dc=org"
+        group_dn = "cn=group2,ou=groups,dc=example,dc=org"
+        self.server.add(dn.encode("utf-8"), {"objectClass": ["inetOrgPerson"], "uid": [u"j\xfcrgen".encode("utf-8")], "cn": ["J"], "sn": ["-"]})
+        self.server.connect().modify_s(group_dn, [(ldap.MOD_REPLACE, "uniqueMember", [EMPTY_LIST_IDENTIFIER]), (ldap.MOD_ADD, "owner", [dn.encode("utf-8")])])
+        with self.server.installed():
+            directory = Directory(bind_user="cn=admin,dc=example,dc=org", bind_password="secret",
+                                  user_dn_base="ou=users,dc=example,dc=org", group_dn_base="ou=groups,dc=example,dc=org")
+            group = directory.get_group("group2", Group.ACCESS_ATTRS)
+            group.add_member(FakeUser(dn, []))
+        # The placeholder is gone and the invitation dropped
+        self.assertEqual(self.server.get(group_dn)["uniquemember"], [dn.encode("utf-8")])
+        self.assertNotIn("owner", self.server.get(group_dn))
+
+    def test_mail_index_does_not_fill_identity_map(self):
+        with self.server.installed():
+            directory = Directory(bind_user="cn=admin,dc=example,dc=org", bind_password="secret", mail_index=True,
+                                  user_dn_base="ou=users,dc=example,dc=org", group_dn_base="ou=groups,dc=example,dc=org")
+            directory.begin_request()
+            self.assertEqual(directory.get_user_by_mail("User3@example.org").name, "user3")
+            self.assertEqual(len(directory.get_identity_map().entries), 1)
+            directory.end_request()
+
+    def test_compare(self):
+        baseline = {"endpoints": {"groups": {"p50": 10.0, "ops": {"search": 1}}}}
+        results = {"endpoints": {"groups": {"p50": 10.5, "ops": {"search": 2}}, "login": {"p50": 1.0, "ops": {}}}}
+        self.assertEqual(ldapbench.compare(baseline, results), [
+            "REGRESSION groups: p50 10.00 -> 10.50 ms (+5%), search 1 -> 2",
+            "login: not in baseline",
+        ])
+        # Baselines of another host have no timings
+        baseline = {"endpoints": {"groups": {"ops": {"search": 2}}, "login": {"ops": {"bind": 1}}}}
+        self.assertEqual(ldapbench.compare(baseline, results), ["groups: unchanged", "login: bind 1 -> 0"])
+        self.assertEqual(ldapbench.percentile([3, 1, 2], 50), 2)
+
+
+class TracingTest(TestCase):
+    def setUp(self):
+        self.server = testing.MemoryServer("cn=admin,dc=example,dc=org", "secret")
+        self.server.load(testing.generate_records("ou=users,dc=example,dc=org", "ou=groups,dc=example,dc=org", users=3, groups=1, members=2))
+        self.tracer = tracing.Tracer()
+        self.conn = self.tracer.wrap(self.server.connect())
+
+    def test_records_operations(self):
+        self.conn.simple_bind_s("cn=admin,dc=example,dc=org", "secret")
+        self.tracer.begin("view")
+        self.conn.search_s("ou=users,dc=example,dc=org", ldap.SCOPE_ONELEVEL, "(uid=*)", ["uid"])
+        msgid = self.conn.search_ext("cn=group0,ou=groups,dc=example,dc=org", ldap.SCOPE_BASE)
+        self.conn.result3(msgid)
+        self.assertRaises(ldap.NO_SUCH_OBJECT, self.conn.compare_s, "uid=nobody,ou=users,dc=example,dc=org", "uid", "nobody")
+        self.assertTrue(self.conn.whoami_s())
+        operations = self.tracer.end()
+        self.assertEqual([(op.name, op.target, op.size) for op in operations], [
+            ("search", "ou=users,dc=example,dc=org (uid=*)", 3),
+            ("search", "cn=group0,ou=groups,dc=example,dc=org (objectClass=*)", 1),
+            ("compare", "uid=nobody,ou=users,dc=example,dc=org", None),
+        ])
+        self.assertEqual(self.tracer.end(), [])
+        self.assertTrue(tracing.server_timing(operations).startswith('ldap;dur='))
+        self.assertIn('ldap-search;dur=', tracing.server_timing(operations))
+
+    def test_slow_log(self):
+        logged = []
+        self.tracer.slow_threshold = 0
+        tracing.slow_logger.warning = lambda *args: logged.append(args[-1])
+        try:
+            self.tracer.begin("jupicp.views.DashboardView")
+            self.conn.simple_bind_s("uid=user0,ou=users,dc=example,dc=org", "password")
+            self.tracer.end()
+        finally:
+            del tracing.slow_logger.warning
+        self.assertEqual(logged, ["jupicp.views.DashboardView"])
+
+
+class ReplicaTest(TestCase):
+    alice = "uid=alice,ou=users,dc=example,dc=org"
+    bob = "uid=bob,ou=users,dc=example,dc=org"
+    group = "cn=g1,ou=groups,dc=example,dc=org"
+
+    def setUp(self):
+        self.directory = Directory(user_dn_base="ou=users,dc=example,dc=org", group_dn_base="ou=groups,dc=example,dc=org", replicate=True)
+        self.replica = self.directory.replica
+        # Driven by the tests instead of a server
+        self.replica.start = lambda: None
+        self.users, self.groups = self.replica.handlers
+        self.users.syncrepl_entry(self.alice, {"uid": ["alice"], "cn": ["Alice"], "otherMailbox": ["Alice@example.org"], "userPassword": ["x"]}, "u1")
+        self.users.syncrepl_entry(self.bob, {"uid": ["bob"]}, "u2")
+        self.groups.syncrepl_entry(self.group, {"cn": ["g1"], "uniqueMember": [self.alice]}, "g1")
+        for handler in self.replica.handlers:
+            handler.syncrepl_refreshdone()
+
+        def no_connection():
+            raise AssertionError("Asked the server")
+        self.directory.connection = no_connection
+
+    def test_reads(self):
+        self.assertEqual(self.directory.get_user("alice").display_name, "Alice")
+        self.assertNotIn("userPassword", self.directory.get_user("alice").attrs)
+        self.assertRaises(AttributeError, self.directory.get_user, "carol")
+        self.assertEqual(self.directory.get_user_by_mail("alice@EXAMPLE.org").name, "alice")
+        self.assertEqual([group.name for group in self.directory.get_groups()], ["g1"])
+        self.assertEqual(self.directory.get_user("alice").get_group_dns(), [self.group])
+        self.assertEqual(self.directory.get_group_names(self.alice), ["g1"])
+        self.assertEqual([user.name for user in self.directory.get_users_by_dn([self.bob, self.alice])], ["bob", "alice"])
+
+    def test_escaped_comma(self):
+        dn = "cn=Doe\\, John,ou=groups,dc=example,dc=org"
+        self.groups.syncrepl_entry(dn, {"cn": ["Doe, John"], "uniqueMember": [self.bob]}, "g2")
+        self.assertEqual([group.name for group in self.directory.get_groups()], ["Doe, John", "g1"])
+        self.assertEqual(self.directory.get_group_names(self.bob), ["Doe, John"])
+
+    def test_changes(self):
+        self.groups.syncrepl_entry("cn=g2,ou=groups,dc=example,dc=org", {"cn": ["g2"], "uniqueMember": [self.alice]}, "g1")
+        self.assertEqual(self.replica.store.get_group_dns(self.alice), ["cn=g2,ou=groups,dc=example,dc=org"])
+        self.users.syncrepl_delete(["u2"])
+        self.assertIsNone(self.replica.store.get_by_uid("bob"))
+
+        # A refresh reports alice as present, bob is gone, and deletes nothing else
+        self.users.syncrepl_entry(self.bob, {"uid": ["bob"]}, "u2")
+        self.users.syncrepl_present(["u1"])
+        self.users.syncrepl_present(None)
+        self.assertIsNone(self.replica.store.get(self.bob))
+        self.assertIsNotNone(self.replica.store.get(self.alice))
+        self.assertIsNotNone(self.replica.store.get("cn=g2,ou=groups,dc=example,dc=org"))
+
+    def test_stale_after_write(self):
+        self.directory.written(self.group, [self.bob])
+        self.assertIsNone(self.replica.get_entry(self.group))
+        self.assertIsNone(self.replica.get_group_dns(self.bob))
+        self.assertEqual(self.replica.get_group_dns(self.alice), [self.group])
+        # The entry the server sends may still be the version before the write
+        self.groups.syncrepl_entry(self.group, {"cn": ["g1"], "uniqueMember": [self.alice, self.bob]}, "g1")
+        self.assertIsNone(self.replica.get_group_dns(self.bob))
+        # Only the timeout ends staleness
+        self.replica.stale_timeout = -1
+        self.replica.mark_stale(self.group, [self.bob])
+        self.assertEqual(self.replica.get_group_dns(self.bob), [self.group])
+
+        self.users.ready = False
+        self.assertIsNone(self.replica.get_entry(self.alice))
+
+    def test_reconnect(self):
+        # A session with a cookie keeps the copy, the server only sends the changes
+        self.users.cookie = "cookie"
+        self.users.start_session()
+        self.assertIsNotNone(self.replica.store.get(self.alice))
+        self.assertFalse(self.replica.is_ready())
+        # The refresh failed, maybe the cookie was rejected. The next session starts from scratch
+        self.users.end_session()
+        self.assertIsNone(self.users.cookie)
+        self.users.start_session()
+        self.assertIsNone(self.replica.store.get(self.alice))
+        self.assertIsNotNone(self.replica.store.get(self.group))
+        self.users.syncrepl_entry(self.alice, {"uid": ["alice"]}, "u1")
+        self.users.syncrepl_refreshdone()
+        self.assertIsNone(self.replica.store.get(self.bob))
+        self.assertEqual(self.directory.get_user("alice").name, "alice")
+
+
+class CoherenceTest(TestCase):
+    def setUp(self):
+        self.server = testing.MemoryServer("cn=admin,dc=example,dc=org", "secret")
+        self.server.load(testing.generate_records("ou=users,dc=example,dc=org", "ou=groups,dc=example,dc=org", users=3, groups=1, members=2))
+        self.installed = self.server.installed()
+        self.installed.__enter__()
+        self.cache = cache.DirectoryCache(cache.LocMemBackend())
+        self.directory = Directory(bind_user="cn=admin,dc=example,dc=org", bind_password="secret", cache=self.cache,
+                                   user_dn_base="ou=users,dc=example,dc=org", group_dn_base="ou=groups,dc=example,dc=org",
+                                   coherence_context="dc=example,dc=org", coherence_interval=0)
+        self.admin = self.server.connect()
+
+    def tearDown(self):
+        self.installed.__exit__(None, None, None)
+
+    def request(self):
+        self.directory.begin_request()
+        self.server.reset_stats()
+        try:
+            return [self.directory.get_user("user0").display_name, self.directory.get_user("user1").display_name,
+                    self.directory.get_group_names(self.directory.get_user_dn("user0"))]
+        finally:
+            self.directory.end_request()
+
+    def test_selective_invalidation(self):
+        self.request()
+        self.assertEqual(self.request(), ["User 0", "User 1", ["group0"]])
+        self.assertEqual(dict(self.server.stats), {})
+
+        self.admin.modify_s("uid=user1,ou=users,dc=example,dc=org", [(ldap.MOD_REPLACE, "cn", ["Changed"])])
+        self.assertEqual(self.request(), ["User 0", "Changed", ["group0"]])
+        # Only user1 is fetched again
+        self.assertEqual(dict(self.server.stats), {"search": 1})
+
+        self.admin.modify_s("cn=group0,ou=groups,dc=example,dc=org", [(ldap.MOD_REPLACE, "uniqueMember", ["uid=user2,ou=users,dc=example,dc=org"])])
+        self.assertEqual(self.request(), ["User 0", "Changed", []])
+
+    def test_graphs_of_other_processes(self):
+        directories = [Directory(bind_user="cn=admin,dc=example,dc=org", bind_password="secret", nested_groups=True,
+                                 cache=cache.DirectoryCache(self.cache.backend), user_dn_base="ou=users,dc=example,dc=org",
+                                 group_dn_base="ou=groups,dc=example,dc=org", coherence_context="dc=example,dc=org",
+                                 coherence_interval=0) for i in range(2)]
+
+        def group_names(directory):
+            directory.begin_request()
+            try:
+                return directory.get_group_names(directory.get_user_dn("user2"))
+            finally:
+                directory.end_request()
+        self.assertEqual([group_names(directory) for directory in directories], [[], []])
+        self.admin.modify_s("cn=group0,ou=groups,dc=example,dc=org", [(ldap.MOD_ADD, "uniqueMember", ["uid=user2,ou=users,dc=example,dc=org"])])
+        # The first one finds the change, the second only sees the contextCSN it stored
+        self.assertEqual([group_names(directory) for directory in directories], [["group0"], ["group0"]])
+
+    def test_delete_flushes(self):
+        self.request()
+        self.admin.delete_s("uid=user1,ou=users,dc=example,dc=org")
+        self.directory.begin_request()
+        try:
+            self.assertEqual(self.directory.get_user("user0").display_name, "User 0")
+            self.assertRaises(AttributeError, self.directory.get_user, "user1")
+        finally:
+            self.directory.end_request()
+
+
+class LazyUserTest(TestCase):
+    snapshot = {
+        "name": "alice",
+        "display_name": "Alice",
+        "mail": "alice@example.org",
+        "primary_mail": "alice@example.org",
+        "external_mails": [{"verified": False, "mail": "alice@example.com"}],
+    }
+
+    def setUp(self):
+        self.directory = Directory(user_dn_base="ou=users,dc=example,dc=org")
+        self.loaded = []
+        self.lookups = []
+
+        def get_user(name):
+            self.loaded.append(name)
+            return FakeUser(self.directory.get_user_dn(name), [])
+        self.directory.get_user = get_user
+
+        def get_group_dns(dn):
+            self.lookups.append(dn)
+            return ["cn=g1,ou=groups,dc=example,dc=org"]
+        self.directory.get_group_dns = get_group_dns
+
+    def test_snapshot_avoids_lookups(self):
+        user = LazyUser(self.directory, "alice", self.snapshot)
+        self.assertTrue(user)
+        self.assertEqual(user.name, "alice")
+        self.assertEqual(user.display_name, "Alice")
+        self.assertEqual([m["mail"] for m in user.get_mails()], ["alice@example.com", "alice@example.org"])
+        self.assertEqual([m["mail"] for m in user.get_mails(only_verified=True)], ["alice@example.org"])
+        self.assertEqual(self.loaded, [])
+        user = LazyUser(self.directory, "alice")
+        user._user = User(self.directory, user.dn, {"uid": ["alice"], "cn": ["Alice"]})
+        self.assertEqual(sorted(user.snapshot()), ["display_name", "external_mails", "mail", "name", "primary_mail"])
+
+    def test_groups_without_loading(self):
+        # Memberships are looked up on every request, but the user is not loaded for them
+        user = LazyUser(self.directory, "alice", self.snapshot)
+        self.assertTrue(user.match_dn("cn=G1,ou=groups,dc=example,dc=org"))
+        self.assertFalse(user.match_dn("cn=g2,ou=groups,dc=example,dc=org"))
+        user.group_joined(Group(self.directory, "cn=g2,ou=groups,dc=example,dc=org", {"cn": ["g2"]}))
+        self.assertTrue(user.match_dn("cn=g2,ou=groups,dc=example,dc=org"))
+        user.group_left(Group(self.directory, "cn=g1,ou=groups,dc=example,dc=org", {"cn": ["g1"]}))
+        self.assertFalse(user.match_dn("cn=g1,ou=groups,dc=example,dc=org"))
+        self.assertEqual(self.lookups, ["uid=alice,ou=users,dc=example,dc=org"])
+        self.assertEqual(self.loaded, [])
+
+    def test_loads_on_first_use(self):
+        user = LazyUser(self.directory, "alice")
+        self.assertFalse(user.is_loaded())
+        self.assertEqual(user.dn, "uid=alice,ou=users,dc=example,dc=org")
+        self.assertEqual(user.get_user().dn, "uid=alice,ou=users,dc=example,dc=org")
+        self.assertFalse(user.match_dn("cn=g1,ou=groups,dc=example,dc=org"))
+        self.assertEqual(self.loaded, ["alice"])
+        self.assertEqual(user, FakeUser("uid=Alice,ou=users,dc=example,dc=org", []))
+        self.assertNotEqual(user, FakeUser("uid=bob,ou=users,dc=example,dc=org", []))
+
+
+class BulkMembersTest(TestCase):
+    def setUp(self):
+        self.server = testing.MemoryServer("cn=admin,dc=example,dc=org", "secret")
+        self.server.load(testing.generate_records("ou=users,dc=example,dc=org", "ou=groups,dc=example,dc=org", users=6, groups=1, members=1))
+        self.admin = self.server.connect()
+        for uid in ("user4", "user5"):
+            self.admin.modify_s("uid={0},ou=users,dc=example,dc=org".format(uid), [(ldap.MOD_ADD, "otherMailbox", ["shared@example.org"])])
+        self.installed = self.server.installed()
+        self.installed.__enter__()
+        self.directory = Directory(bind_user="cn=admin,dc=example,dc=org", bind_password="secret", batch_size=2,
+                                   user_dn_base="ou=users,dc=example,dc=org", group_dn_base="ou=groups,dc=example,dc=org")
+
+    def tearDown(self):
+        self.installed.__exit__(None, None, None)
+
+    def uids(self, dns):
+        return [self.directory.get_uid(dn) for dn in dns]
+
+    def test_read_identifiers(self):
+        f = StringIO.StringIO("uid,cn,mail\nuser1,User 1,\n\n# comment\nuser2@example.org\n")
+        self.assertEqual(bulk.read_identifiers(f), ["user1", "user2@example.org"])
+        f = StringIO.StringIO("dn: uid=user1,ou=users,dc=example,dc=org\nuid: user1\n\ndn: uid=user2,ou=users,dc=example,dc=org\n\n")
+        self.assertEqual(bulk.read_identifiers(f, "ldif"), ["user1", "uid=user2,ou=users,dc=example,dc=org"])
+
+    def test_resolve(self):
+        self.server.reset_stats()
+        dns = bulk.resolve(self.directory, ["user1", "USER2", "user3@example.org", "uid=user4,ou=users,dc=example,dc=org", "user1"])
+        self.assertEqual(self.uids(dns), ["user1", "user2", "user3", "user4"])
+        # Two batches of uids and one of mails
+        self.assertEqual(self.server.stats["search"], 3)
+
+        with self.assertRaises(bulk.InvalidMembers) as cm:
+            bulk.resolve(self.directory, ["user1", "nobody", "shared@example.org", "cn=group0,ou=groups,dc=example,dc=org"])
+        self.assertEqual(cm.exception.unknown, ["nobody", "cn=group0,ou=groups,dc=example,dc=org"])
+        self.assertEqual(cm.exception.ambiguous, ["shared@example.org"])
+
+    def test_import_uses_one_modify(self):
+        group = self.directory.get_group("group0")
+        self.server.reset_stats()
+        dns = bulk.resolve(self.directory, ["user1", "user2", "user3"])
+        added, removed = bulk.import_members(group, dns, "replace")
+        self.assertEqual(self.uids(added), ["user1", "user2", "user3"])
+        self.assertEqual(self.uids(removed), ["user0"])
+        self.assertEqual(self.server.stats["modify"], 1)
+        self.assertEqual(sorted(self.uids(self.directory.get_group("group0").members)), ["user1", "user2", "user3"])
+
+        self.assertEqual(bulk.import_members(group, dns[:1], "add"), ([], []))
+        self.assertEqual(self.server.stats["modify"], 1)
+        bulk.import_members(group, dns, "remove")
+        self.assertEqual(self.server.get("cn=group0,ou=groups,dc=example,dc=org")["uniquemember"], [EMPTY_LIST_IDENTIFIER])
+        bulk.import_members(group, dns[:1], "add")
+        self.assertEqual(self.uids(self.server.get("cn=group0,ou=groups,dc=example,dc=org")["uniquemember"]), ["user1"])
+
+    def test_update_members_refetches_outdated_group(self):
+        group = self.directory.get_group("group0")
+        self.admin.modify_s(group.dn, [(ldap.MOD_ADD, "uniqueMember", ["uid=user1,ou=users,dc=example,dc=org"])])
+        added, removed = group.update_members([self.directory.get_user_dn("user1"), self.directory.get_user_dn("user2")])
+        self.assertEqual(self.uids(added), ["user2"])
+        self.assertEqual(sorted(self.uids(self.server.get(group.dn)["uniquemember"])), ["user0", "user1", "user2"])
+
+    def test_export(self):
+        group = self.directory.get_group("group0")
+        group.update_members([self.directory.get_user_dn("user3"), self.directory.get_user_dn("user1"), "cn=group1,ou=groups,dc=example,dc=org"])
+        self.assertEqual("".join(bulk.export_csv(bulk.iter_members(group))).splitlines(),
+                         ["uid,cn,mail", "user0,User 0,", "user1,User 1,", "user3,User 3,"])
+        ldif = StringIO.StringIO("".join(bulk.export_ldif(bulk.iter_members(group))))
+        self.assertEqual(bulk.read_identifiers(ldif, "ldif"), ["user0", "user1", "user3"])
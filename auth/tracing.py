@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+import ldap
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger(__name__ + ".slow")
+
+# Methods of LDAPObject recorded by TracedConnection, and how they are called in the trace
+OPERATIONS = {
+    "simple_bind_s": "bind",
+    "search_s": "search",
+    "compare_s": "compare",
+    "modify_s": "modify",
+    "add_s": "add",
+    "delete_s": "delete",
+    "passwd_s": "passwd",
+}
+
+
+class Operation:
+    def __init__(self, name, target, size, duration):
+        self.name = name
+        # dn, or "base filter" for searches
+        self.target = target
+        # Number of returned entries for searches, None otherwise
+        self.size = size
+        # Seconds
+        self.duration = duration
+
+    def __repr__(self):
+        return "<{0} {1} ({2}) {3:.1f} ms>".format(self.name, self.target, self.size, self.duration * 1000)
+
+
+class Tracer:
+    """
+    Records the operations of connections wrapped by wrap(). Between begin() and end() the operations of the current
+    thread are collected, end() returns them. Operations taking at least slow_threshold seconds are logged to the
+    auth.tracing.slow logger together with the view they came from.
+    """
+    def __init__(self, slow_threshold=None):
+        self.slow_threshold = slow_threshold
+        self._local = threading.local()
+
+    def wrap(self, conn):
+        return TracedConnection(conn, self)
+
+    def begin(self, view=None):
+        self._local.operations = []
+        self._local.view = view
+
+    def set_view(self, view):
+        self._local.view = view
+
+    def end(self):
+        operations = getattr(self._local, "operations", None)
+        self._local.operations = None
+        self._local.view = None
+        return operations or []
+
+    def record(self, name, target, size, duration):
+        operations = getattr(self._local, "operations", None)
+        if operations is not None:
+            operations.append(Operation(name, target, size, duration))
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            slow_logger.warning("%s %s took %.1f ms%s in %s", name, target, duration * 1000,
+                                " ({0} entries)".format(size) if size is not None else "",
+                                getattr(self._local, "view", None) or "no request")
+
+
+class TracedConnection:
+    """
+    Forwards everything to conn, recording the operations listed in OPERATIONS and asynchronous searches. An
+    asynchronous search is recorded when its result is read, with the time since it was sent.
+    """
+    def __init__(self, conn, tracer):
+        self._conn = conn
+        self._tracer = tracer
+        # msgid -> (target, time sent)
+        self._searches = {}
+
+    def __getattr__(self, attr):
+        method = getattr(self._conn, attr)
+        if attr not in OPERATIONS:
+            return method
+
+        def traced(*args, **kwargs):
+            start = time.time()
+            result = None
+            try:
+                result = method(*args, **kwargs)
+                return result
+            finally:
+                size = len(result) if attr == "search_s" and result is not None else None
+                self._tracer.record(OPERATIONS[attr], self._target(attr, args, kwargs), size, time.time() - start)
+        return traced
+
+    def _target(self, attr, args, kwargs):
+        if attr == "search_s":
+            return "{0} {1}".format(args[0], args[2] if len(args) > 2 else kwargs.get("filterstr", "(objectClass=*)"))
+        return args[0] if args else kwargs.get("who", kwargs.get("user", kwargs.get("dn", "")))
+
+    def search_ext(self, base, scope, filterstr="(objectClass=*)", *args, **kwargs):
+        msgid = self._conn.search_ext(base, scope, filterstr, *args, **kwargs)
+        self._searches[msgid] = ("{0} {1}".format(base, filterstr), time.time())
+        return msgid
+
+    def result3(self, msgid=ldap.RES_ANY, *args, **kwargs):
+        target, start = self._searches.pop(msgid, ("", None))
+        rdata = None
+        try:
+            result = self._conn.result3(msgid, *args, **kwargs)
+            rdata = result[1]
+            return result
+        finally:
+            if start is not None:
+                self._tracer.record("search", target, len(rdata) if rdata is not None else None, time.time() - start)
+
+    def abandon(self, msgid):
+        self._searches.pop(msgid, None)
+        return self._conn.abandon(msgid)
+
+
+def summarize(operations):
+    # name -> (count, seconds)
+    summary = {}
+    for operation in operations:
+        count, duration = summary.get(operation.name, (0, 0))
+        summary[operation.name] = (count + 1, duration + operation.duration)
+    return summary
+
+
+def server_timing(operations):
+    """
+    Value of a Server-Timing header with the total time spent in LDAP and the time per kind of operation
+    """
+    summary = summarize(operations)
+    total = sum(duration for count, duration in summary.values())
+    metrics = ['ldap;dur={0:.1f};desc="{1} operations"'.format(total * 1000, len(operations))]
+    for name, (count, duration) in sorted(summary.items()):
+        metrics.append('ldap-{0};dur={1:.1f};desc="{2}x"'.format(name, duration * 1000, count))
+    return ", ".join(metrics)
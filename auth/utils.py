@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import ldap
+import ldap.dn
+
+_normalized_dns = {}
+
+
+def normalize_dn(dn):
+    """
+    Canonical spelling of a dn (lowercase, no whitespace around separators), so dns can be compared as strings
+    """
+    try:
+        return _normalized_dns[dn]
+    except KeyError:
+        pass
+    try:
+        normalized = ldap.dn.dn2str(ldap.dn.str2dn(dn.lower()))
+    except ldap.DECODING_ERROR:
+        normalized = dn.strip().lower()
+    # The same few thousand dns come up again and again, keep the memo from growing without bounds
+    if len(_normalized_dns) > 10000:
+        _normalized_dns.clear()
+    _normalized_dns[dn] = normalized
+    return normalized
+
+
+def parent_dn(dn):
+    # dn of the entry dn is directly below, in the spelling of normalize_dn for normalized dns
+    try:
+        return ldap.dn.dn2str(ldap.dn.str2dn(dn)[1:])
+    except ldap.DECODING_ERROR:
+        return dn.split(",", 1)[-1]
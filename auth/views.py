@@ -25,4 +25,6 @@ class LogoutView(RedirectView):
     def get_redirect_url(self):
         if "user" in self.request.session:
             del(self.request.session["user"])
+        if "user_snapshot" in self.request.session:
+            del(self.request.session["user_snapshot"])
         return reverse_lazy("login")
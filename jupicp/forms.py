@@ -3,8 +3,11 @@ from django.conf import settings
 from django.core import validators
 from django.utils.translation import ugettext_lazy as _
 
+import ldap
 import recaptcha_form.forms
 
+from auth import bulk
+
 import re
 
 
@@ -22,7 +25,11 @@ class ProfileForm(forms.Form):
 
     def clean_current_password(self):
         password = self.cleaned_data["current_password"]
-        if not self.user.check_password(password):
+        try:
+            valid = self.user.check_password(password)
+        except ldap.BUSY:
+            raise forms.ValidationError(_("Too many logins at the moment, please try again in a minute"))
+        if not valid:
             raise forms.ValidationError(_("Wrong Password"))
         return password
 
@@ -85,6 +92,36 @@ class GroupsCreateForm(forms.Form):
     description = forms.CharField(widget=forms.Textarea, label=_("Description"))
 
 
+class GroupsMembersImportForm(forms.Form):
+    file = forms.FileField(label=_("File"), help_text=_("CSV with a username or mail per line, or LDIF"))
+    mode = forms.ChoiceField(label=_("Mode"), choices=[
+        ("add", _("Add these users")),
+        ("remove", _("Remove these users")),
+        ("replace", _("Replace all users by these")),
+    ])
+
+    def clean(self):
+        # Resolve all users before anything is changed, the members are found in cleaned_data["dns"]
+        cleaned_data = super(GroupsMembersImportForm, self).clean()
+        if "file" not in cleaned_data:
+            return cleaned_data
+        f = cleaned_data["file"]
+        try:
+            identifiers = bulk.read_identifiers(f, bulk.guess_format(f.name))
+        except ValueError:
+            raise forms.ValidationError(_("File is neither valid CSV nor LDIF"))
+        try:
+            cleaned_data["dns"] = bulk.resolve(settings.DIRECTORY, identifiers)
+        except bulk.InvalidMembers as e:
+            errors = []
+            if e.unknown:
+                errors.append(_("Unknown users: %s") % ", ".join(e.unknown).decode("utf-8", "replace"))
+            if e.ambiguous:
+                errors.append(_("Mails used by several users: %s") % ", ".join(e.ambiguous).decode("utf-8", "replace"))
+            raise forms.ValidationError(errors)
+        return cleaned_data
+
+
 class JoinMembershipForm(forms.Form):
     pass
 
@@ -0,0 +1,101 @@
+import datetime
+import logging
+import threading
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection as db_connection
+from django.db.models import Q
+from django.utils import timezone
+
+from jupicp.models import QueuedMail
+
+logger = logging.getLogger(__name__)
+
+# How long a sender may work on a batch before others consider it dead and take over
+LOCK_TIMEOUT = datetime.timedelta(minutes=10)
+
+
+def enqueue(subject, body, from_email, recipients):
+    return QueuedMail.objects.create(subject=subject, body=body, from_email=from_email, recipients="\n".join(recipients))
+
+
+def send_queued(batch_size=50, connection=None):
+    """
+    Send up to batch_size due mails over a single SMTP connection. Returns the number of mails sent and failed.
+    """
+    now = timezone.now()
+    due = QueuedMail.objects.filter(failed=False, next_attempt__lte=now).filter(Q(locked_until__isnull=True) | Q(locked_until__lt=now)).order_by("next_attempt")[:batch_size]
+    # Claim every mail with a conditional update, only one sender will succeed
+    claimed = [mail for mail in due if QueuedMail.objects.filter(pk=mail.pk, locked_until=mail.locked_until).update(locked_until=now + LOCK_TIMEOUT)]
+    if not claimed:
+        return 0, 0
+
+    connection = connection or get_connection()
+    sent, failed = 0, 0
+    try:
+        connection.open()
+        for mail in claimed:
+            try:
+                EmailMessage(mail.subject, mail.body, mail.from_email, mail.get_recipients(), connection=connection).send()
+            except Exception as e:
+                _retry_later(mail, e)
+                failed += 1
+            else:
+                mail.delete()
+                sent += 1
+    except Exception as e:
+        # Could not even connect, try again with all remaining mails later
+        for mail in claimed[sent + failed:]:
+            _retry_later(mail, e)
+            failed += 1
+    finally:
+        connection.close()
+    return sent, failed
+
+
+def _retry_later(mail, error):
+    mail.attempts += 1
+    mail.last_error = unicode(error)
+    mail.locked_until = None
+    max_attempts = getattr(settings, "JUPICP_MAILQUEUE_MAX_ATTEMPTS", 10)
+    if mail.attempts >= max_attempts:
+        mail.failed = True
+        logger.error("Giving up on mail %d to %s after %d attempts: %s", mail.pk, mail.recipients, mail.attempts, mail.last_error)
+    else:
+        delay = getattr(settings, "JUPICP_MAILQUEUE_RETRY_DELAY", 60) * 2 ** (mail.attempts - 1)
+        mail.next_attempt = timezone.now() + datetime.timedelta(seconds=delay)
+    mail.save()
+
+
+_wakeup = threading.Event()
+_sender = None
+_sender_lock = threading.Lock()
+
+
+def wake():
+    """
+    Make sure the background sender of this process is running and let it look for new mails
+    """
+    global _sender
+    with _sender_lock:
+        if _sender is None or not _sender.is_alive():
+            _sender = threading.Thread(target=_run, name="jupicp-mailqueue")
+            _sender.daemon = True
+            _sender.start()
+    _wakeup.set()
+
+
+def _run():
+    batch_size = getattr(settings, "JUPICP_MAILQUEUE_BATCH_SIZE", 50)
+    while True:
+        # Also wake up from time to time to retry failed mails
+        _wakeup.wait(getattr(settings, "JUPICP_MAILQUEUE_RETRY_DELAY", 60))
+        _wakeup.clear()
+        try:
+            while sum(send_queued(batch_size)) == batch_size:
+                pass
+        except Exception:
+            logger.exception("Sending queued mails failed")
+        finally:
+            db_connection.close()
@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from jupicp import mailqueue
+
+
+class Command(BaseCommand):
+    help = "Sends all due mails from the outgoing mail queue"
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", default=50, help="Mails to send over one SMTP connection"),
+    )
+
+    def handle(self, *args, **options):
+        total_sent, total_failed = 0, 0
+        while True:
+            sent, failed = mailqueue.send_queued(options["batch_size"])
+            total_sent += sent
+            total_failed += failed
+            if sent + failed < options["batch_size"]:
+                break
+        self.stdout.write("Sent {0} mails, {1} failed".format(total_sent, total_failed))
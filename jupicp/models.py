@@ -0,0 +1,20 @@
+from django.db import models
+from django.utils import timezone
+
+
+class QueuedMail(models.Model):
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    # One address per line
+    recipients = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    # Set while some sender is working on the mail, so concurrent senders do not deliver it twice
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    failed = models.BooleanField(default=False)
+
+    def get_recipients(self):
+        return self.recipients.split("\n")
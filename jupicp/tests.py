@@ -0,0 +1,88 @@
+import datetime
+
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.core.urlresolvers import Resolver404, resolve
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from jupicp import mailqueue, utils
+from jupicp.models import QueuedMail
+
+MAIL = {"subject": "Welcome", "body": "Hey {username}", "from": "noreply@example.org"}
+
+
+class CountingBackend(EmailBackend):
+    opened = 0
+
+    def open(self):
+        CountingBackend.opened += 1
+        return True
+
+
+class FailingBackend(EmailBackend):
+    def send_messages(self, messages):
+        raise IOError("Connection refused")
+
+
+@override_settings(JUPICP_MAILQUEUE_BACKGROUND=False, EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class MailQueueTest(TestCase):
+    def test_send_mail_only_enqueues(self):
+        utils.send_mail(MAIL, {"username": "alice"}, "alice@example.org")
+        self.assertEqual(len(mail.outbox), 0)
+        queued = QueuedMail.objects.get()
+        self.assertEqual(queued.body, "Hey alice")
+        self.assertEqual(queued.get_recipients(), ["alice@example.org"])
+
+    def test_batch_uses_one_connection(self):
+        for name in ("alice", "bob", "carol"):
+            utils.send_mail(MAIL, {"username": name}, name + "@example.org")
+        CountingBackend.opened = 0
+        self.assertEqual(mailqueue.send_queued(connection=CountingBackend()), (3, 0))
+        self.assertEqual(CountingBackend.opened, 1)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ["alice@example.org", "bob@example.org", "carol@example.org"])
+        self.assertFalse(QueuedMail.objects.exists())
+
+    @override_settings(JUPICP_MAILQUEUE_RETRY_DELAY=60, JUPICP_MAILQUEUE_MAX_ATTEMPTS=2)
+    def test_failed_mails_are_retried_with_backoff(self):
+        utils.send_mail(MAIL, {"username": "alice"}, "alice@example.org")
+        self.assertEqual(mailqueue.send_queued(connection=FailingBackend()), (0, 1))
+        queued = QueuedMail.objects.get()
+        self.assertEqual(queued.attempts, 1)
+        self.assertIn("Connection refused", queued.last_error)
+        self.assertTrue(queued.next_attempt > timezone.now() + datetime.timedelta(seconds=50))
+        # Not due yet
+        self.assertEqual(mailqueue.send_queued(connection=FailingBackend()), (0, 0))
+
+        QueuedMail.objects.update(next_attempt=timezone.now())
+        mailqueue.send_queued(connection=FailingBackend())
+        self.assertTrue(QueuedMail.objects.get().failed)
+
+    def test_locked_mails_are_skipped(self):
+        utils.send_mail(MAIL, {"username": "alice"}, "alice@example.org")
+        QueuedMail.objects.update(locked_until=timezone.now() + datetime.timedelta(minutes=5))
+        self.assertEqual(mailqueue.send_queued(), (0, 0))
+        QueuedMail.objects.update(locked_until=timezone.now() - datetime.timedelta(minutes=5))
+        self.assertEqual(mailqueue.send_queued(), (1, 0))
+
+    def test_management_command_drains_queue(self):
+        for i in range(5):
+            utils.send_mail(MAIL, {"username": i}, "user{0}@example.org".format(i))
+        call_command("sendqueuedmail", batch_size=2)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertFalse(QueuedMail.objects.exists())
+
+
+class UrlsTest(TestCase):
+    urls = "jupicp.urls"
+
+    def test_check_user_routes_are_anchored(self):
+        self.assertEqual(resolve("/json/checkUser").func.__name__, "CheckUserJSONView")
+        self.assertEqual(resolve("/json/checkUser/stats").func.__name__, "CheckUserStatsJSONView")
+        self.assertRaises(Resolver404, resolve, "/foo/json/checkUser")
+        # Clients calling with a trailing slash keep working
+        self.assertEqual(resolve("/json/checkUser/").func.__name__, "CheckUserJSONView")
+        self.assertEqual(resolve("/json/groups/g1").func.__name__, "GroupsDetailJSONView")
+        self.assertRaises(Resolver404, resolve, "/foo/json/groups/g1")
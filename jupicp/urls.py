@@ -34,6 +34,8 @@ urlpatterns = patterns(
     url(r'^profile/', require_login(jupicp.views.ProfileView.as_view()), name="profile"),
 
     url(r'^groups/create', jupicp.views.GroupsCreateView.as_view(), name="groups_create"),
+    url(r'^groups/(?P<group_name>[^/]+)/members/import', require_login(jupicp.views.GroupsMembersImportView.as_view()), name="groups_members_import"),
+    url(r'^groups/(?P<group_name>[^/]+)/members/export\.(?P<format>csv|ldif)', require_login(jupicp.views.GroupsMembersExportView.as_view()), name="groups_members_export"),
     url(r'^groups/(?P<group_name>[^/]+)/members/add', require_login(jupicp.views.GroupsMemberAddView.as_view()), name="groups_member_add"),
     url(r'^groups/(?P<group_name>[^/]+)/members/(?P<user_name>[^/]+)/add', require_login(jupicp.views.GroupsMemberAddView.as_view()), name="groups_member_add"),
     url(r'^groups/(?P<group_name>[^/]+)/members/(?P<user_name>[^/]+)/del', require_login(jupicp.views.GroupsMemberDelView.as_view()), name="groups_member_del"),
@@ -43,8 +45,9 @@ urlpatterns = patterns(
     url(r'^groups/(?P<group_name>[^/]+)', jupicp.views.GroupsDetailView.as_view(), name="groups_detail"),
     url(r'^groups/', jupicp.views.GroupsListView.as_view(), name="groups"),
 
-    url(r'sso/discourse', require_login(discourse.views.DiscourseSSO.as_view()), name="sso_discourse"),
+    url(r'^sso/discourse', require_login(discourse.views.DiscourseSSO.as_view()), name="sso_discourse"),
 
-    url(r'json/groups/(?P<group_name>[^/]+)', jupicp.views.GroupsDetailJSONView.as_view()),
-    url(r'json/checkUser', jupicp.views.CheckUserJSONView.as_view()),
+    url(r'^json/groups/(?P<group_name>[^/]+)', jupicp.views.GroupsDetailJSONView.as_view()),
+    url(r'^json/checkUser/stats/?$', jupicp.views.CheckUserStatsJSONView.as_view()),
+    url(r'^json/checkUser/?$', jupicp.views.CheckUserJSONView.as_view()),
 )
@@ -2,7 +2,7 @@ from random import choice
 import string
 import json
 
-import django.core.mail
+from django.conf import settings
 from django.views.generic import View
 from django.http import HttpResponse
 from django.core.exceptions import PermissionDenied
@@ -15,7 +15,11 @@ def generate_password(length=8):
 def send_mail(data, options, recipient):
     if type(recipient) != list:
         recipient = [recipient]
-    django.core.mail.send_mail(data['subject'], data['body'].format(**options), data['from'], recipient)
+    # Queue the mail instead of blocking the request on a slow relay
+    from jupicp import mailqueue
+    mailqueue.enqueue(data['subject'], data['body'].format(**options), data['from'], recipient)
+    if getattr(settings, "JUPICP_MAILQUEUE_BACKGROUND", True):
+        mailqueue.wake()
 
 
 def classview_decorator(decorator):
@@ -1,14 +1,20 @@
 from django.conf import settings
-from django.http import HttpResponseRedirect
+from django.contrib import messages
+from django.http import HttpResponseRedirect, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.views.generic import TemplateView, RedirectView
+from django.views.generic import TemplateView, RedirectView, View
 from django.views.generic.edit import FormView
 from django.core import signing
 from django.core.urlresolvers import reverse, reverse_lazy
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.utils.datastructures import MultiValueDictKeyError
+from django.utils.translation import ugettext as _
 
+import ldap
+
+from auth import Group, bulk, credentials
 import mailman
+from mailman import subscriptions
 from jupicp import forms, utils
 
 
@@ -16,19 +22,29 @@ from jupicp import forms, utils
 class CheckUserJSONView(utils.JSONView):
     def post(self, *args, **kwargs):
         try:
-            ldap_user = settings.DIRECTORY.get_user(self.request.POST["user"])
-            if not ldap_user.check_password(self.request.POST["password"]):
-                return {"status": "fail", "message": "Authentification failed"}
-            return {
-                "status": "success",
-                "name": ldap_user.name,
-                "displayName": ldap_user.display_name,
-                "groups": [group.name for group in ldap_user.get_groups()],
-            }
+            result = settings.DIRECTORY.credentials.check(self.request.POST["user"], self.request.POST["password"],
+                                                          self.request.META.get("REMOTE_ADDR"))
         except MultiValueDictKeyError:
             return {"status": "fail", "message": "Need parameters user and password via POST"}
-        except AttributeError:
+        except credentials.RateLimited:
+            return {"status": "fail", "message": "Too many failed attempts"}
+        except ldap.BUSY:
+            return {"status": "fail", "message": "Too many concurrent checks, try again later"}
+        if result is None:
             return {"status": "fail", "message": "Authentification failed"}
+        return {
+            "status": "success",
+            "name": result["name"],
+            "displayName": result["display_name"],
+            "groups": result["groups"],
+        }
+
+
+class CheckUserStatsJSONView(utils.JSONView):
+    def get(self, *args, **kwargs):
+        if not self.request.user or not self.request.user.match_dn(settings.ADMIN_DN):
+            raise PermissionDenied()
+        return settings.DIRECTORY.credentials.get_metrics()
 
 
 class RegisterView(FormView):
@@ -52,6 +68,11 @@ class RegisterDoneView(TemplateView):
 class DashboardView(TemplateView):
     template_name = "jupicp/dashboard.html"
 
+    def get_context_data(self, **kwargs):
+        context = super(DashboardView, self).get_context_data(**kwargs)
+        context['groups'] = self.request.user.get_groups(Group.SUMMARY_ATTRS)
+        return context
+
 
 class MembershipView(TemplateView):
     def get_template_names(self):
@@ -75,37 +96,28 @@ class MailinglistsListView(TemplateView):
     template_name = "jupicp/lists.html"
 
     def post(self, request, **kwargs):
-        for listname, mlist in mailman.get_lists(only_public=True, lock=False):
-            subscribe = set()
-            if "subscription_" + listname in self.request.POST and self.request.POST["subscription_" + listname]:
-                subscribe.add(self.request.POST["subscription_" + listname])
-            mails = [mail["mail"] for mail in self.request.user.get_mails(only_verified=True)]
-            subscribed = set(mlist.members) & set(mails)
-
-            members_remove = subscribed - subscribe
-            members_add = subscribe - subscribed
-
-            if len(members_remove | members_add) > 0:
-                mlist.Lock()
-                for member in members_remove:
-                    mlist.ApprovedDeleteMember(member, whence="JuPiCP", admin_notif=False, userack=False)
-                for member in subscribe - subscribed:
-                    mlist.ApprovedAddMember(mailman.UserDesc(address=member), admin_notif=False, ack=False)
-                mlist.Save()
-                mlist.Unlock()
-
+        mails = [mail["mail"] for mail in self.request.user.get_mails(only_verified=True)]
+        desired = dict((key[len("subscription_"):], value) for key, value in self.request.POST.items() if key.startswith("subscription_"))
+        changes = subscriptions.plan(desired, mails, index=getattr(settings, "MAILMAN_INDEX", None))
+        busy = subscriptions.apply_changes(changes, workers=getattr(settings, "MAILMAN_SUBSCRIPTION_WORKERS", 1),
+                                           lock_timeout=getattr(settings, "MAILMAN_LOCK_TIMEOUT", 0))
+        if busy:
+            return self.render_to_response(self.get_context_data(busy=busy))
         return HttpResponseRedirect(reverse_lazy("lists"))
 
     def get_context_data(self, **kwargs):
         context = super(MailinglistsListView, self).get_context_data(**kwargs)
+        mails = self.request.user.get_mails(only_verified=True) if self.request.user else []
+        index = getattr(settings, "MAILMAN_INDEX", None)
+        subscriptions = mailman.catalogue.get_subscriptions([mail["mail"] for mail in mails], index=index)
         lists = {}
-        for listname, mlist in mailman.get_lists(only_public=True, lock=False):
-            if mlist.host_name not in lists:
-                lists[mlist.host_name] = {}
-            lists[mlist.host_name][listname] = mlist
+        for info in mailman.catalogue.get_lists(only_public=True, index=index):
+            if info.host_name not in lists:
+                lists[info.host_name] = {}
+            lists[info.host_name][info.name] = {"info": info, "subscribed": subscriptions.get(info.name, set())}
         context['lists'] = lists
         if self.request.user:
-            context['mails'] = self.request.user.get_mails(only_verified=True)
+            context['mails'] = mails
         return context
 
 
@@ -222,7 +234,7 @@ class GroupsListView(TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super(GroupsListView, self).get_context_data(**kwargs)
-        context['groups'] = [group for group in settings.DIRECTORY.get_groups() if group.may_see(self.request.user)]
+        context['groups'] = settings.DIRECTORY.filter_visible(settings.DIRECTORY.iter_groups(attrlist=Group.SUMMARY_ATTRS), self.request.user)
         if self.request.user:
             context['may_create'] = self.request.user.match_dn(settings.ADMIN_DN)
         return context
@@ -246,11 +258,17 @@ class GroupsDetailView(TemplateView):
     def get_context_data(self, **kwargs):
         context = super(GroupsDetailView, self).get_context_data(**kwargs)
         try:
-            context['group'] = settings.DIRECTORY.get_group(kwargs["group_name"])
+            with settings.DIRECTORY.fanout() as fanout:
+                group = fanout.get_group(kwargs["group_name"])
+                if self.request.user:
+                    # Needed for the permission checks below, fetch them while waiting for the group
+                    fanout.get_group_dns(self.request.user.dn)
+            context['group'] = group.get()
             if not context['group'].may_see(self.request.user):
                 raise Exception
         except:
             raise ObjectDoesNotExist
+        context['members'] = context['group'].get_members(["uid"])
         if self.request.user:
             context['is_member'] = context['group'].is_member(self.request.user)
             context['may_join'] = context['group'].may_join(self.request.user)
@@ -267,7 +285,7 @@ class GroupsDetailJSONView(utils.JSONView):
                 raise Exception
         except:
             raise ObjectDoesNotExist
-        return {"id": group.name, "name": group.display_name, "description": group.description, "members": [user.name for user in group.get_members()]}
+        return {"id": group.name, "name": group.display_name, "description": group.description, "members": [user.name for user in group.get_members(["uid"])]}
 
 
 @utils.classview_decorator(utils.raise_404)
@@ -295,7 +313,7 @@ class GroupsMemberAddView(RedirectView):
 
     def get_redirect_url(self, group_name, user_name=None):
         try:
-            group = settings.DIRECTORY.get_group(group_name)
+            group = settings.DIRECTORY.get_group(group_name, Group.ACCESS_ATTRS)
             if not group.may_see(self.request.user):
                 raise Exception
             if not user_name:
@@ -317,7 +335,7 @@ class GroupsMemberDelView(RedirectView):
 
     def get_redirect_url(self, group_name, user_name):
         try:
-            group = settings.DIRECTORY.get_group(group_name)
+            group = settings.DIRECTORY.get_group(group_name, Group.ACCESS_ATTRS)
             if not group.may_see(self.request.user):
                 raise Exception
             user = settings.DIRECTORY.get_user(user_name)
@@ -331,6 +349,71 @@ class GroupsMemberDelView(RedirectView):
         return reverse_lazy("groups_detail", kwargs={'group_name': group_name})
 
 
+def get_editable_group(request, group_name):
+    try:
+        group = settings.DIRECTORY.get_group(group_name)
+        if not group.may_see(request.user):
+            raise Exception
+    except:
+        raise ObjectDoesNotExist
+    if not group.may_edit(request.user):
+        raise PermissionDenied
+    return group
+
+
+@utils.classview_decorator(utils.raise_404)
+class GroupsMembersImportView(FormView):
+    template_name = "jupicp/groups_members_import.html"
+    form_class = forms.GroupsMembersImportForm
+
+    def dispatch(self, request, *args, **kwargs):
+        self.group = get_editable_group(request, kwargs["group_name"])
+        return super(GroupsMembersImportView, self).dispatch(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super(GroupsMembersImportView, self).get_context_data(**kwargs)
+        context['group'] = self.group
+        return context
+
+    def post(self, request, *args, **kwargs):
+        if "confirm" in request.POST:
+            return self.apply(request.POST["confirm"])
+        return super(GroupsMembersImportView, self).post(request, *args, **kwargs)
+
+    def form_valid(self, form):
+        # Only show what would change, the signed token lets the manager confirm it
+        dns, mode = form.cleaned_data["dns"], form.cleaned_data["mode"]
+        added, removed = bulk.import_members(self.group, dns, mode, dry_run=True)
+        token = signing.dumps({"group": self.group.name, "mode": mode, "dns": dns}, salt="groups_members_import")
+        get_uid = settings.DIRECTORY.get_uid
+        return self.render_to_response(self.get_context_data(form=form, token=token, mode=mode,
+                                                             added=[get_uid(dn) for dn in added], removed=[get_uid(dn) for dn in removed]))
+
+    def apply(self, token):
+        try:
+            data = signing.loads(token, salt="groups_members_import", max_age=3600)
+        except signing.BadSignature:
+            raise PermissionDenied
+        if data["group"] != self.group.name:
+            raise PermissionDenied
+        added, removed = bulk.import_members(self.group, data["dns"], data["mode"])
+        messages.success(self.request, _("%(added)d members added, %(removed)d removed") % {"added": len(added), "removed": len(removed)})
+        return HttpResponseRedirect(reverse_lazy("groups_detail", kwargs={"group_name": self.group.name}))
+
+
+@utils.classview_decorator(utils.raise_404)
+class GroupsMembersExportView(View):
+    def get(self, request, group_name, format):
+        group = get_editable_group(request, group_name)
+        # The members are fetched batch by batch while the response is sent
+        if format == "ldif":
+            response = StreamingHttpResponse(bulk.export_ldif(bulk.iter_members(group)), content_type="text/x-ldif")
+        else:
+            response = StreamingHttpResponse(bulk.export_csv(bulk.iter_members(group)), content_type="text/csv")
+        response["Content-Disposition"] = 'attachment; filename="{0}.{1}"'.format(group.name, format)
+        return response
+
+
 @utils.classview_decorator(utils.raise_404)
 class GroupsManagerAddView(RedirectView):
     permanent = False
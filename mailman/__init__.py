@@ -1,16 +1,19 @@
+import os
 import sys
+import threading
 sys.path.append("/usr/lib/mailman/bin")
 import paths
 from Mailman import Errors
 from Mailman.MailList import MailList
 from Mailman import Utils
+from Mailman import mm_cfg
 
 
 def get_listnames(only_public=False, **kwargs):
+    if only_public:
+        return [info.name for info in catalogue.get_lists(only_public=True)]
     names = Utils.list_names()
     names.sort()
-    if only_public:
-        names = [name for name in names if get_list(name, lock=False).subscribe_policy == 1]
     return names
 
 
@@ -26,3 +29,88 @@ def get_list(name, lock=False, **kwargs):
 class UserDesc:
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
+
+
+class ListInfo:
+    """
+    The attributes of a list shown on the lists page, and its lowercased member addresses
+    """
+    def __init__(self, name, host_name, real_name, description, subscribe_policy, members):
+        self.name = name
+        self.host_name = host_name
+        self.real_name = real_name
+        self.description = description
+        self.subscribe_policy = subscribe_policy
+        self.members = frozenset(members)
+
+    def is_public(self):
+        return self.subscribe_policy == 1
+
+    @classmethod
+    def from_metadata(cls, name, meta):
+        # Without members, they are looked up in the index the metadata came from
+        return cls(name, meta["host_name"], meta["real_name"], meta["description"], meta["subscribe_policy"], [])
+
+
+def load_list_info(name):
+    mlist = get_list(name, lock=False)
+    return ListInfo(name, mlist.host_name, mlist.real_name, mlist.description, mlist.subscribe_policy,
+                    [address.lower() for address in mlist.getMembers()])
+
+
+class ListCatalogue:
+    """
+    Process-wide cache of ListInfo objects. A list is only loaded again when its config.pck has changed.
+    """
+    def __init__(self, path=None, load=load_list_info):
+        self.path = path
+        self.load = load
+        self._lock = threading.Lock()
+        # name -> (stat of config.pck, ListInfo)
+        self._entries = {}
+
+    def _stat(self, name):
+        try:
+            st = os.stat(os.path.join(self.path or mm_cfg.LIST_DATA_DIR, name, "config.pck"))
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def get_lists(self, only_public=False, index=None):
+        """
+        ListInfo of all lists. With an index (a snapshot.SnapshotIndex) they are built from its metadata, no list is
+        loaded and members are left empty.
+        """
+        if index is not None:
+            return [ListInfo.from_metadata(name, index.get_metadata(name)) for name in index.get_listnames(only_public=only_public)]
+        path = self.path or mm_cfg.LIST_DATA_DIR
+        names = sorted(name for name in os.listdir(path) if os.path.exists(os.path.join(path, name, "config.pck")))
+        with self._lock:
+            for name in set(self._entries) - set(names):
+                del self._entries[name]
+            for name in names:
+                stat = self._stat(name)
+                if name not in self._entries or self._entries[name][0] != stat:
+                    self._entries[name] = (stat, self.load(name))
+            lists = [self._entries[name][1] for name in names]
+        if only_public:
+            lists = [info for info in lists if info.is_public()]
+        return lists
+
+    def get_subscriptions(self, addresses, only_public=True, index=None):
+        """
+        Returns a dict mapping every list name to the set of the given addresses subscribed to it. Memberships are
+        looked up in index (a snapshot.SnapshotIndex) if given, without loading any list.
+        """
+        addresses = set(address.lower() for address in addresses)
+        if index is None:
+            return dict((info.name, info.members & addresses) for info in self.get_lists(only_public=only_public))
+        subscriptions = dict((name, set()) for name in index.get_listnames(only_public=only_public))
+        for address in addresses:
+            for name in index.get_lists(address):
+                if name in subscriptions:
+                    subscriptions[name].add(address)
+        return subscriptions
+
+
+catalogue = ListCatalogue()
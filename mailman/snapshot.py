@@ -0,0 +1,197 @@
+import cPickle as pickle
+import fcntl
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+from Mailman import mm_cfg
+
+logger = logging.getLogger(__name__)
+
+# List attributes kept in the index
+METADATA = ("real_name", "host_name", "description", "subscribe_policy", "advertised")
+
+HEADER_SIZE = 16
+
+
+def _key(address):
+    # Mailman keeps addresses as unicode or as byte strings, the index as UTF-8
+    address = address.lower()
+    return address.encode("utf-8") if isinstance(address, unicode) else address
+
+
+def read_config(filename):
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+class SnapshotIndex:
+    """
+    Read-only index of all lists, kept in a single file that is memory-mapped by every process using it. The file
+    starts with the pickled metadata of the lists, followed by sorted "address<TAB>list,list" lines that are binary
+    searched in place. Only lists whose config.pck changed are read again when the index is refreshed, and only by
+    one process at a time: the others pick up the file it wrote.
+    """
+    def __init__(self, filename, path=None, check_interval=10, read=read_config):
+        self.filename = filename
+        self.path = path
+        self.check_interval = check_interval
+        self.read = read
+        self._lock = threading.Lock()
+        self._checked = None
+        self._map = None
+        self._start = 0
+        # (inode, mtime, size) of the file mapped into _map
+        self._file_stat = None
+        # name -> (stat of config.pck, metadata dict)
+        self.lists = {}
+
+    def _get_path(self):
+        return self.path or mm_cfg.LIST_DATA_DIR
+
+    def _stat(self, name):
+        st = os.stat(os.path.join(self._get_path(), name, "config.pck"))
+        return (st.st_mtime, st.st_size)
+
+    def _open(self):
+        # Called with self._lock held
+        try:
+            f = open(self.filename, "rb")
+        except IOError:
+            return False
+        with f:
+            st = os.fstat(f.fileno())
+            new_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        meta_size = int(new_map[:HEADER_SIZE])
+        self.lists = pickle.loads(new_map[HEADER_SIZE:HEADER_SIZE + meta_size])
+        if self._map is not None:
+            self._map.close()
+        self._map = new_map
+        self._start = HEADER_SIZE + meta_size
+        self._file_stat = (st.st_ino, st.st_mtime, st.st_size)
+        return True
+
+    def _reopen(self):
+        # Map the file again if another process replaced it since we opened it
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return
+        if (st.st_ino, st.st_mtime, st.st_size) != self._file_stat:
+            self._open()
+
+    def _entries(self):
+        if self._map is None:
+            return
+        pos = self._start
+        while pos < len(self._map):
+            end = self._map.find("\n", pos)
+            address, listnames = self._map[pos:end].split("\t")
+            yield address, listnames.split(",")
+            pos = end + 1
+
+    def _changes(self, stats):
+        changed = [name for name in stats if name not in self.lists or self.lists[name][0] != stats[name]]
+        return changed, set(self.lists) - set(stats)
+
+    def refresh(self):
+        with self._lock:
+            path = self._get_path()
+            stats = {}
+            for name in os.listdir(path):
+                try:
+                    stats[name] = self._stat(name)
+                except OSError:
+                    pass
+            self._checked = time.time()
+            self._reopen()
+            changed, removed = self._changes(stats)
+            if not changed and not removed and self._map is not None:
+                return
+            try:
+                with open(self.filename + ".lock", "a") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    # Another process may have written the index while we waited for the lock
+                    self._reopen()
+                    changed, removed = self._changes(stats)
+                    if not changed and not removed and self._map is not None:
+                        return
+                    self._rebuild(path, stats, changed, removed)
+            except (IOError, OSError) as e:
+                logger.warning("Cannot write the list index %s: %s", self.filename, e)
+
+    def _rebuild(self, path, stats, changed, removed):
+        # Called with self._lock and the file lock held
+        lists = dict((name, entry) for name, entry in self.lists.items() if name not in removed)
+        members = {}
+        for name in changed:
+            config = self.read(os.path.join(path, name, "config.pck"))
+            lists[name] = (stats[name], dict((key, config.get(key)) for key in METADATA))
+            members[name] = set(_key(address) for address in config.get("members", {}).keys() + config.get("digest_members", {}).keys())
+
+        dropped = set(changed) | removed
+        index = {}
+        for address, listnames in self._entries():
+            kept = [listname for listname in listnames if listname not in dropped]
+            if kept:
+                index[address] = kept
+        for name, addresses in members.items():
+            for address in addresses:
+                index.setdefault(address, []).append(name)
+        self._write(lists, index)
+        self._open()
+
+    def _write(self, lists, index):
+        meta = pickle.dumps(lists, pickle.HIGHEST_PROTOCOL)
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write("%0*d" % (HEADER_SIZE, len(meta)))
+            f.write(meta)
+            for address in sorted(index):
+                f.write("{0}\t{1}\n".format(address, ",".join(sorted(index[address]))))
+        # rename is atomic, other processes keep their old mapping until they reopen the file
+        os.rename(tmp, self.filename)
+
+    def _ensure_fresh(self):
+        if self._checked is None or time.time() - self._checked > self.check_interval:
+            self.refresh()
+
+    def get_lists(self, address):
+        """
+        Returns the names of all lists address is subscribed to
+        """
+        self._ensure_fresh()
+        key = _key(address)
+        with self._lock:
+            m = self._map
+            if m is None:
+                return []
+            lo, hi = self._start, len(m)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                start = m.rfind("\n", lo, mid)
+                start = lo if start == -1 else start + 1
+                end = m.find("\n", start)
+                line_address, listnames = m[start:end].split("\t")
+                if line_address == key:
+                    return listnames.split(",")
+                if line_address < key:
+                    lo = end + 1
+                else:
+                    hi = start
+        return []
+
+    def get_listnames(self, only_public=False):
+        self._ensure_fresh()
+        return sorted(name for name, (stat, meta) in self.lists.items() if not only_public or meta["subscribe_policy"] == 1)
+
+    def get_metadata(self, name):
+        self._ensure_fresh()
+        try:
+            return self.lists[name][1]
+        except KeyError:
+            raise AttributeError
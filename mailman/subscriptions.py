@@ -0,0 +1,78 @@
+from multiprocessing.pool import ThreadPool
+
+from Mailman.LockFile import TimeOutError
+
+import mailman
+
+
+class SubscriptionChange:
+    def __init__(self, listname, add, remove):
+        self.listname = listname
+        self.add = add
+        self.remove = remove
+
+
+def plan(desired, addresses, catalogue=None, index=None):
+    """
+    Compare the wanted subscriptions of someone owning addresses with the current state of all public lists.
+    desired maps list names to the address to subscribe, or to None to unsubscribe all addresses. Addresses not in
+    addresses are ignored, index is passed on to ListCatalogue.get_subscriptions. Returns a SubscriptionChange for
+    every list that has to be modified.
+    """
+    catalogue = catalogue or mailman.catalogue
+    owned = dict((address.lower(), address) for address in addresses)
+    changes = []
+    for listname, subscribed in sorted(catalogue.get_subscriptions(addresses, index=index).items()):
+        wanted = desired.get(listname)
+        wanted = set([wanted.lower()]) if wanted and wanted.lower() in owned else set()
+        if wanted != subscribed:
+            changes.append(SubscriptionChange(listname, [owned[a] for a in wanted - subscribed], [owned[a] for a in subscribed - wanted]))
+    return changes
+
+
+def apply_change(change, lock_timeout=0):
+    """
+    Apply a single change while holding the list lock. Membership is checked again under the lock, as the catalogue
+    may be outdated. The list is only saved if something was modified. Returns whether it was.
+    """
+    mlist = mailman.get_list(change.listname, lock=False)
+    mlist.Lock(lock_timeout)
+    try:
+        modified = False
+        for address in change.remove:
+            if mlist.isMember(address):
+                mlist.ApprovedDeleteMember(address, whence="JuPiCP", admin_notif=False, userack=False)
+                modified = True
+        for address in change.add:
+            if not mlist.isMember(address):
+                mlist.ApprovedAddMember(mailman.UserDesc(address=address), admin_notif=False, ack=False)
+                modified = True
+        if modified:
+            mlist.Save()
+        return modified
+    finally:
+        mlist.Unlock()
+
+
+def apply_changes(changes, workers=1, lock_timeout=0):
+    """
+    Apply changes, on up to workers threads. Every thread works on different lists, but Mailman 2 itself is not meant
+    to be used by several threads at once, so keep workers at 1 unless that was tested. With a lock_timeout (in
+    seconds, 0 waits forever) lists locked by someone else for too long are skipped. Returns the names of the skipped
+    lists.
+    """
+    def apply(change):
+        try:
+            apply_change(change, lock_timeout)
+        except TimeOutError:
+            return change.listname
+
+    if workers > 1 and len(changes) > 1:
+        pool = ThreadPool(min(workers, len(changes)))
+        try:
+            results = pool.map(apply, changes)
+        finally:
+            pool.close()
+    else:
+        results = [apply(change) for change in changes]
+    return [listname for listname in results if listname is not None]
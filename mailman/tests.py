@@ -5,7 +5,16 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+
 from django.test import TestCase
+from Mailman.LockFile import TimeOutError
+
+import mailman
+from mailman import snapshot, subscriptions
 
 
 class SimpleTest(TestCase):
@@ -14,3 +23,203 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class ListCatalogueTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.loads = []
+        self.policies = {"announce": 1, "private": 2}
+        for name in self.policies:
+            self.write(name)
+        self.catalogue = mailman.ListCatalogue(self.path, self.load)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, content="x"):
+        if not os.path.isdir(os.path.join(self.path, name)):
+            os.mkdir(os.path.join(self.path, name))
+        with open(os.path.join(self.path, name, "config.pck"), "w") as f:
+            f.write(content)
+
+    def load(self, name):
+        self.loads.append(name)
+        return mailman.ListInfo(name, "lists.example.org", name.title(), "", self.policies[name], ["alice@example.org"])
+
+    def test_only_public(self):
+        self.assertEqual([info.name for info in self.catalogue.get_lists(only_public=True)], ["announce"])
+        self.assertEqual([info.name for info in self.catalogue.get_lists()], ["announce", "private"])
+
+    def test_reloads_changed_lists_only(self):
+        self.catalogue.get_lists()
+        self.catalogue.get_lists()
+        self.assertEqual(sorted(self.loads), ["announce", "private"])
+        self.write("private", "changed")
+        self.catalogue.get_lists()
+        self.assertEqual(sorted(self.loads), ["announce", "private", "private"])
+
+    def test_removed_lists(self):
+        self.catalogue.get_lists()
+        shutil.rmtree(os.path.join(self.path, "private"))
+        self.assertEqual([info.name for info in self.catalogue.get_lists()], ["announce"])
+
+    def test_subscriptions(self):
+        subscriptions = self.catalogue.get_subscriptions(["Alice@Example.org", "bob@example.org"])
+        self.assertEqual(subscriptions, {"announce": set(["alice@example.org"])})
+
+
+class FakeList:
+    def __init__(self, name, members=(), locked_elsewhere=False):
+        self.name = name
+        self.members = set(members)
+        self.locked_elsewhere = locked_elsewhere
+        self.saved = 0
+
+    def Lock(self, timeout=0):
+        if self.locked_elsewhere:
+            raise TimeOutError()
+
+    def Unlock(self):
+        pass
+
+    def Save(self):
+        self.saved += 1
+
+    def isMember(self, address):
+        return address.lower() in self.members
+
+    def ApprovedAddMember(self, userdesc, **kwargs):
+        self.members.add(userdesc.address.lower())
+
+    def ApprovedDeleteMember(self, address, **kwargs):
+        self.members.discard(address.lower())
+
+
+class FakeCatalogue:
+    def __init__(self, subscriptions):
+        self.subscriptions = subscriptions
+
+    def get_subscriptions(self, addresses, index=None):
+        return self.subscriptions
+
+
+class SubscriptionsTest(TestCase):
+    def setUp(self):
+        self.lists = {}
+        self._get_list = mailman.get_list
+        mailman.get_list = lambda name, lock=False: self.lists[name]
+
+    def tearDown(self):
+        mailman.get_list = self._get_list
+
+    def test_plan_only_changed_lists(self):
+        catalogue = FakeCatalogue({"announce": set(["alice@example.org"]), "talk": set(), "news": set()})
+        changes = subscriptions.plan({"announce": "Alice@Example.org", "talk": "alice@example.org", "news": "mallory@example.org"},
+                                     ["Alice@Example.org"], catalogue)
+        self.assertEqual([(c.listname, c.add, c.remove) for c in changes], [("talk", ["Alice@Example.org"], [])])
+
+    def test_plan_unsubscribe(self):
+        catalogue = FakeCatalogue({"announce": set(["alice@example.org"])})
+        changes = subscriptions.plan({"announce": ""}, ["alice@example.org"], catalogue)
+        self.assertEqual([(c.listname, c.add, c.remove) for c in changes], [("announce", [], ["alice@example.org"])])
+
+    def test_apply_checks_membership_under_lock(self):
+        self.lists["talk"] = FakeList("talk", ["alice@example.org"])
+        self.assertFalse(subscriptions.apply_change(subscriptions.SubscriptionChange("talk", ["alice@example.org"], [])))
+        self.assertEqual(self.lists["talk"].saved, 0)
+        self.assertTrue(subscriptions.apply_change(subscriptions.SubscriptionChange("talk", [], ["alice@example.org"])))
+        self.assertEqual(self.lists["talk"].saved, 1)
+
+    def test_apply_changes_skips_busy_lists(self):
+        self.lists["talk"] = FakeList("talk")
+        self.lists["announce"] = FakeList("announce", locked_elsewhere=True)
+        changes = [subscriptions.SubscriptionChange(name, ["alice@example.org"], []) for name in ("announce", "talk")]
+        self.assertEqual(subscriptions.apply_changes(changes, workers=2, lock_timeout=1), ["announce"])
+        self.assertEqual(self.lists["talk"].members, set(["alice@example.org"]))
+
+
+class SnapshotIndexTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, "lists.idx")
+        self.lists = os.path.join(self.path, "lists")
+        os.mkdir(self.lists)
+        self.reads = []
+        self.write("announce", 1, ["Alice@Example.org", "bob@example.org"])
+        self.write("private", 2, ["alice@example.org"], digest=["carol@example.org"])
+        self.index = self.create()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def create(self):
+        return snapshot.SnapshotIndex(self.filename, self.lists, check_interval=0, read=self.read)
+
+    def read(self, filename):
+        self.reads.append(os.path.basename(os.path.dirname(filename)))
+        return snapshot.read_config(filename)
+
+    def write(self, name, policy, members, digest=()):
+        if not os.path.isdir(os.path.join(self.lists, name)):
+            os.mkdir(os.path.join(self.lists, name))
+        config = {"real_name": name.title(), "host_name": "lists.example.org", "description": "", "subscribe_policy": policy,
+                  "advertised": 1, "members": dict((m, 0) for m in members), "digest_members": dict((m, 0) for m in digest)}
+        with open(os.path.join(self.lists, name, "config.pck"), "wb") as f:
+            pickle.dump(config, f, 1)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.get_lists("ALICE@example.org"), ["announce", "private"])
+        self.assertEqual(self.index.get_lists("carol@example.org"), ["private"])
+        self.assertEqual(self.index.get_lists("mallory@example.org"), [])
+        self.assertEqual(self.index.get_listnames(only_public=True), ["announce"])
+        self.assertEqual(self.index.get_metadata("private")["real_name"], "Private")
+        self.assertRaises(AttributeError, self.index.get_metadata, "missing")
+
+    def test_incremental_refresh(self):
+        self.index.refresh()
+        self.assertEqual(sorted(self.reads), ["announce", "private"])
+        self.write("announce", 1, ["dave@example.org"])
+        self.index.refresh()
+        self.assertEqual(sorted(self.reads), ["announce", "announce", "private"])
+        self.assertEqual(self.index.get_lists("alice@example.org"), ["private"])
+        self.assertEqual(self.index.get_lists("dave@example.org"), ["announce"])
+
+    def test_removed_list(self):
+        self.index.refresh()
+        shutil.rmtree(os.path.join(self.lists, "private"))
+        self.assertEqual(self.index.get_lists("alice@example.org"), ["announce"])
+        self.assertEqual(self.index.get_listnames(), ["announce"])
+
+    def test_reuses_index_file(self):
+        self.index.refresh()
+        self.reads = []
+        other = self.create()
+        self.assertEqual(other.get_lists("bob@example.org"), ["announce"])
+        self.assertEqual(self.reads, [])
+
+    def test_other_process_reuses_rebuilt_file(self):
+        other = self.create()
+        self.index.refresh()
+        other.refresh()
+        self.write("announce", 1, ["dave@example.org"], digest=["J\xc3\xbcrgen@example.org"])
+        self.reads = []
+        self.index.refresh()
+        other.refresh()
+        self.assertEqual(self.reads, ["announce"])
+        self.assertEqual(other.get_lists("j\xc3\xbcrgen@example.org"), ["announce"])
+        self.assertEqual(other.get_lists(u"dave@example.org"), ["announce"])
+
+    def test_unwritable_index(self):
+        index = snapshot.SnapshotIndex(os.path.join(self.path, "missing", "lists.idx"), self.lists, check_interval=0, read=self.read)
+        self.assertEqual(index.get_lists("alice@example.org"), [])
+
+    def test_catalogue_subscriptions(self):
+        loaded = []
+        catalogue = mailman.ListCatalogue(self.lists, loaded.append)
+        self.assertEqual(catalogue.get_subscriptions(["alice@example.org"], index=self.index), {"announce": set(["alice@example.org"])})
+        self.assertEqual(catalogue.get_subscriptions(["alice@example.org"], only_public=False, index=self.index),
+                         {"announce": set(["alice@example.org"]), "private": set(["alice@example.org"])})
+        lists = catalogue.get_lists(only_public=True, index=self.index)
+        self.assertEqual([(info.name, info.real_name, info.members) for info in lists], [("announce", "Announce", frozenset())])
+        self.assertEqual(loaded, [])